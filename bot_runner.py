@@ -0,0 +1,171 @@
+import asyncio
+import hmac
+import logging
+import os
+import signal
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+import metrics
+from log_config import log_context
+
+load_dotenv()
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower() # polling | webhook
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "32")) # Одновременно обрабатываемых апдейтов (разных пользователей)
+# Апдейтов в работе вместе с ожидающими своей очереди у того же пользователя (задачи Application)
+BOT_MAX_PENDING_UPDATES = int(os.getenv("BOT_MAX_PENDING_UPDATES", "1024"))
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL") # Публичный https-адрес, например https://bot.example.com
+BOT_WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "/telegram/update")
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET") # Приходит в заголовке X-Telegram-Bot-Api-Secret-Token
+BOT_WEBHOOK_LISTEN = os.getenv("BOT_WEBHOOK_LISTEN", "0.0.0.0")
+BOT_WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", "8443"))
+BOT_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("BOT_WEBHOOK_MAX_CONNECTIONS", "40")) # Параллельных доставок со стороны Telegram
+BOT_WEBHOOK_DROP_PENDING = os.getenv("BOT_WEBHOOK_DROP_PENDING", "false").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты разных пользователей обрабатываются параллельно (не более max_concurrent_updates),
+    апдейты одного пользователя — строго по очереди, в порядке поступления; слот обработки занимает только тот,
+    чья очередь подошла.
+
+    Семафор BaseUpdateProcessor (его process_update не переопределяется) ограничивает апдейты в работе вместе
+    с ожидающими очереди пользователя — max_pending_updates. Одновременную обработку ограничивает свой семафор,
+    который do_process_update берет уже после очереди пользователя: иначе апдейты одного пользователя, стоящие
+    за его же текущим апдейтом, держали бы слоты, и апдейты других пользователей ждали бы их.
+    """
+
+    def __init__(self, max_concurrent_updates: int = BOT_CONCURRENT_UPDATES, max_pending_updates: int = BOT_MAX_PENDING_UPDATES):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.max_processing_updates = max_concurrent_updates
+        self.processing_updates = 0
+        self._processing_slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._user_locks: dict[int, asyncio.Lock] = {}
+        self._user_waiters: dict[int, int] = {} # Сколько апдейтов пользователя в работе/ожидании, чтобы удалять лишние Lock
+
+    @staticmethod
+    def _ordering_key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = self._ordering_key(update)
+        # Поля корреляции попадают во все записи лога, сделанные при обработке апдейта
+        with log_context(update_id=getattr(update, "update_id", None), telegram_id=key):
+            async with self._user_turn(key), self._processing_slots:
+                self.processing_updates += 1
+                try:
+                    await coroutine
+                finally:
+                    self.processing_updates -= 1
+
+    @asynccontextmanager
+    async def _user_turn(self, key):
+        if key is None:
+            yield
+            return
+        lock = self._user_locks.setdefault(key, asyncio.Lock())
+        self._user_waiters[key] = self._user_waiters.get(key, 0) + 1
+        try:
+            async with lock: # asyncio.Lock отдает владение в порядке ожидания (FIFO)
+                yield
+        finally:
+            self._user_waiters[key] -= 1
+            if self._user_waiters[key] == 0:
+                del self._user_waiters[key]
+                del self._user_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+async def set_bot_webhook(application: Application) -> None:
+    webhook_url = f"{BOT_WEBHOOK_URL.rstrip('/')}{BOT_WEBHOOK_PATH}"
+    await application.bot.set_webhook(
+        url=webhook_url,
+        secret_token=BOT_WEBHOOK_SECRET,
+        max_connections=BOT_WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=BOT_WEBHOOK_DROP_PENDING,
+    )
+    webhook_info = await application.bot.get_webhook_info()
+    logger.info(
+        f"Telegram webhook установлен: {webhook_url}, ожидают доставки: {webhook_info.pending_update_count}, "
+        f"последняя ошибка: {webhook_info.last_error_message or 'нет'}"
+    )
+
+
+def create_webhook_app(application: Application) -> web.Application:
+    async def telegram_update_route(request: web.Request) -> web.Response:
+        if BOT_WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), BOT_WEBHOOK_SECRET
+        ):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            logger.warning(f"Некорректный апдейт Telegram: {e}")
+            return web.Response(status=400)
+        # Сразу отвечаем Telegram; обработка идет в Application с PerUserUpdateProcessor
+        await application.update_queue.put(update)
+        return web.Response(text="OK")
+
+    async def health_route(request: web.Request) -> web.Response:
+        return web.json_response({"running": application.running, "update_queue": application.update_queue.qsize()})
+
+    webhook_app = web.Application()
+    webhook_app.router.add_post(BOT_WEBHOOK_PATH, telegram_update_route)
+    webhook_app.router.add_get("/health", health_route)
+    webhook_app.router.add_get("/metrics", metrics.metrics_route)
+    return webhook_app
+
+
+async def run_webhook(application: Application) -> None:
+    """
+    Режим webhook: Telegram доставляет апдейты на BOT_WEBHOOK_PATH, setWebhook вызывается при старте.
+    Повторяет жизненный цикл run_polling(): initialize -> post_init -> start ... stop -> post_stop -> shutdown -> post_shutdown.
+    """
+    if not BOT_WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook, но BOT_WEBHOOK_URL не задан.")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    runner = web.AppRunner(create_webhook_app(application))
+    await runner.setup()
+    try:
+        await application.start()
+        await web.TCPSite(runner, BOT_WEBHOOK_LISTEN, BOT_WEBHOOK_PORT).start()
+        logger.info(f"Webhook-сервер бота слушает {BOT_WEBHOOK_LISTEN}:{BOT_WEBHOOK_PORT}{BOT_WEBHOOK_PATH}")
+        await set_bot_webhook(application)
+        await stop_event.wait()
+    finally:
+        # Webhook не удаляем: пока бот перезапускается, Telegram копит апдейты у себя
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
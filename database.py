@@ -1,10 +1,17 @@
+import asyncio
 import os
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Boolean, Numeric
+import time
+import logging
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Boolean, Numeric, Text, UniqueConstraint, Index
+from sqlalchemy import text, event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+import metrics
+
 load_dotenv()
 
 DB_HOST = os.getenv("DB_HOST")
@@ -17,9 +24,98 @@ if not all([DB_HOST, DB_NAME, DB_USER, DB_PASSWORD]):
     print("КРИТИЧЕСКАЯ ОШИБКА: Не все переменные для подключения к БД установлены в .env файле.")
 
 DATABASE_URL = f"postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Строка подключения для прямых соединений psycopg (например, LISTEN/NOTIFY)
+PSYCOPG_CONNINFO = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# --- Настройки пула соединений ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30")) # Сколько ждать свободное соединение
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_SLOW_CHECKOUT_WARN_SEC = float(os.getenv("DB_POOL_SLOW_CHECKOUT_WARN_SEC", "0.5"))
+# Серверные prepared statements psycopg: запрос готовится после N выполнений на соединении,
+# кэш ограничен DB_PREPARED_MAX запросами на соединение (горячие запросы по telegram_id, user_id, yookassa id)
+# DB_PREPARE_THRESHOLD=none отключает их (например, за pgbouncer в режиме transaction)
+_prepare_threshold_env = os.getenv("DB_PREPARE_THRESHOLD", "2")
+DB_PREPARE_THRESHOLD = None if _prepare_threshold_env.lower() == "none" else int(_prepare_threshold_env)
+DB_PREPARED_MAX = int(os.getenv("DB_PREPARED_MAX", "50"))
+
+logger = logging.getLogger(__name__)
+
+# Статистика ожидания соединения из пула (по процессу)
+pool_checkout_stats = {"checkouts": 0, "wait_total_sec": 0.0, "wait_max_sec": 0.0, "slow_checkouts": 0, "timeouts": 0}
+
+
+class InstrumentedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """Пул, который измеряет время ожидания свободного соединения."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection_record = super()._do_get()
+        except Exception:
+            pool_checkout_stats["timeouts"] += 1
+            raise
+        waited = time.perf_counter() - started
+        pool_checkout_stats["checkouts"] += 1
+        pool_checkout_stats["wait_total_sec"] += waited
+        pool_checkout_stats["wait_max_sec"] = max(pool_checkout_stats["wait_max_sec"], waited)
+        if waited >= DB_POOL_SLOW_CHECKOUT_WARN_SEC:
+            pool_checkout_stats["slow_checkouts"] += 1
+            logger.warning(f"Ожидание соединения из пула БД заняло {waited:.3f} с (занято {self.checkedout()} из {self.size()} + overflow {self.overflow()}).")
+        return connection_record
+
 
 # Настройка для стабильного подключения к БД
-async_engine = create_async_engine(DATABASE_URL, echo=False, pool_recycle=1800)
+async_engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    poolclass=InstrumentedAsyncQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={"prepare_threshold": DB_PREPARE_THRESHOLD},
+)
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _configure_psycopg_connection(dbapi_connection, connection_record):
+    # Ограничиваем кэш prepared statements на соединении
+    dbapi_connection.driver_connection.prepared_max = DB_PREPARED_MAX
+
+
+def get_pool_stats() -> dict:
+    """Текущее состояние пула и статистика ожидания соединений."""
+    pool = async_engine.pool
+    checkouts = pool_checkout_stats["checkouts"]
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "checkouts": checkouts,
+        "wait_avg_ms": round(pool_checkout_stats["wait_total_sec"] / checkouts * 1000, 3) if checkouts else 0.0,
+        "wait_max_ms": round(pool_checkout_stats["wait_max_sec"] * 1000, 3),
+        "slow_checkouts": pool_checkout_stats["slow_checkouts"],
+        "timeouts": pool_checkout_stats["timeouts"],
+    }
+
+def _collect_pool_metrics() -> None:
+    pool = async_engine.pool
+    metrics.db_pool.set(pool.size(), state="size")
+    metrics.db_pool.set(pool.checkedout(), state="checked_out")
+    metrics.db_pool.set(pool.checkedin(), state="checked_in")
+    metrics.db_pool.set(pool.overflow(), state="overflow")
+    metrics.db_pool_checkout_wait.set(pool_checkout_stats["wait_total_sec"], stat="total")
+    metrics.db_pool_checkout_wait.set(pool_checkout_stats["wait_max_sec"], stat="max")
+    metrics.db_pool_checkouts.set_total(pool_checkout_stats["checkouts"], kind="all")
+    metrics.db_pool_checkouts.set_total(pool_checkout_stats["slow_checkouts"], kind="slow")
+    metrics.db_pool_checkouts.set_total(pool_checkout_stats["timeouts"], kind="timeout")
+
+metrics.on_collect(_collect_pool_metrics)
 
 Base = declarative_base()
 AsyncSessionLocal = sessionmaker(
@@ -41,15 +137,28 @@ class User(Base):
 
 class Payment(Base):
     __tablename__ = "payments"
+    __table_args__ = (
+        # Индексы для существующих БД создаются миграциями (migrations.py)
+        Index("ix_payments_status_created_at", "status", "created_at"),
+        # Повторное нажатие "оплатить": живая ссылка ищется по пользователю и покупке среди pending
+        Index("ix_payments_user_purchase_pending", "user_id", "purchase_key", "confirmation_expires_at", postgresql_where=text("status = 'pending'")),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     yookassa_payment_id = Column(String, unique=True, index=True, nullable=False)
     amount = Column(Numeric(10, 2), nullable=False)
     # --- ВОССТАНОВЛЕННОЕ ПОЛЕ ---
     currency = Column(String(3), nullable=False, default="RUB")
-    status = Column(String(30), nullable=False, default="pending")
+    status = Column(String(30), nullable=False, default="pending") # pending -> processing (захвачен воркером) -> succeeded / canceled; failed — ошибка в данных, разбор вручную
     description = Column(String, nullable=True)
     additional_data = Column(String, nullable=True)
+    # Аренда обработки: воркер, упавший посреди processing, не держит платеж дольше claimed_until
+    claimed_until = Column(DateTime, nullable=True)
+    claim_token = Column(String(32), nullable=True) # Кто держит аренду; финальный переход проверяет, что это мы
+    # Ссылка на оплату и до какого момента ее можно выдавать повторно
+    confirmation_url = Column(String, nullable=True)
+    confirmation_expires_at = Column(DateTime, nullable=True)
+    purchase_key = Column(String(200), nullable=True) # Что покупается: действие, подписка, срок (см. initiate_yookassa_payment)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -60,6 +169,14 @@ class Payment(Base):
 
 class VpnKey(Base): # Класс можно переименовать в MarzbanSubscription или UserSubscription для ясности
     __tablename__ = "vpn_keys" # Таблицу тоже можно переименовать, например, в user_subscriptions
+    __table_args__ = (
+        # Индексы для существующих БД создаются миграциями (migrations.py)
+        Index("ix_vpn_keys_active_expires_at", "expires_at", "id", postgresql_where=text("is_active")),
+        Index("ix_vpn_keys_user_id_is_trial", "user_id", "is_trial"),
+        Index("ix_vpn_keys_user_active_trial_expires", "user_id", "is_active", "is_trial", "expires_at"),
+        # Не больше одного триала на пользователя
+        Index("uq_vpn_keys_user_trial", "user_id", unique=True, postgresql_where=text("is_trial")),
+    )
     id = Column(Integer, primary_key=True, index=True)
 
     # Новые поля для Marzban
@@ -80,11 +197,58 @@ class VpnKey(Base): # Класс можно переименовать в Marzba
     payment = relationship("Payment", back_populates="marzban_subscription_association")
 
 
+class ExpiryReminder(Base):
+    """Отправленные напоминания об окончании подписки: одно на подписку и конкретную дату окончания."""
+    __tablename__ = "expiry_reminders"
+    # После продления expires_at меняется — к новой дате окончания уйдет новое напоминание
+    vpn_key_id = Column(Integer, ForeignKey("vpn_keys.id", ondelete="CASCADE"), primary_key=True)
+    expires_at = Column(DateTime, primary_key=True)
+    sent_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class JobCheckpoint(Base):
+    """Позиция постраничного фонового обхода: прерванный запуск продолжается с нее, а не с начала."""
+    __tablename__ = "job_checkpoints"
+    name = Column(String(50), primary_key=True) # Например, "expiry_sweep"
+    run_started_at = Column(DateTime, nullable=False) # Граница выборки запуска (expires_at <= run_started_at)
+    cursor_expires_at = Column(DateTime, nullable=True) # Keyset-курсор: последняя обработанная строка
+    cursor_id = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True) # NULL — запуск не завершен
+
+
+class WebhookInbox(Base):
+    """Входящие уведомления YooKassa: вебхук только сохраняет их, обработку делают фоновые воркеры."""
+    __tablename__ = "webhook_inbox"
+    __table_args__ = (
+        # Повторная доставка того же события не создает новую запись
+        UniqueConstraint("yookassa_payment_id", "event", name="uq_webhook_inbox_payment_event"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    yookassa_payment_id = Column(String, nullable=False)
+    event = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=False) # Сырой JSON уведомления
+    status = Column(String(20), nullable=False, default="pending") # pending / processing / done / failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+    locked_until = Column(DateTime, nullable=True) # Аренда записи воркером; после истечения запись снова можно забрать
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+
+
 async def create_db_tables():
     async with async_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
     print("Таблицы базы данных проверены/созданы.")
 
+async def warm_up_pool(connections: int) -> None:
+    """Открывает соединения пула заранее, чтобы первые запросы не ждали TCP/TLS и аутентификацию."""
+    async def touch():
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    await asyncio.gather(*(touch() for _ in range(min(connections, async_engine.pool.size()))))
+
 async def get_async_session() -> AsyncSession:
     async with AsyncSessionLocal() as session:
         yield session
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from sqlalchemy import and_, delete, exists, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.future import select
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import Forbidden
+
+import metrics
+from database import User as DbUser, VpnKey, ExpiryReminder, AsyncSessionLocal
+from telegram_dispatcher import PRIORITY_BULK
+
+load_dotenv()
+
+EXPIRY_REMINDER_WINDOW_HOURS = int(os.getenv("EXPIRY_REMINDER_WINDOW_HOURS", "72")) # За сколько часов до окончания напоминать
+EXPIRY_REMINDER_PAGE_SIZE = int(os.getenv("EXPIRY_REMINDER_PAGE_SIZE", "500")) # Строк на страницу (keyset)
+EXPIRY_REMINDER_CONCURRENCY = int(os.getenv("EXPIRY_REMINDER_CONCURRENCY", "20")) # Одновременных отправок в очереди Telegram
+
+logger = logging.getLogger(__name__)
+
+expiry_reminder_lock = asyncio.Lock()
+
+
+def _reminder_page_query(now: datetime, window_end: datetime, after: tuple[datetime, int] | None):
+    """Страница подписок, истекающих в окне и еще без напоминания к текущей дате окончания."""
+    already_sent = exists().where(and_(
+        ExpiryReminder.vpn_key_id == VpnKey.id,
+        ExpiryReminder.expires_at == VpnKey.expires_at,
+    ))
+    stmt = (
+        select(VpnKey.id, VpnKey.marzban_username, VpnKey.expires_at, VpnKey.is_trial, DbUser.telegram_id)
+        .join(DbUser, DbUser.id == VpnKey.user_id)
+        .where(
+            VpnKey.is_active == True,
+            VpnKey.expires_at > now,
+            VpnKey.expires_at <= window_end,
+            ~already_sent,
+        )
+        # Порядок совпадает с частичным индексом ix_vpn_keys_active_expires_at (expires_at, id) WHERE is_active
+        .order_by(VpnKey.expires_at, VpnKey.id)
+        .limit(EXPIRY_REMINDER_PAGE_SIZE)
+    )
+    if after is not None:
+        stmt = stmt.where(tuple_(VpnKey.expires_at, VpnKey.id) > tuple_(*after))
+    return stmt
+
+
+def _reminder_text(marzban_username: str, expires_at: datetime, is_trial: bool, now: datetime) -> str:
+    hours_left = max(1, int((expires_at - now).total_seconds() // 3600))
+    kind = "Пробный период" if is_trial else "Ваша VPN подписка"
+    return (
+        f"⏳ {kind} ({marzban_username}) заканчивается через {hours_left} ч.\n\n"
+        f"Дата окончания: {expires_at.strftime('%d.%m.%Y %H:%M')} UTC\n"
+        f"Продлите подписку заранее, чтобы не потерять доступ."
+    )
+
+
+async def _send_reminder(bot, row, now: datetime, semaphore: asyncio.Semaphore) -> str:
+    """Возвращает "sent", "blocked" (пользователь заблокировал бота) или "failed"."""
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Продлить на 1 месяц", callback_data=f"extend_sub_{row.id}")]])
+    async with semaphore:
+        try:
+            await bot.send_message(
+                chat_id=row.telegram_id,
+                text=_reminder_text(row.marzban_username, row.expires_at, row.is_trial, now),
+                reply_markup=keyboard,
+                rate_limit_args={"priority": PRIORITY_BULK},
+            )
+            return "sent"
+        except Forbidden:
+            return "blocked"
+        except Exception as e:
+            logger.warning(f"Напоминание для подписки {row.id} (telegram_id {row.telegram_id}) не отправлено: {e}")
+            return "failed"
+
+
+async def send_expiry_reminders(bot) -> dict | None:
+    """
+    Рассылает напоминания "продлить" по подпискам, истекающим в ближайшие EXPIRY_REMINDER_WINDOW_HOURS.
+    Обходит подписки постранично (keyset по expires_at, id), поэтому память не зависит от их числа.
+    Напоминание сначала записывается в expiry_reminders (ON CONFLICT DO NOTHING), потом отправляется:
+    повторный или параллельный запуск его не продублирует. Неудачные отправки удаляются из таблицы
+    и повторяются в следующий запуск. Возвращает сводку с пропускной способностью.
+    """
+    if expiry_reminder_lock.locked():
+        logger.warning("Expiry reminders: previous run is still in progress, skipping.")
+        return None
+
+    async with expiry_reminder_lock:
+        started = time.monotonic()
+        now = datetime.utcnow()
+        window_end = now + timedelta(hours=EXPIRY_REMINDER_WINDOW_HOURS)
+        semaphore = asyncio.Semaphore(EXPIRY_REMINDER_CONCURRENCY)
+        summary = {"scanned": 0, "sent": 0, "blocked": 0, "failed": 0, "skipped": 0, "pages": 0}
+        after = None
+
+        while True:
+            async with AsyncSessionLocal() as session:
+                rows = (await session.execute(_reminder_page_query(now, window_end, after))).all()
+                if not rows:
+                    break
+                after = (rows[-1].expires_at, rows[-1].id)
+                summary["pages"] += 1
+                summary["scanned"] += len(rows)
+
+                # Резервируем напоминания до отправки: строки, которые уже забрал другой запуск, не вернутся
+                reserved_ids = set((await session.execute(
+                    pg_insert(ExpiryReminder)
+                    .values([{"vpn_key_id": row.id, "expires_at": row.expires_at, "sent_at": now} for row in rows])
+                    .on_conflict_do_nothing()
+                    .returning(ExpiryReminder.vpn_key_id)
+                )).scalars().all())
+                await session.commit()
+
+                to_send = [row for row in rows if row.id in reserved_ids]
+                summary["skipped"] += len(rows) - len(to_send)
+                outcomes = await asyncio.gather(*(_send_reminder(bot, row, now, semaphore) for row in to_send))
+
+                failed = [row for row, outcome in zip(to_send, outcomes) if outcome == "failed"]
+                for outcome in outcomes:
+                    summary[outcome] += 1
+                if failed:
+                    await session.execute(delete(ExpiryReminder).where(
+                        tuple_(ExpiryReminder.vpn_key_id, ExpiryReminder.expires_at).in_([(row.id, row.expires_at) for row in failed])
+                    ))
+                    await session.commit()
+
+            if len(rows) < EXPIRY_REMINDER_PAGE_SIZE:
+                break
+
+        wall_time = time.monotonic() - started
+        summary["wall_time_sec"] = round(wall_time, 2)
+        summary["rows_per_sec"] = round(summary["scanned"] / wall_time, 1) if wall_time > 0 else 0.0
+        summary["sent_per_sec"] = round(summary["sent"] / wall_time, 1) if wall_time > 0 else 0.0
+        metrics.observe_job("expiry_reminders", summary, wall_time, outcomes=("scanned", "sent", "blocked", "failed", "skipped"))
+        logger.info(
+            f"Expiry reminders finished. Scanned: {summary['scanned']} in {summary['pages']} pages, sent: {summary['sent']}, "
+            f"blocked: {summary['blocked']}, failed: {summary['failed']}, skipped: {summary['skipped']}, "
+            f"wall time: {summary['wall_time_sec']} s ({summary['rows_per_sec']} rows/s, {summary['sent_per_sec']} sent/s)."
+        )
+        return summary
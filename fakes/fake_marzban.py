@@ -0,0 +1,123 @@
+# Локальная заглушка API панели Marzban для тестов и нагрузочных прогонов.
+#
+# Запуск:
+#     python -m fakes.fake_marzban --port 8082 --latency-ms 100 --error-rate 0.01
+# и MARZBAN_PANEL_URL=http://127.0.0.1:8082 для бота и вебхука.
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+TOKEN_TTL_SEC = 24 * 3600
+
+
+def _make_jwt(ttl_sec: int) -> str:
+    def encode(part: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip("=")
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode({'sub': 'admin', 'exp': int(time.time()) + ttl_sec})}.{uuid.uuid4().hex}"
+
+
+def create_app(latency_ms: float = 0.0, error_rate: float = 0.0, token_ttl_sec: int = TOKEN_TTL_SEC) -> web.Application:
+    users: dict[str, dict] = {}
+    tokens: set[str] = set()
+
+    async def simulate_conditions(request: web.Request):
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        if error_rate and random.random() < error_rate:
+            raise web.HTTPServiceUnavailable(text='{"detail": "Service unavailable"}', content_type="application/json")
+        if request.path != "/api/admin/token":
+            scheme, _, access_token = request.headers.get("Authorization", "").partition(" ")
+            if scheme.lower() != "bearer" or access_token not in tokens:
+                raise web.HTTPUnauthorized(text='{"detail": "Could not validate credentials"}', content_type="application/json")
+
+    def user_response(user: dict) -> dict:
+        # Только поля ответа Marzban (их принимает marzpy.User); sub_token — внутреннее поле заглушки
+        fields = {key: value for key, value in user.items() if key != "sub_token"}
+        return {**fields, "subscription_url": f"/sub/{user['username']}/{user['sub_token']}", "links": []}
+
+    async def login(request: web.Request) -> web.Response:
+        await simulate_conditions(request)
+        access_token = _make_jwt(token_ttl_sec)
+        tokens.add(access_token)
+        return web.json_response({"access_token": access_token, "token_type": "bearer"})
+
+    async def add_user(request: web.Request) -> web.Response:
+        await simulate_conditions(request)
+        body = await request.json()
+        username = body.get("username")
+        if not username:
+            return web.json_response({"detail": "username is required"}, status=422)
+        if username in users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        users[username] = {
+            "username": username,
+            "proxies": body.get("proxies") or {},
+            "inbounds": body.get("inbounds") or {},
+            "expire": body.get("expire") or 0,
+            "data_limit": body.get("data_limit") or 0,
+            "data_limit_reset_strategy": body.get("data_limit_reset_strategy") or "no_reset",
+            "status": body.get("status") or "active",
+            "used_traffic": 0,
+            "lifetime_used_traffic": 0,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "sub_token": uuid.uuid4().hex,
+        }
+        return web.json_response(user_response(users[username]))
+
+    async def get_user(request: web.Request) -> web.Response:
+        await simulate_conditions(request)
+        user = users.get(request.match_info["username"])
+        if not user:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response(user_response(user))
+
+    async def modify_user(request: web.Request) -> web.Response:
+        await simulate_conditions(request)
+        user = users.get(request.match_info["username"])
+        if not user:
+            return web.json_response({"detail": "User not found"}, status=404)
+        body = await request.json()
+        for field in ("expire", "data_limit", "data_limit_reset_strategy", "status", "proxies", "inbounds"):
+            if body.get(field) is not None:
+                user[field] = body[field]
+        return web.json_response(user_response(user))
+
+    async def delete_user(request: web.Request) -> web.Response:
+        await simulate_conditions(request)
+        if not users.pop(request.match_info["username"], None):
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response({})
+
+    async def list_users(request: web.Request) -> web.Response:
+        await simulate_conditions(request)
+        offset = int(request.query.get("offset") or 0)
+        limit = int(request.query.get("limit") or len(users) or 1)
+        page = list(users.values())[offset:offset + limit]
+        return web.json_response({"users": [user_response(user) for user in page], "total": len(users)})
+
+    app = web.Application()
+    app.router.add_post("/api/admin/token", login)
+    app.router.add_post("/api/user", add_user)
+    app.router.add_get("/api/user/{username}", get_user)
+    app.router.add_put("/api/user/{username}", modify_user)
+    app.router.add_delete("/api/user/{username}", delete_user)
+    app.router.add_get("/api/users", list_users)
+    app["users"] = users
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка API Marzban")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency_ms, args.error_rate), host=args.host, port=args.port)
@@ -0,0 +1,73 @@
+# Локальная заглушка Telegram Bot API: принимает исходящие запросы бота и отвечает как Telegram.
+#
+# Запуск:
+#     python -m fakes.fake_telegram --port 8083 --latency-ms 30
+# и TELEGRAM_BOT_API_URL=http://127.0.0.1:8083/bot для бота и вебхука.
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "VPN Bot", "username": "fake_vpn_bot"}
+
+
+def create_app(latency_ms: float = 0.0, error_rate: float = 0.0) -> web.Application:
+    message_ids = itertools.count(1)
+    sent: list[dict] = [] # Последние исходящие сообщения (для проверок в сценариях)
+    calls: dict[str, int] = {}
+
+    async def bot_method(request: web.Request) -> web.Response:
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        method = request.match_info["method"]
+        calls[method] = calls.get(method, 0) + 1
+        if error_rate and random.random() < error_rate:
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}}, status=429)
+
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": BOT_USER})
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            message = {
+                "message_id": int(params.get("message_id") or next(message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+            if params.get("reply_markup"):
+                reply_markup = params["reply_markup"]
+                message["reply_markup"] = json.loads(reply_markup) if isinstance(reply_markup, str) else reply_markup
+                if "inline_keyboard" not in message["reply_markup"]:
+                    del message["reply_markup"] # Обычная клавиатура в ответе Telegram не возвращается
+            sent.append(message)
+            del sent[:-1000]
+            return web.json_response({"ok": True, "result": message})
+        if method == "getWebhookInfo":
+            return web.json_response({"ok": True, "result": {"url": "", "has_custom_certificate": False, "pending_update_count": 0}})
+        return web.json_response({"ok": True, "result": True})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", bot_method)
+    app["sent"] = sent
+    app["calls"] = calls
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8083)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency_ms, args.error_rate), host=args.host, port=args.port)
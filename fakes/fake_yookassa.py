@@ -0,0 +1,98 @@
+# Локальная заглушка YooKassa API v3 для тестов и нагрузочных прогонов.
+#
+# Запуск:
+#     python -m fakes.fake_yookassa --port 8081 --latency-ms 50 --error-rate 0.01
+# и YOOKASSA_API_URL=http://127.0.0.1:8081/v3 для бота.
+import argparse
+import asyncio
+import random
+import uuid
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+
+def create_app(latency_ms: float = 0.0, error_rate: float = 0.0) -> web.Application:
+    payments: dict[str, dict] = {}
+    by_idempotency_key: dict[str, str] = {}
+
+    async def simulate_conditions():
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        if error_rate and random.random() < error_rate:
+            raise web.HTTPInternalServerError(text='{"type": "error", "code": "internal_server_error"}', content_type="application/json")
+
+    async def create_payment(request: web.Request) -> web.Response:
+        await simulate_conditions()
+        idempotency_key = request.headers.get("Idempotence-Key")
+        if not idempotency_key:
+            return web.json_response({"type": "error", "code": "invalid_request", "description": "Idempotence-Key required"}, status=400)
+        body = await request.json()
+        # Между проверкой и записью нет await — повтор с тем же ключом всегда получит тот же платеж
+        if idempotency_key in by_idempotency_key:
+            return web.json_response(payments[by_idempotency_key[idempotency_key]])
+
+        payment_id = str(uuid.uuid4())
+        payments[payment_id] = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "amount": body.get("amount"),
+            "description": body.get("description"),
+            "metadata": body.get("metadata") or {},
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.ru/checkout/payments/v2/contract?orderId={payment_id}"},
+        }
+        by_idempotency_key[idempotency_key] = payment_id
+        return web.json_response(payments[payment_id])
+
+    async def get_payment(request: web.Request) -> web.Response:
+        await simulate_conditions()
+        payment = payments.get(request.match_info["payment_id"])
+        if not payment:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        return web.json_response(payment)
+
+    async def list_payments(request: web.Request) -> web.Response:
+        await simulate_conditions()
+        items = sorted(payments.values(), key=lambda payment: payment["created_at"])
+        if request.query.get("status"):
+            items = [payment for payment in items if payment["status"] == request.query["status"]]
+        if request.query.get("created_at.gte"):
+            items = [payment for payment in items if payment["created_at"] >= request.query["created_at.gte"]]
+        if request.query.get("created_at.lte"):
+            items = [payment for payment in items if payment["created_at"] <= request.query["created_at.lte"]]
+        offset = int(request.query.get("cursor") or 0)
+        limit = int(request.query.get("limit") or 10)
+        page = items[offset:offset + limit]
+        response = {"type": "list", "items": page}
+        if offset + limit < len(items):
+            response["next_cursor"] = str(offset + limit)
+        return web.json_response(response)
+
+    async def set_status(request: web.Request) -> web.Response:
+        """Служебный метод заглушки: перевести платеж в succeeded/canceled."""
+        payment = payments.get(request.match_info["payment_id"])
+        if not payment:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        payment["status"] = request.match_info["status"]
+        payment["paid"] = payment["status"] == "succeeded"
+        return web.json_response(payment)
+
+    app = web.Application()
+    app.router.add_post("/v3/payments", create_payment)
+    app.router.add_get("/v3/payments", list_payments)
+    app.router.add_get("/v3/payments/{payment_id}", get_payment)
+    app.router.add_post("/v3/_fake/payments/{payment_id}/{status}", set_status)
+    app["payments"] = payments
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка YooKassa API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency_ms, args.error_rate), host=args.host, port=args.port)
@@ -0,0 +1,285 @@
+# Нагрузочный стенд: сценарий пользователя start -> триал -> "Моя подписка" -> продление -> вебхук оплаты
+# целиком в одном процессе. Marzban, YooKassa и Telegram Bot API заменены локальными заглушками (fakes/),
+# апдейты Telegram подаются напрямую в Application.process_update, уведомления — POST в приложение вебхука.
+# Нужна только Postgres (DB_* из .env); лучше отдельная база, стенд создает в ней пользователей и подписки.
+#
+# Запуск:
+#     python load_test.py --users 200 --concurrency 20 --marzban-latency-ms 80 --yookassa-latency-ms 150
+#     python load_test.py --users 500 --json results/$(git rev-parse --short HEAD).json  # для сравнения коммитов
+#
+# Каждое уведомление об оплате дополнительно доставляется --duplicate-deliveries раз параллельно в обход inbox
+# (как повторная доставка и сверка одновременно); сценарий падает, если подписка продлена больше одного раза.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from fakes import fake_marzban, fake_telegram, fake_yookassa
+
+JOURNEY_STEPS = ("start", "trial", "my_keys", "extend", "payment_webhook")
+EXTEND_DAYS = 30 # Продление из кнопки "Продлить на 1 месяц"
+
+logger = logging.getLogger("load_test")
+
+
+async def start_fake(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: list[float]) -> dict:
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+        "max_ms": round(values[-1] * 1000, 1) if values else 0.0,
+    }
+
+
+class Journey:
+    """Один синтетический пользователь и его апдейты."""
+
+    def __init__(self, application, telegram_id: int):
+        self.application = application
+        self.telegram_id = telegram_id
+        self.user = {"id": telegram_id, "is_bot": False, "first_name": f"Load {telegram_id}", "username": f"load_{telegram_id}"}
+        self.chat = {"id": telegram_id, "type": "private"}
+        self.message_id = 0
+
+    def _update_id(self) -> int:
+        return int(uuid.uuid4().int % 2_000_000_000)
+
+    def message_update(self, text: str):
+        from telegram import Update
+        self.message_id += 1
+        message = {"message_id": self.message_id, "date": int(time.time()), "chat": self.chat, "from": self.user, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": self._update_id(), "message": message}, self.application.bot)
+
+    def callback_update(self, data: str):
+        from telegram import Update
+        message = {"message_id": self.message_id, "date": int(time.time()), "chat": self.chat, "from": fake_telegram.BOT_USER, "text": "..."}
+        callback_query = {"id": uuid.uuid4().hex, "from": self.user, "chat_instance": str(self.telegram_id), "data": data, "message": message}
+        return Update.de_json({"update_id": self._update_id(), "callback_query": callback_query}, self.application.bot)
+
+
+async def run_journey(ctx: dict, telegram_id: int) -> dict[str, float]:
+    """Проходит сценарий и возвращает длительность каждого шага (сек). Исключение — сценарий не удался."""
+    bot = ctx["bot_module"]
+    from sqlalchemy.future import select
+    from database import AsyncSessionLocal, Payment, User as DbUser, VpnKey
+
+    journey = Journey(ctx["application"], telegram_id)
+    timings = {}
+
+    async def timed(step: str, coroutine):
+        started = time.perf_counter()
+        result = await coroutine
+        timings[step] = time.perf_counter() - started
+        return result
+
+    await timed("start", ctx["application"].process_update(journey.message_update("/start")))
+    await timed("trial", ctx["application"].process_update(journey.message_update(bot.BUTTON_GET_KEY)))
+    await timed("my_keys", ctx["application"].process_update(journey.message_update(bot.BUTTON_MY_KEYS)))
+
+    async with AsyncSessionLocal() as session:
+        subscription_id = (await session.execute(
+            select(VpnKey.id).join(DbUser, DbUser.id == VpnKey.user_id).where(DbUser.telegram_id == telegram_id).limit(1)
+        )).scalar_one_or_none()
+    if subscription_id is None:
+        raise RuntimeError(f"{telegram_id}: триал не выдан")
+    await timed("extend", ctx["application"].process_update(journey.callback_update(f"extend_sub_{subscription_id}")))
+
+    async with AsyncSessionLocal() as session:
+        yookassa_payment_id = (await session.execute(
+            select(Payment.yookassa_payment_id).join(DbUser, DbUser.id == Payment.user_id)
+            .where(DbUser.telegram_id == telegram_id, Payment.status == "pending").limit(1)
+        )).scalar_one_or_none()
+    if yookassa_payment_id is None:
+        raise RuntimeError(f"{telegram_id}: платеж на продление не создан")
+
+    async def subscription_expires_at():
+        async with AsyncSessionLocal() as session:
+            return (await session.execute(select(VpnKey.expires_at).where(VpnKey.id == subscription_id))).scalar_one()
+
+    async def pay_and_wait():
+        payment_object = ctx["yookassa_payments"][yookassa_payment_id]
+        payment_object.update(status="succeeded", paid=True)
+        notification = {"type": "notification", "event": "payment.succeeded", "object": payment_object}
+        expires_before = await subscription_expires_at()
+        response, *_ = await asyncio.gather(
+            ctx["webhook_client"].post("/yookassa_webhook", json=notification),
+            *(ctx["webhook_module"].process_yookassa_notification_standalone(notification) for _ in range(ctx["duplicate_deliveries"])),
+        )
+        if response.status != 200:
+            raise RuntimeError(f"{telegram_id}: вебхук ответил {response.status}")
+        # Ждем, пока inbox-воркер проведет платеж
+        deadline = time.monotonic() + ctx["payment_timeout_sec"]
+        while time.monotonic() < deadline:
+            async with AsyncSessionLocal() as session:
+                status = (await session.execute(
+                    select(Payment.status).where(Payment.yookassa_payment_id == yookassa_payment_id)
+                )).scalar_one()
+            if status == "succeeded":
+                extended_days = (await subscription_expires_at() - expires_before).total_seconds() / 86400
+                if extended_days > EXTEND_DAYS * 1.5:
+                    raise RuntimeError(f"{telegram_id}: платеж {yookassa_payment_id} проведен повторно (продление на {extended_days:.1f} дн.)")
+                return
+            await asyncio.sleep(0.02)
+        raise RuntimeError(f"{telegram_id}: платеж {yookassa_payment_id} не проведен за {ctx['payment_timeout_sec']} с")
+
+    await timed("payment_webhook", pay_and_wait())
+    timings["journey"] = sum(timings[step] for step in JOURNEY_STEPS)
+    return timings
+
+
+async def run(args) -> dict:
+    marzban_runner, marzban_url = await start_fake(fake_marzban.create_app(args.marzban_latency_ms, args.marzban_error_rate))
+    yookassa_app = fake_yookassa.create_app(args.yookassa_latency_ms, args.yookassa_error_rate)
+    yookassa_runner, yookassa_url = await start_fake(yookassa_app)
+    telegram_runner, telegram_url = await start_fake(fake_telegram.create_app(args.telegram_latency_ms))
+
+    # Настройки читаются при импорте модулей бота и вебхука, поэтому задаем их до импорта
+    os.environ.update({
+        "BOT_TOKEN": "123456:LOADTEST",
+        "TELEGRAM_BOT_API_URL": f"{telegram_url}/bot",
+        "MARZBAN_PANEL_URL": marzban_url,
+        "MARZBAN_USERNAME": "admin",
+        "MARZBAN_PASSWORD": "admin",
+        "YOOKASSA_API_URL": f"{yookassa_url}/v3",
+        "YOOKASSA_SHOP_ID": "loadtest",
+        "YOOKASSA_SECRET_KEY": "loadtest",
+        "BOT_METRICS_PORT": "0",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"), # Бот и вебхук настраивают логирование сами (log_config.py)
+        "TELEGRAM_GLOBAL_RATE_PER_SEC": os.getenv("TELEGRAM_GLOBAL_RATE_PER_SEC", "100000"), # Лимиты Telegram к заглушке не применяем
+        "TELEGRAM_GLOBAL_BURST": os.getenv("TELEGRAM_GLOBAL_BURST", "100000"),
+        "TELEGRAM_CHAT_RATE_PER_SEC": os.getenv("TELEGRAM_CHAT_RATE_PER_SEC", "100000"),
+        "TELEGRAM_CHAT_BURST": os.getenv("TELEGRAM_CHAT_BURST", "100000"),
+    })
+    import my_telegram_bot as bot_module
+    import webhook_listener
+
+    application = bot_module.build_application()
+    await application.initialize()
+    await application.post_init(application)
+    webhook_client = TestClient(TestServer(await webhook_listener.create_app()))
+    await webhook_client.start_server()
+
+    ctx = {
+        "bot_module": bot_module,
+        "application": application,
+        "webhook_client": webhook_client,
+        "yookassa_payments": yookassa_app["payments"],
+        "payment_timeout_sec": args.payment_timeout_sec,
+        "webhook_module": webhook_listener,
+        "duplicate_deliveries": args.duplicate_deliveries,
+    }
+    # Новые пользователи на каждый прогон; users.telegram_id — INTEGER, поэтому держимся в пределах int4
+    user_id_base = args.user_id_base or 1_000_000_000 + (int(time.time()) % 100_000) * 10_000
+    semaphore = asyncio.Semaphore(args.concurrency)
+    step_samples: dict[str, list[float]] = {step: [] for step in JOURNEY_STEPS + ("journey",)}
+    failures: list[str] = []
+
+    async def one_user(user_no: int):
+        async with semaphore:
+            try:
+                timings = await run_journey(ctx, user_id_base + user_no)
+            except Exception as e:
+                failures.append(f"{type(e).__name__}: {e}")
+                return
+            for step, seconds in timings.items():
+                step_samples[step].append(seconds)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(one_user(user_no) for user_no in range(args.users)))
+    finally:
+        wall_time = time.perf_counter() - started
+        await webhook_client.close()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        for runner in (marzban_runner, yookassa_runner, telegram_runner):
+            await runner.cleanup()
+
+    completed = len(step_samples["journey"])
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "completed": completed,
+        "failed": len(failures),
+        "failure_examples": failures[:5],
+        "wall_time_sec": round(wall_time, 2),
+        "journeys_per_sec": round(completed / wall_time, 2) if wall_time > 0 else 0.0,
+        "steps": {step: summarize(samples) for step, samples in step_samples.items()},
+        "startup": dict(bot_module.startup_timings), # Этапы холодного старта бота, включая first_update
+        "fakes": {
+            "marzban_latency_ms": args.marzban_latency_ms,
+            "yookassa_latency_ms": args.yookassa_latency_ms,
+            "telegram_latency_ms": args.telegram_latency_ms,
+            "marzban_error_rate": args.marzban_error_rate,
+            "yookassa_error_rate": args.yookassa_error_rate,
+        },
+    }
+
+
+def print_report(report: dict) -> None:
+    print(
+        f"Пользователей: {report['users']}, параллельно: {report['concurrency']}, успешно: {report['completed']}, "
+        f"ошибок: {report['failed']}, время: {report['wall_time_sec']} с, {report['journeys_per_sec']} сценариев/с"
+    )
+    print(f"{'шаг':<16}{'count':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for step, stats in report["steps"].items():
+        print(f"{step:<16}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    print("Старт бота, с: " + ", ".join(f"{stage} {seconds}" for stage, seconds in report["startup"].items()))
+    for failure in report["failure_examples"]:
+        print(f"  ошибка: {failure}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон сценария пользователя на заглушках")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--marzban-latency-ms", type=float, default=50.0)
+    parser.add_argument("--marzban-error-rate", type=float, default=0.0)
+    parser.add_argument("--yookassa-latency-ms", type=float, default=100.0)
+    parser.add_argument("--yookassa-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency-ms", type=float, default=20.0)
+    parser.add_argument("--payment-timeout-sec", type=float, default=30.0)
+    parser.add_argument("--duplicate-deliveries", type=int, default=2, help="Параллельных повторов уведомления об оплате в обход inbox")
+    parser.add_argument("--user-id-base", type=int, default=0, help="Первый telegram_id синтетических пользователей")
+    parser.add_argument("--json", help="Сохранить отчет в JSON-файл")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or ".", exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0 if report["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    sys.exit(main())
@@ -0,0 +1,159 @@
+# Общая настройка логирования для бота и вебхука.
+# Записи кладутся в очередь (QueueHandler) и форматируются/пишутся фоновым потоком (QueueListener),
+# поэтому event loop не ждет ни форматирования, ни вывода в stdout.
+#
+# Настройки:
+#     LOG_LEVEL=INFO
+#     LOG_FORMAT=json            # json — одна JSON-строка на запись, text — прежний формат для локальной отладки
+#     LOG_QUEUE_SIZE=10000       # При переполнении записи отбрасываются (счетчик vpnbot_log_records_dropped_total)
+#     LOG_SAMPLE_RATES=httpx=0.1,aiohttp.access=0.05  # Доля сохраняемых записей ниже WARNING по префиксу логгера
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "httpx=0.1,aiohttp.access=0.1")
+TEXT_LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Поля корреляции (telegram_id, payment_id, marzban_username, ...) текущего апдейта/уведомления.
+# asyncio копирует контекст в создаваемые задачи, поэтому поля видны во всем, что запущено из обработчика.
+_log_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+@contextmanager
+def log_context(**fields):
+    """Добавляет поля корреляции ко всем записям внутри блока (и в порожденных задачах)."""
+    token = _log_context.set({**_log_context.get(), **{key: value for key, value in fields.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def bind_log_context(**fields) -> None:
+    """Дополняет поля корреляции до конца текущего блока log_context (например, когда стал известен telegram_id)."""
+    _log_context.set({**_log_context.get(), **{key: value for key, value in fields.items() if value is not None}})
+
+
+def _parse_sample_rates(value: str) -> dict[str, float]:
+    rates = {}
+    for item in value.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю записей ниже WARNING от шумных логгеров (по префиксу имени)."""
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        # Длинные префиксы проверяются первыми: "aiohttp.access" точнее, чем "aiohttp"
+        self.rates = sorted(rates.items(), key=lambda item: -len(item[0]))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        for prefix, rate in self.rates:
+            if record.name == prefix or record.name.startswith(prefix + "."):
+                return random.random() < rate
+        return True
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    В отличие от стандартного QueueHandler не форматирует запись в потоке event loop:
+    сообщение собирается из msg/args уже в потоке QueueListener. Здесь только запоминаются поля корреляции.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.context = _log_context.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_records_dropped.inc(logger=record.name)
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "service": self.service,
+        }
+        entry.update(getattr(record, "context", None) or {})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextTextFormatter(logging.Formatter):
+    """Прежний текстовый формат; поля корреляции дописываются в конец строки."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        context = getattr(record, "context", None)
+        if context:
+            line += " [" + " ".join(f"{key}={value}" for key, value in context.items()) + "]"
+        return line
+
+
+def configure_logging(service: str) -> None:
+    """Настраивает корневой логгер процесса. Повторный вызов ничего не делает."""
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter(service) if LOG_FORMAT == "json" else ContextTextFormatter(TEXT_LOG_FORMAT))
+
+    queue_handler = ContextQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter(_parse_sample_rates(LOG_SAMPLE_RATES)))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, output)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Дописывает оставшиеся в очереди записи и останавливает фоновый поток."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
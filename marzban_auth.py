@@ -0,0 +1,128 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# За сколько секунд до истечения JWT получать новый токен
+MARZBAN_TOKEN_REFRESH_MARGIN_SEC = int(os.getenv("MARZBAN_TOKEN_REFRESH_MARGIN_SEC", "120"))
+# Время жизни токена, если из него не удалось прочитать exp
+MARZBAN_TOKEN_FALLBACK_TTL_SEC = int(os.getenv("MARZBAN_TOKEN_FALLBACK_TTL_SEC", "3600"))
+# Сколько старт процесса ждет логина в панель; дальше токен получит первый вызов панели
+MARZBAN_TOKEN_WARMUP_TIMEOUT_SEC = float(os.getenv("MARZBAN_TOKEN_WARMUP_TIMEOUT_SEC", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+def decode_jwt_expiry(token) -> float | None:
+    """Возвращает exp (unix time) из JWT без проверки подписи. Токен marzpy — dict с access_token."""
+    access_token = token.get("access_token") if isinstance(token, dict) else token
+    if not isinstance(access_token, str) or access_token.count(".") != 2:
+        return None
+    try:
+        payload_b64 = access_token.split(".")[1]
+        payload_b64 += "=" * (-len(payload_b64) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload_b64)).get("exp")
+        return float(exp) if exp else None
+    except (ValueError, TypeError):
+        return None
+
+
+def is_marzban_auth_error(error: Exception) -> bool:
+    """401 от панели: у aiohttp.ClientResponseError есть status, для прочих ошибок смотрим на текст."""
+    if getattr(error, "status", None) == 401:
+        return True
+    err_msg = str(error).lower()
+    return "401" in err_msg or "unauthorized" in err_msg or "could not validate credentials" in err_msg
+
+
+class MarzbanTokenError(Exception):
+    """Токен Marzban недоступен (панель не отвечает на логин или неверные учетные данные)."""
+
+
+class MarzbanTokenManager:
+    """
+    Токен Marzban API, общий для всех корутин процесса.
+    Обновляется заранее, до истечения JWT; одновременно выполняется не больше одного логина,
+    остальные вызывающие ждут его результат.
+    """
+
+    def __init__(self, login, log_prefix: str = ""):
+        self._login = login # Корутинная функция без аргументов, например lambda: marzban_client.get_token()
+        self._log_prefix = log_prefix
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self.refresh_count = 0
+
+    def _is_fresh(self) -> bool:
+        return self._token is not None and time.time() < self._expires_at - MARZBAN_TOKEN_REFRESH_MARGIN_SEC
+
+    async def get_token(self, force_refresh: bool = False):
+        seen_token = self._token
+        if not force_refresh and self._is_fresh():
+            return seen_token
+
+        async with self._lock:
+            # Пока ждали блокировку, токен мог обновить другой вызывающий
+            if self._token is not seen_token and self._is_fresh():
+                return self._token
+            if not force_refresh and self._is_fresh():
+                return self._token
+            return await self._refresh()
+
+    async def _refresh(self):
+        try:
+            token = await self._login()
+        except Exception as e:
+            logger.error(f"{self._log_prefix}Ошибка при получении токена Marzban: {e}", exc_info=True)
+            token = None
+        if not token or (isinstance(token, dict) and not token.get("access_token")):
+            logger.error(f"{self._log_prefix}Не удалось получить токен Marzban (ответ {token!r}).")
+            self._token, self._expires_at = None, 0.0
+            return None
+
+        self.refresh_count += 1
+        self._token = token
+        self._expires_at = decode_jwt_expiry(token) or (time.time() + MARZBAN_TOKEN_FALLBACK_TTL_SEC)
+        logger.info(f"{self._log_prefix}Токен Marzban успешно получен/обновлен, действует до {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self._expires_at))} UTC.")
+        return token
+
+    async def warm_up(self, timeout_sec: float = MARZBAN_TOKEN_WARMUP_TIMEOUT_SEC) -> bool:
+        """Получает токен при старте, не дольше timeout_sec. Неудача не мешает старту, только логируется."""
+        try:
+            return bool(await asyncio.wait_for(self.get_token(), timeout=timeout_sec))
+        except asyncio.TimeoutError:
+            logger.warning(f"{self._log_prefix}Панель Marzban не ответила на логин за {timeout_sec} с при старте, токен будет получен при первом вызове.")
+            return False
+
+    async def invalidate(self, rejected_token) -> None:
+        """Помечает токен недействительным, если его еще не заменили новым."""
+        async with self._lock:
+            if self._token is rejected_token:
+                self._token, self._expires_at = None, 0.0
+
+    async def call(self, operation):
+        """
+        Выполняет operation(token); при 401 обновляет токен и повторяет вызов один раз.
+        Если токен получить не удалось, возбуждает MarzbanTokenError.
+        """
+        token = await self.get_token()
+        if not token:
+            raise MarzbanTokenError("Не удалось получить токен Marzban")
+        try:
+            return await operation(token)
+        except Exception as e:
+            if not is_marzban_auth_error(e):
+                raise
+            logger.warning(f"{self._log_prefix}Marzban ответил 401, обновляем токен и повторяем запрос.")
+            await self.invalidate(token)
+            token = await self.get_token()
+            if not token:
+                raise MarzbanTokenError("Не удалось обновить токен Marzban") from e
+            return await operation(token)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import psycopg
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+load_dotenv()
+
+MARZBAN_USER_CACHE_TTL_SEC = float(os.getenv("MARZBAN_USER_CACHE_TTL_SEC", "60"))
+MARZBAN_USER_CACHE_MAX_SIZE = int(os.getenv("MARZBAN_USER_CACHE_MAX_SIZE", "10000"))
+# Канал Postgres LISTEN/NOTIFY: вебхук (другой процесс) сообщает боту об измененных пользователях Marzban
+MARZBAN_INVALIDATION_CHANNEL = "marzban_user_invalidate"
+
+logger = logging.getLogger(__name__)
+
+
+class MarzbanUserCache:
+    """
+    Async-кэш ответов marzban_client.get_user по marzban_username.
+    TTL + LRU-вытеснение по размеру; одновременные запросы одного ключа
+    объединяются в один запрос к панели (single-flight).
+    """
+
+    def __init__(self, ttl_sec: float = MARZBAN_USER_CACHE_TTL_SEC, max_size: int = MARZBAN_USER_CACHE_MAX_SIZE):
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, object]] = OrderedDict() # username -> (expires_at_monotonic, user)
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def get(self, username: str, fetch):
+        """Возвращает пользователя из кэша или вызывает fetch() (корутину без аргументов) ровно один раз на ключ."""
+        entry = self._entries.get(username)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry[1]
+
+        in_flight = self._in_flight.get(username)
+        if in_flight:
+            self.coalesced += 1 # Ответ панели будет общим, отдельного запроса нет
+            return await asyncio.shield(in_flight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[username] = future
+        try:
+            user = await fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # Помечаем исключение как полученное, если ожидающих нет
+            raise
+        else:
+            future.set_result(user)
+            # Если ключ инвалидировали во время запроса, не кладем потенциально устаревший ответ
+            if self._in_flight.get(username) is future and user is not None:
+                self._store(username, user)
+            return user
+        finally:
+            if self._in_flight.get(username) is future:
+                del self._in_flight[username]
+
+    def _store(self, username: str, user) -> None:
+        self._entries[username] = (time.monotonic() + self.ttl_sec, user)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, username: str) -> None:
+        if self._entries.pop(username, None) is not None:
+            self.invalidations += 1
+        self._in_flight.pop(username, None) # Запрос в полете завершится, но не попадет в кэш
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+# Общий экземпляр на процесс
+marzban_user_cache = MarzbanUserCache()
+
+
+async def publish_marzban_user_invalidation(session, username: str) -> None:
+    """
+    Ставит NOTIFY в текущую транзакцию сессии: уведомление уйдет слушателям только после commit.
+    Локальный кэш процесса инвалидируется сразу.
+    """
+    marzban_user_cache.invalidate(username)
+    await session.execute(text("SELECT pg_notify(:channel, :username)"), {"channel": MARZBAN_INVALIDATION_CHANNEL, "username": username})
+
+
+async def listen_for_marzban_invalidations(conninfo: str, reconnect_delay_sec: float = 5.0) -> None:
+    """Фоновая задача: слушает канал инвалидации и сбрасывает записи кэша. Переподключается при обрыве."""
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {MARZBAN_INVALIDATION_CHANNEL}")
+                logger.info("Marzban cache: подписка на инвалидации установлена.")
+                async for notify in conn.notifies():
+                    marzban_user_cache.invalidate(notify.payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Marzban cache: ошибка слушателя инвалидаций: {e}. Переподключение через {reconnect_delay_sec} с.")
+            # Пока слушатель не работает, уведомления теряются — сбрасываем кэш целиком
+            marzban_user_cache.clear()
+            await asyncio.sleep(reconnect_delay_sec)
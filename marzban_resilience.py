@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+
+import metrics
+from marzban_auth import MarzbanTokenError
+from metrics import LatencyHistogram
+
+load_dotenv()
+
+# Таймауты по операциям (сек); переопределяются через MARZBAN_TIMEOUT_<OPERATION>_SEC, например MARZBAN_TIMEOUT_GET_USER_SEC
+MARZBAN_DEFAULT_TIMEOUTS_SEC = {
+    "get_user": 5.0,
+    "add_user": 10.0,
+    "modify_user": 10.0,
+    "delete_user": 10.0,
+    "list_users": 30.0,
+}
+MARZBAN_TIMEOUT_DEFAULT_SEC = float(os.getenv("MARZBAN_TIMEOUT_DEFAULT_SEC", "10"))
+MARZBAN_RETRY_ATTEMPTS = int(os.getenv("MARZBAN_RETRY_ATTEMPTS", "3")) # Всего попыток, включая первую
+MARZBAN_RETRY_BASE_DELAY_SEC = float(os.getenv("MARZBAN_RETRY_BASE_DELAY_SEC", "0.2"))
+MARZBAN_RETRY_MAX_DELAY_SEC = float(os.getenv("MARZBAN_RETRY_MAX_DELAY_SEC", "2"))
+MARZBAN_BREAKER_FAILURE_THRESHOLD = int(os.getenv("MARZBAN_BREAKER_FAILURE_THRESHOLD", "5")) # Подряд идущих сбоев до размыкания
+MARZBAN_BREAKER_RESET_SEC = float(os.getenv("MARZBAN_BREAKER_RESET_SEC", "30")) # Через сколько пробовать half-open
+
+# Операции, которые можно повторить после таймаута: повтор не создаст дубликат в панели.
+# add_user повторяем только если запрос точно не дошел до панели (ошибка соединения).
+MARZBAN_IDEMPOTENT_OPERATIONS = {"get_user", "modify_user", "delete_user", "list_users"}
+RETRYABLE_HTTP_STATUSES = {429, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+
+class MarzbanUnavailableError(Exception):
+    """Панель Marzban недоступна: circuit breaker разомкнут."""
+
+
+class CircuitBreaker:
+    """closed -> (N сбоев подряд) -> open -> (через reset_sec) -> half_open -> одна проба -> closed/open."""
+
+    def __init__(self, failure_threshold: int = MARZBAN_BREAKER_FAILURE_THRESHOLD, reset_sec: float = MARZBAN_BREAKER_RESET_SEC, name: str = "marzban"):
+        self.failure_threshold = failure_threshold
+        self.reset_sec = reset_sec
+        self.name = name
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self) -> bool:
+        """Пропускает вызов или возбуждает MarzbanUnavailableError. True — этот вызов и есть проба half-open."""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_sec:
+                raise MarzbanUnavailableError("Marzban недоступен (circuit breaker open)")
+            self.state = "half_open"
+            logger.info(f"Circuit breaker {self.name}: half-open, пробный запрос к панели.")
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise MarzbanUnavailableError("Marzban недоступен (circuit breaker half-open, идет проба)")
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info(f"Circuit breaker {self.name}: панель снова отвечает, closed.")
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.error(f"Circuit breaker {self.name}: open после {self.consecutive_failures} сбоев подряд.")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """Проба завершилась без вывода о здоровье панели: ответ вроде 404 или отмена вызывающего."""
+        self._probe_in_flight = False
+
+
+def is_retryable_marzban_error(operation_name: str, error: Exception) -> bool:
+    if isinstance(error, aiohttp.ClientConnectorError):
+        return True # Соединение не установлено — запрос до панели не дошел
+    if operation_name not in MARZBAN_IDEMPOTENT_OPERATIONS:
+        return False
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ServerDisconnectedError, aiohttp.ClientOSError)):
+        return True
+    return isinstance(error, aiohttp.ClientResponseError) and error.status in RETRYABLE_HTTP_STATUSES
+
+
+def is_marzban_outage_error(error: Exception) -> bool:
+    """Ошибки, которые говорят о проблемах панели, а не о конкретном запросе (404, 409, 422 — не считаются)."""
+    if isinstance(error, MarzbanTokenError):
+        return True # Логин в панель не удался (он выполняется внутри вызова, под тем же таймаутом)
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+class ResilientMarzbanCaller:
+    """
+    Обертка над вызовами Marzban: таймаут на операцию, повторы с jitter для безопасных ошибок,
+    circuit breaker и гистограммы задержек по операциям.
+    """
+
+    def __init__(self, token_manager, name: str = "marzban"):
+        self.token_manager = token_manager
+        self.name = name
+        self.breaker = CircuitBreaker(name=name)
+        self.latency: dict[str, LatencyHistogram] = {}
+        self.errors: dict[str, int] = {}
+
+    def timeout_for(self, operation_name: str) -> float:
+        env_value = os.getenv(f"MARZBAN_TIMEOUT_{operation_name.upper()}_SEC")
+        if env_value:
+            return float(env_value)
+        return MARZBAN_DEFAULT_TIMEOUTS_SEC.get(operation_name, MARZBAN_TIMEOUT_DEFAULT_SEC)
+
+    async def call(self, operation_name: str, operation):
+        """Выполняет operation(token) через менеджер токенов с таймаутом, повторами и breaker."""
+        timeout_sec = self.timeout_for(operation_name)
+        histogram = self.latency.setdefault(operation_name, metrics.marzban_request_duration.child(caller=self.name, operation=operation_name))
+        for attempt in range(1, MARZBAN_RETRY_ATTEMPTS + 1):
+            is_probe = self.breaker.before_call()
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(self.token_manager.call(operation), timeout=timeout_sec)
+            except Exception as e:
+                histogram.observe(time.monotonic() - started)
+                self.errors[operation_name] = self.errors.get(operation_name, 0) + 1
+                metrics.errors.inc(component=f"{self.name}.{operation_name}", cause=type(e).__name__)
+                if is_marzban_outage_error(e):
+                    self.breaker.record_failure()
+                if attempt >= MARZBAN_RETRY_ATTEMPTS or not is_retryable_marzban_error(operation_name, e):
+                    if isinstance(e, MarzbanTokenError):
+                        # Для вызывающих это та же недоступность панели, что и разомкнутый breaker
+                        raise MarzbanUnavailableError(str(e)) from e
+                    raise
+                delay = min(MARZBAN_RETRY_MAX_DELAY_SEC, MARZBAN_RETRY_BASE_DELAY_SEC * (2 ** (attempt - 1)))
+                delay = random.uniform(0, delay) # Full jitter
+                logger.warning(f"Marzban {operation_name}: попытка {attempt} не удалась ({type(e).__name__}: {e}), повтор через {delay:.2f} с.")
+            else:
+                histogram.observe(time.monotonic() - started)
+                self.breaker.record_success()
+                return result
+            finally:
+                # Проба завершена при любом исходе, в том числе при отмене вызывающего (CancelledError):
+                # иначе breaker остался бы в half-open с "идущей" пробой и отклонял бы все вызовы
+                if is_probe:
+                    self.breaker.release_probe()
+            await asyncio.sleep(delay)
+
+    def is_available(self) -> bool:
+        return self.breaker.state != "open" or time.monotonic() - self.breaker.opened_at >= self.breaker.reset_sec
+
+    def snapshot(self) -> dict:
+        return {
+            "breaker": {"state": self.breaker.state, "consecutive_failures": self.breaker.consecutive_failures},
+            "errors": dict(self.errors),
+            "latency": {operation_name: histogram.snapshot() for operation_name, histogram in self.latency.items()},
+        }
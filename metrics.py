@@ -0,0 +1,197 @@
+# Метрики процесса в текстовом формате Prometheus (без внешних зависимостей).
+# Бот и вебхук отдают их на /metrics; у каждого процесса (и каждого воркера gunicorn) свои значения.
+import bisect
+import functools
+import logging
+import time
+
+from aiohttp import web
+
+LATENCY_BUCKETS_SEC = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_PREFIX = "vpnbot_"
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами (в стиле Prometheus)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_SEC):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # Последняя корзина — +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self) -> dict:
+        cumulative, buckets = 0, {}
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += bucket_count
+            buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+        return {"count": self.count, "sum": round(self.total, 4), "buckets": buckets}
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+
+class _Metric:
+    metric_type = ""
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()):
+        self.name = METRICS_PREFIX + name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.children: dict[tuple, object] = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        for key, child in sorted(self.children.items()):
+            lines.extend(self._render_child(dict(zip(self.label_names, key)), child))
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()):
+        super().__init__(f"{name}_total", description, label_names)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.children[key] = self.children.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels) -> None:
+        """Для счетчиков, которые уже ведутся в другом месте (например, статистика пула БД)."""
+        self.children[self._key(labels)] = value
+
+    def _render_child(self, labels, value) -> list[str]:
+        return [f"{self.name}{_format_labels(labels)} {value}"]
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self.children[self._key(labels)] = value
+
+    def _render_child(self, labels, value) -> list[str]:
+        return [f"{self.name}{_format_labels(labels)} {value}"]
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = (), buckets=LATENCY_BUCKETS_SEC):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def child(self, **labels) -> LatencyHistogram:
+        """Гистограмма для набора меток; можно хранить у себя и вызывать observe() напрямую."""
+        key = self._key(labels)
+        histogram = self.children.get(key)
+        if histogram is None:
+            histogram = self.children[key] = LatencyHistogram(self.buckets)
+        return histogram
+
+    def observe(self, value: float, **labels) -> None:
+        self.child(**labels).observe(value)
+
+    def _render_child(self, labels, histogram: LatencyHistogram) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else str(bound)
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': le})} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {histogram.total}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {histogram.count}")
+        return lines
+
+
+_registry: list[_Metric] = []
+_collect_hooks = [] # Вызываются перед выдачей метрик, чтобы обновить gauge из текущего состояния
+
+
+def on_collect(hook) -> None:
+    _collect_hooks.append(hook)
+
+
+def render_metrics() -> str:
+    for hook in _collect_hooks:
+        try:
+            hook()
+        except Exception as e:
+            logger.error(f"Ошибка при сборе метрик в {getattr(hook, '__name__', hook)}: {e}")
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Общие метрики ---
+handler_duration = Histogram("handler_duration_seconds", "Telegram handler latency", ("handler",))
+marzban_request_duration = Histogram("marzban_request_duration_seconds", "Marzban API call latency per attempt", ("caller", "operation"))
+yookassa_request_duration = Histogram("yookassa_request_duration_seconds", "YooKassa API call latency", ("operation",))
+webhook_processing_duration = Histogram("webhook_processing_duration_seconds", "YooKassa notification processing time", ("event", "result"))
+telegram_send_duration = Histogram("telegram_send_duration_seconds", "Outbound Telegram request latency including queueing", ("priority",))
+scheduler_job_duration = Histogram("scheduler_job_duration_seconds", "Scheduled job wall time", ("job",), buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800))
+scheduler_rows = Counter("scheduler_rows", "Rows processed by scheduled jobs", ("job", "outcome"))
+errors = Counter("errors", "Errors by component and cause", ("component", "cause"))
+db_pool = Gauge("db_pool", "Database connection pool state", ("state",))
+db_pool_checkout_wait = Gauge("db_pool_checkout_wait_seconds", "Database pool checkout wait (total, max)", ("stat",))
+db_pool_checkouts = Counter("db_pool_checkouts", "Database pool checkouts (all, slow, timeout)", ("kind",))
+startup_duration = Gauge("startup_duration_seconds", "Bot cold start stages; module_load, ready and first_update are measured from process start", ("stage",))
+log_records_dropped = Counter("log_records_dropped", "Log records dropped because the log queue was full", ("logger",))
+
+
+def observe_handler(handler):
+    """Декоратор для обработчиков Telegram: время выполнения и ошибки по типу исключения."""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception as e:
+            errors.inc(component=handler.__name__, cause=type(e).__name__)
+            raise
+        finally:
+            handler_duration.observe(time.monotonic() - started, handler=handler.__name__)
+    return wrapper
+
+
+def observe_job(job_name: str, summary: dict | None, wall_time_sec: float, outcomes=()) -> None:
+    """Длительность запуска фоновой задачи и число строк по исходам из ее сводки."""
+    scheduler_job_duration.observe(wall_time_sec, job=job_name)
+    for outcome in outcomes:
+        if summary and summary.get(outcome):
+            scheduler_rows.inc(summary[outcome], job=job_name, outcome=outcome)
+
+
+async def metrics_route(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Отдельный HTTP-сервер с /metrics (для процессов без своего веб-приложения, например бота в режиме polling)."""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_route)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,214 @@
+# Версионированные миграции схемы.
+# create_all создает только отсутствующие таблицы и не трогает существующие,
+# поэтому изменения существующих таблиц (индексы и т.п.) оформляются здесь.
+# Примененные версии хранятся в таблице schema_migrations.
+#
+# Запуск:
+#     python migrations.py            # создать недостающие таблицы и применить миграции (шаг деплоя при BOT_SCHEMA_CHECK=skip)
+#     python migrations.py --check    # показать непримененные миграции и отсутствующие индексы
+#     python migrations.py --explain  # планы горячих запросов (проверка, что используются индексы)
+import argparse
+import asyncio
+import logging
+import sys
+
+from sqlalchemy import text
+
+from database import async_engine, create_db_tables
+
+logger = logging.getLogger(__name__)
+
+# (версия, описание, SQL-операторы). CREATE INDEX CONCURRENTLY не блокирует запись в таблицу,
+# но не может выполняться в транзакции — поэтому миграции применяются в режиме AUTOCOMMIT.
+MIGRATIONS = [
+    (
+        1,
+        "Composite and partial indexes for hot VpnKey/Payment queries",
+        [
+            # Проверка истекших подписок: WHERE is_active AND expires_at <= now (+ id для постраничного обхода)
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_vpn_keys_active_expires_at ON vpn_keys (expires_at, id) WHERE is_active",
+            # Проверка использованного триала: WHERE user_id = ? AND is_trial
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_vpn_keys_user_id_is_trial ON vpn_keys (user_id, is_trial)",
+            # Активные платные подписки пользователя / "Моя подписка"
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_vpn_keys_user_active_trial_expires ON vpn_keys (user_id, is_active, is_trial, expires_at)",
+            # Платежи по статусу (pending и т.п.), по возрасту
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_payments_status_created_at ON payments (status, created_at)",
+        ],
+    ),
+    (
+        2,
+        "Payment processing lease (claimed_until, claim_token)",
+        [
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS claim_token VARCHAR(32)",
+        ],
+    ),
+    (
+        3,
+        "Reusable payment links (confirmation_url, confirmation_expires_at, purchase_key)",
+        [
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS confirmation_url VARCHAR",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS confirmation_expires_at TIMESTAMP",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS purchase_key VARCHAR(200)",
+            # Живая ссылка на оплату: WHERE user_id = ? AND purchase_key = ? AND status = 'pending' AND confirmation_expires_at > now
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_payments_user_purchase_pending ON payments (user_id, purchase_key, confirmation_expires_at) WHERE status = 'pending'",
+        ],
+    ),
+    (
+        4,
+        "One trial subscription per user (partial unique index)",
+        [
+            # Гарантия на уровне БД, даже если advisory lock потока не дождался (lock_timeout).
+            # Если в базе уже есть пользователи с несколькими триалами, индекс не построится — их нужно разобрать
+            # вручную (SELECT user_id FROM vpn_keys WHERE is_trial GROUP BY user_id HAVING count(*) > 1) и повторить
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_vpn_keys_user_trial ON vpn_keys (user_id) WHERE is_trial",
+        ],
+    ),
+]
+
+# Индексы, которые должны существовать после всех миграций (для --check)
+EXPECTED_INDEXES = {
+    "vpn_keys": ["ix_vpn_keys_active_expires_at", "ix_vpn_keys_user_id_is_trial", "ix_vpn_keys_user_active_trial_expires", "uq_vpn_keys_user_trial"],
+    "payments": ["ix_payments_status_created_at", "ix_payments_user_purchase_pending"],
+}
+
+# Горячие запросы для --explain: (описание, SQL, индекс, который должен использоваться)
+HOT_QUERIES = [
+    (
+        "expiry sweep",
+        "SELECT * FROM vpn_keys WHERE is_active AND expires_at <= now() ORDER BY expires_at, id LIMIT 500",
+        "ix_vpn_keys_active_expires_at",
+    ),
+    (
+        "trial lookup",
+        "SELECT id FROM vpn_keys WHERE user_id = 1 AND is_trial LIMIT 1",
+        "uq_vpn_keys_user_trial", # Частичный уникальный индекс уже и точнее (user_id, is_trial)
+    ),
+    (
+        "active paid subscription lookup",
+        "SELECT id FROM vpn_keys WHERE user_id = 1 AND is_active AND NOT is_trial AND expires_at > now() LIMIT 1",
+        "ix_vpn_keys_user_active_trial_expires",
+    ),
+    (
+        "payments by status",
+        "SELECT id FROM payments WHERE status = 'pending' AND created_at < now() - interval '10 minutes' LIMIT 500",
+        "ix_payments_status_created_at",
+    ),
+    (
+        "live payment link lookup",
+        "SELECT confirmation_url FROM payments WHERE user_id = 1 AND purchase_key = 'extend_x_1_30' AND status = 'pending' AND confirmation_expires_at > now() ORDER BY confirmation_expires_at DESC LIMIT 1",
+        "ix_payments_user_purchase_pending",
+    ),
+]
+
+
+async def _ensure_migrations_table(conn) -> None:
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, description VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc'))"
+    ))
+
+
+async def _applied_versions(conn) -> set[int]:
+    return set((await conn.execute(text("SELECT version FROM schema_migrations"))).scalars().all())
+
+
+async def apply_migrations() -> list[int]:
+    """
+    Применяет непримененные миграции по порядку. Возвращает список примененных версий.
+    Одновременно стартующие реплики бота и воркеры вебхука применяют миграции по очереди: session-level
+    advisory lock на соединении (транзакционный не подходит — AUTOCOMMIT), примененные версии читаются
+    уже под ним, поэтому вторая реплика не повторяет чужую миграцию.
+    """
+    applied_now = []
+    async with async_engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("SELECT pg_advisory_lock(hashtextextended('schema_migrations', 0))"))
+        try:
+            await _ensure_migrations_table(conn)
+            applied = await _applied_versions(conn)
+            for version, description, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info(f"Миграция {version}: {description}")
+                for statement in statements:
+                    await conn.execute(text(statement))
+                await conn.execute(
+                    text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                    {"version": version, "description": description},
+                )
+                applied_now.append(version)
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(hashtextextended('schema_migrations', 0))"))
+    if applied_now:
+        logger.info(f"Применены миграции: {applied_now}")
+    return applied_now
+
+
+async def check_schema() -> dict:
+    """Возвращает непримененные миграции и отсутствующие (или невалидные после сбоя CONCURRENTLY) индексы."""
+    async with async_engine.connect() as conn:
+        await _ensure_migrations_table(conn)
+        applied = await _applied_versions(conn)
+        rows = (await conn.execute(text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indisvalid"
+        ))).scalars().all()
+        await conn.commit()
+    existing = set(rows)
+    return {
+        "pending_migrations": [version for version, _, _ in MIGRATIONS if version not in applied],
+        "missing_indexes": [name for names in EXPECTED_INDEXES.values() for name in names if name not in existing],
+    }
+
+
+async def explain_hot_queries(conn=None) -> list[dict]:
+    """
+    EXPLAIN для горячих запросов: какой индекс выбрал планировщик и совпадает ли он с ожидаемым.
+    conn — соединение с открытой транзакцией (тесты наполняют в ней таблицы и откатывают); по умолчанию свое.
+    """
+    if conn is None:
+        async with async_engine.connect() as own_conn:
+            try:
+                return await explain_hot_queries(own_conn)
+            finally:
+                await own_conn.rollback()
+
+    results = []
+    # На маленьких таблицах планировщик предпочтет Seq Scan — отключаем его, чтобы проверить пригодность индексов
+    await conn.execute(text("SET LOCAL enable_seqscan = off"))
+    for description, sql, expected_index in HOT_QUERIES:
+        plan = "\n".join((await conn.execute(text(f"EXPLAIN {sql}"))).scalars().all())
+        results.append({"query": description, "expected_index": expected_index, "uses_expected_index": expected_index in plan, "plan": plan})
+    return results
+
+
+async def _main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Миграции схемы БД")
+    parser.add_argument("--check", action="store_true", help="Только проверить схему, ничего не менять")
+    parser.add_argument("--explain", action="store_true", help="Показать планы горячих запросов")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.check:
+            report = await check_schema()
+            print(f"Непримененные миграции: {report['pending_migrations'] or 'нет'}")
+            print(f"Отсутствующие индексы: {report['missing_indexes'] or 'нет'}")
+            return 1 if report["pending_migrations"] or report["missing_indexes"] else 0
+        if args.explain:
+            ok = True
+            for result in await explain_hot_queries():
+                status = "OK" if result["uses_expected_index"] else "НЕ ИСПОЛЬЗУЕТ ИНДЕКС"
+                print(f"[{status}] {result['query']} (ожидается {result['expected_index']})\n{result['plan']}\n")
+                ok = ok and result["uses_expected_index"]
+            return 0 if ok else 1
+        await create_db_tables()
+        applied = await apply_migrations()
+        print(f"Применены миграции: {applied}" if applied else "Схема актуальна.")
+        return 0
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    sys.exit(asyncio.run(_main()))
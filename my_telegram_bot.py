@@ -1,11 +1,17 @@
 import logging
 import os
+import time
+BOT_PROCESS_STARTED_AT = time.monotonic() # Для замера холодного старта (до импортов)
+from typing import TYPE_CHECKING
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
+from telegram.error import BadRequest
+from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler, TypeHandler
 # REMOVE: from outline_vpn.outline_vpn import OutlineVPN
 from dotenv import load_dotenv
 from sqlalchemy.future import select
-from sqlalchemy import and_ # and_ может еще понадобиться
+from sqlalchemy import and_, any_, column, tuple_, update, values as sa_values, Integer, DateTime # and_ может еще понадобиться
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
 import asyncio
 import uuid
@@ -14,20 +20,31 @@ import json
 # REMOVE: import httpx # marzpy использует aiohttp
 
 # --- Импорты ---
-from database import User as DbUser, VpnKey, Payment, create_db_tables, get_async_session # Renamed User to DbUser to avoid conflict
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from yookassa import Configuration as YooKassaConfiguration
-from yookassa import Payment as YooKassaPaymentObject
-from yookassa.domain.request.payment_request_builder import PaymentRequestBuilder
-from yookassa.domain.models.receipt import Receipt, ReceiptItem
+from database import User as DbUser, VpnKey, Payment, JobCheckpoint, create_db_tables, get_async_session, get_pool_stats, warm_up_pool, PSYCOPG_CONNINFO # Renamed User to DbUser to avoid conflict
+from migrations import apply_migrations, check_schema
+from user_resolver import upsert_user, resolve_user_id, get_user_cache_stats
+from marzban_cache import marzban_user_cache, listen_for_marzban_invalidations
+from marzban_auth import MarzbanTokenManager
+from marzban_resilience import ResilientMarzbanCaller, MarzbanUnavailableError
+from yookassa_client import yookassa_client
+from telegram_dispatcher import PriorityRateLimiter
+from expiry_reminders import send_expiry_reminders
+from bot_runner import BOT_MODE, PerUserUpdateProcessor, run_webhook
+from user_flights import user_advisory_lock
+import metrics
+from log_config import configure_logging, bind_log_context
+from profiling import maybe_profile, PROFILE_JOB_SAMPLE_RATE
 
 # +++ Marzban Imports +++
-from marzpy import Marzban
-from marzpy.api.user import User as MarzbanUser # Alias для класса пользователя Marzban
+# marzpy и apscheduler импортируются там, где используются: на холодный старт они не нужны
+if TYPE_CHECKING:
+    from marzpy import Marzban
 
 # --- Загрузка настроек ---
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Адрес Bot API (локальный telegram-bot-api сервер или заглушка fakes/fake_telegram.py)
+TELEGRAM_BOT_API_URL = os.getenv("TELEGRAM_BOT_API_URL", "https://api.telegram.org/bot")
 
 # REMOVE: API_URL = os.getenv("API_URL")
 # REMOVE: CERT_SHA256 = os.getenv("CERT_SHA256")
@@ -45,10 +62,24 @@ YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
 YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
 BASE_PRICE_PER_MONTH = Decimal(os.getenv("BASE_PRICE_PER_MONTH", "160.00"))
 FREE_TRIAL_DAYS = int(os.getenv("FREE_TRIAL_DAYS", "30")) # Оставляем, но теперь это для Marzban
-
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+PAYMENT_LINK_TTL_MIN = int(os.getenv("PAYMENT_LINK_TTL_MIN", "30")) # Сколько минут повторно выдаем ту же ссылку на оплату
+
+# +++ Scheduler Settings +++
+EXPIRY_SWEEP_CONCURRENCY = int(os.getenv("EXPIRY_SWEEP_CONCURRENCY", "10")) # Одновременных запросов к Marzban при проверке истекших
+EXPIRY_SWEEP_BATCH_SIZE = int(os.getenv("EXPIRY_SWEEP_BATCH_SIZE", "100")) # Размер пакета изменений между commit
+# "per_user" — get_user на каждую подписку; "snapshot" — один постраничный снимок всех пользователей панели за запуск
+EXPIRY_SWEEP_MODE = os.getenv("EXPIRY_SWEEP_MODE", "per_user")
+MARZBAN_SNAPSHOT_PAGE_SIZE = int(os.getenv("MARZBAN_SNAPSHOT_PAGE_SIZE", "500"))
+# Отдельный HTTP-сервер с /metrics (в режиме webhook метрики есть и на сервере апдейтов); 0 — выключен
+BOT_METRICS_HOST = os.getenv("BOT_METRICS_HOST", "0.0.0.0")
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9100"))
+# Проверка схемы при старте: "startup" — create_all и миграции до начала приема апдейтов,
+# "background" — в фоне после старта, если все миграции уже применены (иначе как "startup": код бота рассчитывает
+# на колонки из миграций), "skip" — не проверять (схему обновляет шаг деплоя: python migrations.py)
+BOT_SCHEMA_CHECK = os.getenv("BOT_SCHEMA_CHECK", "startup")
+BOT_WARMUP_DB_CONNECTIONS = int(os.getenv("BOT_WARMUP_DB_CONNECTIONS", "2")) # Соединений пула, открываемых при старте
+
+configure_logging("bot") # JSON-логи через очередь и фоновый поток (см. log_config.py)
 logger = logging.getLogger(__name__)
 
 # --- Инициализация клиентов ---
@@ -66,14 +97,14 @@ logger = logging.getLogger(__name__)
 # REMOVE:     logger.info("Amnezia API URL не найден в .env.")
 
 # +++ Marzban Client +++
-marzban_client: Marzban | None = None
-marzban_api_token: str | None = None # Токен будем получать и обновлять при необходимости
+marzban_client: "Marzban | None" = None
 
 async def initialize_marzban_client():
     global marzban_client
     if MARZBAN_PANEL_URL and MARZBAN_USERNAME and MARZBAN_PASSWORD:
         try:
-            marzban_client = Marzban(username=MARZBAN_USERNAME, password=MARZBAN_PASSWORD, base_url=MARZBAN_PANEL_URL)
+            from marzpy import Marzban
+            marzban_client = Marzban(MARZBAN_USERNAME, MARZBAN_PASSWORD, MARZBAN_PANEL_URL) # username, password, panel_address
             logger.info("Клиент Marzban инициализирован. URL: %s", MARZBAN_PANEL_URL)
             # Первоначальное получение токена может быть здесь или отложено до первого вызова API
         except Exception as e:
@@ -82,37 +113,22 @@ async def initialize_marzban_client():
     else:
         logger.error("Не заданы MARZBAN_PANEL_URL, MARZBAN_USERNAME или MARZBAN_PASSWORD в .env. Клиент Marzban не будет работать.")
 
-# Функция для получения/обновления токена Marzban
-async def get_marzban_api_token(force_refresh: bool = False) -> str | None:
-    global marzban_api_token
-    if not marzban_client:
-        logger.error("Клиент Marzban не инициализирован.")
-        return None
+# Токен Marzban: общий для всех корутин, обновляется до истечения JWT, логин выполняется один раз на всех
+marzban_tokens = MarzbanTokenManager(lambda: marzban_client.get_token())
+# Все вызовы панели идут через таймауты, повторы и circuit breaker
+marzban_api = ResilientMarzbanCaller(marzban_tokens)
+# Общая очередь исходящих сообщений Telegram (лимиты Bot API, приоритеты, retry_after)
+telegram_dispatcher = PriorityRateLimiter()
 
-    if marzban_api_token and not force_refresh:
-        # TODO: Добавить проверку времени жизни токена, если это возможно с marzpy
-        # Пока что, если токен есть и не просят обновить принудительно, возвращаем его.
-        return marzban_api_token
-
-    try:
-        token = await marzban_client.get_token()
-        if token:
-            marzban_api_token = token
-            logger.info("Токен Marzban успешно получен/обновлен.")
-            return marzban_api_token
-        else:
-            logger.error("Не удалось получить токен Marzban (ответ None).")
-            marzban_api_token = None
-            return None
-    except Exception as e:
-        logger.error(f"Ошибка при получении токена Marzban: {e}", exc_info=True)
-        marzban_api_token = None
-        return None
+async def get_marzban_user_cached(marzban_username: str):
+    """get_user через TTL-кэш (для отображения); планировщик и вебхук читают панель напрямую."""
+    return await marzban_user_cache.get(
+        marzban_username,
+        lambda: marzban_api.call("get_user", lambda token: marzban_client.get_user(user_username=marzban_username, token=token))
+    )
 
 
-if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
-    YooKassaConfiguration.account_id = YOOKASSA_SHOP_ID
-    YooKassaConfiguration.secret_key = YOOKASSA_SECRET_KEY
+if yookassa_client.is_configured:
     logger.info("Конфигурация ЮKassa установлена.")
 
 # --- Определение кнопок меню и клавиатур ---
@@ -136,21 +152,17 @@ main_menu_keyboard = [
 REPLY_MARKUP_MAIN_MENU = ReplyKeyboardMarkup(main_menu_keyboard, resize_keyboard=True)
 
 # --- ОБРАБОТЧИКИ КОМАНД ---
+@metrics.observe_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_tg = update.effective_user
     logger.info(f"User {user_tg.first_name} ({user_tg.id}) started.")
     async for session in get_async_session():
-        # Используем DbUser для обращения к нашей модели User
-        stmt = select(User).where(User.telegram_id == user_tg.id)
-        db_user_obj = (await session.execute(stmt)).scalar_one_or_none() # переименовал переменную во избежание путаницы
-        if not db_user_obj:
-            db_user_obj = DbUser(telegram_id=user_tg.id, username=user_tg.username, first_name=user_tg.first_name)
-            session.add(db_user_obj)
-            await session.commit()
-            await session.refresh(db_user_obj) # Обновляем для получения default значений, если есть
+        # Один INSERT ... ON CONFLICT: создает пользователя или обновляет username/first_name
+        await upsert_user(session, user_tg)
     
     await update.message.reply_html(f"Привет, {user_tg.mention_html()}! 👋\n\nЯ помогу вам получить доступ к быстрому и безопасному VPN.", reply_markup=REPLY_MARKUP_MAIN_MENU)
 
+@metrics.observe_handler
 async def get_key_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обрабатывает запрос на получение/продление доступа.
@@ -178,27 +190,24 @@ async def initiate_key_or_payment_flow(update: Update, context: ContextTypes.DEF
         return
 
     async for session in get_async_session():
-        db_user_obj = (await session.execute(select(DbUser).where(DbUser.telegram_id == user_tg.id))).scalar_one()
-        
+        user_db_id = await resolve_user_id(session, user_tg)
+        # Повторное нажатие (в том числе на другой реплике) ждет до commit: не выдает второй триал и не создает второй платеж
+        await user_advisory_lock(session, user_tg.id)
+
         # Проверка на существующий триальный ключ/подписку
         stmt_trial_key = select(VpnKey).where(
-            VpnKey.user_id == db_user_obj.id,
+            VpnKey.user_id == user_db_id,
             VpnKey.is_trial == True,
         )
         trial_key_exists = (await session.execute(stmt_trial_key)).scalars().first()
 
         if trial_key_exists:
-            logger.info(f"User {user_tg.id} ({db_user_obj.username}) уже использовал пробный период. Переход к оплате.")
+            logger.info(f"User {user_tg.id} ({user_tg.username}) уже использовал пробный период. Переход к оплате.")
             await context.bot.send_message(chat_id, "Вы уже использовали пробный период. Для получения доступа необходимо оплатить.")
             # Передаем None для marzban_username_to_extend, так как это может быть новая подписка или продление существующей платной
-            await initiate_yookassa_payment(update, context, months=1, duration_days=30)
+            await initiate_yookassa_payment(update, context, session, user_db_id, months=1, duration_days=30)
         else:
-            logger.info(f"User {user_tg.id} ({db_user_obj.username}) получает пробный доступ Marzban.")
-
-            marzban_api_token_val = await get_marzban_api_token()
-            if not marzban_api_token_val:
-                await context.bot.send_message(chat_id, "Не удалось связаться с VPN сервисом для выдачи пробного доступа. (Ошибка токена Marzban)")
-                return
+            logger.info(f"User {user_tg.id} ({user_tg.username}) получает пробный доступ Marzban.")
 
             try:
                 # Генерация имени пользователя для Marzban
@@ -213,6 +222,7 @@ async def initiate_key_or_payment_flow(update: Update, context: ContextTypes.DEF
                 # Объем данных для триала (в байтах)
                 trial_data_limit_bytes = MARZBAN_DEFAULT_DATA_LIMIT_GB_TRIAL * (1024**3)
 
+                from marzpy.api.user import User as MarzbanUser # Alias для класса пользователя Marzban
                 new_marzban_user_config = MarzbanUser(
                     username=marzban_trial_username,
                     proxies={}, # Оставить пустым для использования настроек по умолчанию из Marzban User Template
@@ -228,7 +238,9 @@ async def initiate_key_or_payment_flow(update: Update, context: ContextTypes.DEF
                 # Судя по README marzpy, он использует aiohttp, так что его методы уже async.
                 # Однако, если есть сомнения или сложные вычисления внутри marzpy, to_thread безопаснее.
                 # Для простоты, предполагаем, что marzpy.add_user() корректно асинхронен.
-                created_marzban_user = await marzban_client.add_user(user=new_marzban_user_config, token=marzban_api_token_val)
+                created_marzban_user = await marzban_api.call("add_user",
+                    lambda token: marzban_client.add_user(user=new_marzban_user_config, token=token)
+                )
 
                 if not created_marzban_user or not created_marzban_user.subscription_url:
                     logger.error(f"Не удалось создать пользователя Marzban или отсутствует subscription_url для {marzban_trial_username}.")
@@ -238,14 +250,23 @@ async def initiate_key_or_payment_flow(update: Update, context: ContextTypes.DEF
                 new_db_vpn_key = VpnKey(
                     marzban_username=marzban_trial_username,
                     subscription_url=created_marzban_user.subscription_url,
-                    name=f"Пробная подписка Marzban для {db_user_obj.username or user_tg.id}",
-                    user_id=db_user_obj.id,
+                    name=f"Пробная подписка Marzban для {user_tg.username or user_tg.id}",
+                    user_id=user_db_id,
                     expires_at=trial_expires_dt,
                     is_active=True,
                     is_trial=True
                 )
                 session.add(new_db_vpn_key)
-                await session.commit()
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    # Триал уже выдан параллельным нажатием, которое advisory lock не удержал (uq_vpn_keys_user_trial):
+                    # удаляем только что созданного пользователя панели, второй триал не выдаем
+                    await session.rollback()
+                    logger.warning(f"User {user_tg.id}: второй пробный доступ отклонен уникальным индексом, удаляем {marzban_trial_username} в Marzban.")
+                    await marzban_api.call("delete_user", lambda token: marzban_client.delete_user(user_username=marzban_trial_username, token=token))
+                    await context.bot.send_message(chat_id, "Вы уже использовали пробный период.")
+                    return
                 await session.refresh(new_db_vpn_key)
 
                 expires_str = trial_expires_dt.strftime('%d.%m.%Y в %H:%M')
@@ -258,70 +279,111 @@ async def initiate_key_or_payment_flow(update: Update, context: ContextTypes.DEF
                 )
                 await context.bot.send_message(chat_id, msg_text, parse_mode='Markdown')
 
+            except MarzbanUnavailableError:
+                await context.bot.send_message(chat_id, "VPN сервис временно недоступен. Пожалуйста, попробуйте позже.")
             except Exception as e:
                 # Здесь можно добавить retry логику или более специфичную обработку ошибок Marzban
                 # Например, если пользователь с таким marzban_username уже существует (маловероятно с uuid)
                 logger.error(f"Ошибка при создании пробного пользователя Marzban для user_tg_id {user_tg.id}: {e}", exc_info=True)
-                # Попытка получить токен заново, если ошибка связана с токеном
-                if "token" in str(e).lower(): # Очень грубая проверка
-                    marzban_api_token_val = await get_marzban_api_token(force_refresh=True)
-                    if marzban_api_token_val:
-                        await context.bot.send_message(chat_id, "Произошла временная ошибка связи с VPN сервисом. Пожалуйста, попробуйте еще раз.")
-                        return
-
-                await context.bot.send_message(chat_id, "Произошла ошибка при создании пробного доступа. Свяжитесь с поддержкой.")
-
-async def my_keys_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-                    expires_at = datetime.utcnow() + timedelta(days=FREE_TRIAL_DAYS)
-
-                    new_db_key = VpnKey(
-                        key_uuid_on_server=str(new_key_obj.key_id),
-                        access_url=new_key_obj.access_url,
-                        name=f"tg_user_{db_user.id}_trial_outline",
-                        protocol=PROTOCOL_CALLBACK_OUTLINE,
-                        user_id=db_user.id,
-                        expires_at=expires_at,
-                        is_active=True,
-                        is_trial=True # Explicitly set trial flag
-                    )
-                    session.add(new_db_key)
-                    await session.commit()
-
-                    expires_str = expires_at.strftime('%d.%m.%Y в %H:%M')
-                    msg_text = (
-                        f"✅ Ваш бесплатный ключ Outline VPN готов!\n\n"
-                        f"🔑 Ключ доступа:\n`{new_key_obj.access_url}`\n\n"
-                        f"Он будет действителен до: *{expires_str} UTC*."
-                    )
-                    await context.bot.send_message(chat_id, msg_text, parse_mode='Markdown')
-                except Exception as e:
-                    logger.error(f"Error creating a free Outline key for user {user_tg.id}: {e}")
-                    if marzban_api_token_val:
-                        await context.bot.send_message(chat_id, "Произошла временная ошибка связи с VPN сервисом. Пожалуйста, попробуйте еще раз.")
-                        return
-
+                # Ошибки 401 уже повторены менеджером токенов, сюда доходят только прочие ошибки
                 await context.bot.send_message(chat_id, "Произошла ошибка при создании пробного доступа. Свяжитесь с поддержкой.")
 
+MY_KEYS_PAGE_CALLBACK_PREFIX = "my_keys_page_"
+
+# Статус пользователя в Marzban
+MARZBAN_STATUS_TRANSLATION = {
+    "active": "Активна ✅",
+    "disabled": "Отключена (администратором) 🚫",
+    "expired": "Истекла (по времени) ⏳",
+    "limited": "Истекла (по трафику) 📈"
+}
+
+def sync_subscription_with_marzban(db_sub: VpnKey, marzban_user_info, now: datetime) -> None:
+    """Приводит локальные expires_at/is_active в соответствие с данными Marzban (без commit)."""
+    expires_at_dt = datetime.fromtimestamp(marzban_user_info.expire) if marzban_user_info.expire else None
+    is_expired_on_marzban = bool(expires_at_dt and expires_at_dt < now)
+
+    # Обновляем локальный expires_at и is_active, если есть расхождения и подписка на сервере активна
+    # Это важно, если expires_at в Marzban был изменен вручную или другим процессом
+    if expires_at_dt and db_sub.expires_at != expires_at_dt and marzban_user_info.status == "active":
+        db_sub.expires_at = expires_at_dt
+        logger.info(f"Обновлена дата истечения для локальной подписки ID {db_sub.id} на {expires_at_dt} из Marzban.")
+
+    if marzban_user_info.status != "active" and db_sub.is_active:
+        db_sub.is_active = False # Если в Marzban не активна, то и у нас не активна
+        logger.info(f"Подписка ID {db_sub.id} помечена неактивной, т.к. статус в Marzban: {marzban_user_info.status}")
+    elif marzban_user_info.status == "active" and not db_sub.is_active and (not expires_at_dt or expires_at_dt > now) :
+        # Если в Marzban активна, а у нас нет (и не истекла), активируем
+        db_sub.is_active = True
+        logger.info(f"Подписка ID {db_sub.id} помечена активной, т.к. статус в Marzban: {marzban_user_info.status} и не истекла.")
+
+    # Если подписка в Marzban истекла по времени или трафику, но у нас еще активна
+    if (is_expired_on_marzban or marzban_user_info.status in ["expired", "limited"]) and db_sub.is_active:
+        db_sub.is_active = False
+        logger.info(f"Подписка ID {db_sub.id} помечена неактивной из-за статуса/истечения в Marzban ({marzban_user_info.status}, истекла: {is_expired_on_marzban}).")
+
+def format_subscription_page(db_sub: VpnKey, marzban_user_info) -> dict:
+    """Готовит страницу сообщения "Моя подписка" для одной подписки."""
+    # Форматирование данных о трафике
+    used_traffic_gb = round(marzban_user_info.used_traffic / (1024**3), 2)
+    data_limit_gb_str = "Безлимитно"
+    if marzban_user_info.data_limit > 0:
+        data_limit_gb_str = f"{round(marzban_user_info.data_limit / (1024**3), 2)} ГБ"
+
+    # Дата истечения
+    expires_at_dt = datetime.fromtimestamp(marzban_user_info.expire) if marzban_user_info.expire else None
+    expires_str = expires_at_dt.strftime('%d.%m.%Y в %H:%M UTC') if expires_at_dt else "Никогда"
+    marzban_status_str = MARZBAN_STATUS_TRANSLATION.get(marzban_user_info.status, marzban_user_info.status)
+
+    text = (
+        f"🔗 **Ссылка-подписка:**\n`{db_sub.subscription_url}`\n\n"
+        f"👤 Имя пользователя (Marzban): `{db_sub.marzban_username}`\n"
+        f"📊 Трафик: Использовано {used_traffic_gb} ГБ из {data_limit_gb_str}\n"
+        f"🗓️ Действительна до: *{expires_str}*\n"
+        f"🚦 Статус на сервере: *{marzban_status_str}*\n"
+        f"{'🔑 (Пробная)' if db_sub.is_trial else '💳 (Платная)'}"
+    )
+    # Кнопка продления только если подписка не "disabled" администратором
+    extend_sub_id = db_sub.id if marzban_user_info.status != "disabled" else None
+    return {"text": text, "extend_sub_id": extend_sub_id}
+
+def render_my_keys_page(pages: list[dict], index: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Возвращает текст и клавиатуру (продление + навигация ◀️/▶️) для страницы index."""
+    index = max(0, min(index, len(pages) - 1))
+    page = pages[index]
+    keyboard_buttons = []
+    if page["extend_sub_id"] is not None:
+        keyboard_buttons.append([InlineKeyboardButton("Продлить на 1 месяц", callback_data=f"extend_sub_{page['extend_sub_id']}")])
+    if len(pages) > 1:
+        nav_row = []
+        if index > 0:
+            nav_row.append(InlineKeyboardButton("◀️", callback_data=f"{MY_KEYS_PAGE_CALLBACK_PREFIX}{index - 1}"))
+        nav_row.append(InlineKeyboardButton(f"{index + 1}/{len(pages)}", callback_data=f"{MY_KEYS_PAGE_CALLBACK_PREFIX}{index}"))
+        if index < len(pages) - 1:
+            nav_row.append(InlineKeyboardButton("▶️", callback_data=f"{MY_KEYS_PAGE_CALLBACK_PREFIX}{index + 1}"))
+        keyboard_buttons.append(nav_row)
+    return page["text"], InlineKeyboardMarkup(keyboard_buttons) if keyboard_buttons else None
+
+@metrics.observe_handler
 async def my_keys_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Показывает активные подписки пользователя Marzban и кнопки для продления.
+    Показывает активные подписки пользователя Marzban одним сообщением с постраничной навигацией.
+    Запросы к Marzban выполняются параллельно, локальные исправления фиксируются одним commit.
     """
     user_tg = update.effective_user
-    chat_id = update.effective_chat.id
     now = datetime.utcnow()
-    subscriptions_found = False
 
     if not marzban_client:
         await update.message.reply_text("VPN сервис временно недоступен. (Клиент Marzban не инициализирован)")
         return
 
     async for session in get_async_session():
-        db_user_obj = (await session.execute(select(DbUser).where(DbUser.telegram_id == user_tg.id))).scalar_one()
+        user_db_id = await resolve_user_id(session, user_tg)
 
         # Выбираем все активные (is_active=True) подписки пользователя из нашей БД
         # Дополнительно можно фильтровать по VpnKey.expires_at > now, но Marzban API даст точный статус
         stmt = select(VpnKey).where(
-            VpnKey.user_id == db_user_obj.id,
+            VpnKey.user_id == user_db_id,
             VpnKey.is_active == True
         ).order_by(VpnKey.expires_at.desc()) # Сначала более свежие
 
@@ -331,113 +393,78 @@ async def my_keys_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text("У вас нет активных VPN подписок.\nНажмите '🔑 Получить/Продлить доступ', чтобы оформить.")
             return
 
-        marzban_api_token_val = await get_marzban_api_token()
-        if not marzban_api_token_val:
-            await update.message.reply_text("Не удалось связаться с VPN сервисом для получения информации о подписках. (Ошибка токена Marzban)")
+        # Токен получает marzban_api.call; без токена запросы завершатся MarzbanUnavailableError
+        marzban_results = await asyncio.gather(
+            *(get_marzban_user_cached(db_sub.marzban_username) for db_sub in active_subscriptions_db),
+            return_exceptions=True
+        )
+
+        if all(isinstance(result, MarzbanUnavailableError) for result in marzban_results):
+            await update.message.reply_text("VPN сервис временно недоступен. Пожалуйста, попробуйте позже.")
             return
 
-        for db_sub in active_subscriptions_db:
-            try:
-                marzban_user_info = await marzban_client.get_user(username=db_sub.marzban_username, token=marzban_api_token_val)
-
-                if not marzban_user_info:
-                    logger.warning(f"Пользователь Marzban {db_sub.marzban_username} не найден в панели для sub ID {db_sub.id}. Возможно, был удален вручную.")
-                    # Можно пометить такую подписку как неактивную в нашей БД
-                    # db_sub.is_active = False
-                    # await session.commit()
-                    # await update.message.reply_text(f"Подписка (внутр. ID: {db_sub.id}) не найдена на VPN сервере. Обратитесь в поддержку.")
-                    # Пока просто пропустим ее отображение или покажем как неактивную
-                    await update.message.reply_text(
+        pages = []
+        for db_sub, marzban_user_info in zip(active_subscriptions_db, marzban_results):
+            if isinstance(marzban_user_info, Exception):
+                if not isinstance(marzban_user_info, MarzbanUnavailableError):
+                    logger.error(f"Ошибка при получении информации о подписке Marzban {db_sub.marzban_username} (ID {db_sub.id}): {marzban_user_info}", exc_info=marzban_user_info)
+                pages.append({"text": f"Не удалось загрузить детали для подписки `{db_sub.marzban_username}`. Попробуйте позже.", "extend_sub_id": None})
+                continue
+
+            if not marzban_user_info:
+                logger.warning(f"Пользователь Marzban {db_sub.marzban_username} не найден в панели для sub ID {db_sub.id}. Возможно, был удален вручную.")
+                pages.append({
+                    "text": (
                         f"⚠️ Подписка с именем `{db_sub.marzban_username}` не найдена на сервере.\n"
                         f"Ссылка: `{db_sub.subscription_url}` (может быть неактивна)\n"
-                        f"Пожалуйста, свяжитесь с поддержкой, если считаете это ошибкой.",
-                        parse_mode='Markdown'
-                    )
-                    continue
-
-                subscriptions_found = True
-
-                # Форматирование данных о трафике
-                used_traffic_gb = round(marzban_user_info.used_traffic / (1024**3), 2)
-                data_limit_gb_str = "Безлимитно"
-                if marzban_user_info.data_limit > 0:
-                    data_limit_gb_str = f"{round(marzban_user_info.data_limit / (1024**3), 2)} ГБ"
-
-                # Дата истечения
-                expires_at_dt = datetime.fromtimestamp(marzban_user_info.expire) if marzban_user_info.expire else None
-                expires_str = "Никогда"
-                is_expired_on_marzban = False
-                if expires_at_dt:
-                    expires_str = expires_at_dt.strftime('%d.%m.%Y в %H:%M UTC')
-                    if expires_at_dt < now:
-                        is_expired_on_marzban = True
-
-                # Статус пользователя в Marzban
-                status_translation = {
-                    "active": "Активна ✅",
-                    "disabled": "Отключена (администратором) 🚫",
-                    "expired": "Истекла (по времени) ⏳",
-                    "limited": "Истекла (по трафику) 📈"
-                }
-                marzban_status_str = status_translation.get(marzban_user_info.status, marzban_user_info.status)
-
-                # Обновляем локальный expires_at и is_active, если есть расхождения и подписка на сервере активна
-                # Это важно, если expires_at в Marzban был изменен вручную или другим процессом
-                if expires_at_dt and db_sub.expires_at != expires_at_dt and marzban_user_info.status == "active":
-                    db_sub.expires_at = expires_at_dt
-                    logger.info(f"Обновлена дата истечения для локальной подписки ID {db_sub.id} на {expires_at_dt} из Marzban.")
-
-                if marzban_user_info.status != "active" and db_sub.is_active:
-                    db_sub.is_active = False # Если в Marzban не активна, то и у нас не активна
-                    logger.info(f"Подписка ID {db_sub.id} помечена неактивной, т.к. статус в Marzban: {marzban_user_info.status}")
-                elif marzban_user_info.status == "active" and not db_sub.is_active and (not expires_at_dt or expires_at_dt > now) :
-                    # Если в Marzban активна, а у нас нет (и не истекла), активируем
-                    db_sub.is_active = True
-                    logger.info(f"Подписка ID {db_sub.id} помечена активной, т.к. статус в Marzban: {marzban_user_info.status} и не истекла.")
-
-                # Если подписка в Marzban истекла по времени или трафику, но у нас еще активна
-                if (is_expired_on_marzban or marzban_user_info.status in ["expired", "limited"]) and db_sub.is_active:
-                    db_sub.is_active = False
-                    logger.info(f"Подписка ID {db_sub.id} помечена неактивной из-за статуса/истечения в Marzban ({marzban_user_info.status}, истекла: {is_expired_on_marzban}).")
-
-                await session.commit() # Сохраняем изменения в is_active/expires_at для db_sub
-
-                # Не показываем пользователю неактивные подписки, которые уже неактивны и в Marzban,
-                # или если они были помечены неактивными только что из-за статуса Marzban.
-                if not db_sub.is_active and marzban_user_info.status != "active":
-                    # Можно добавить логирование, что такая подписка была, но не отображается
-                    logger.info(f"Пропуск отображения неактивной подписки ID {db_sub.id} (статус Marzban: {marzban_user_info.status})")
-                    continue
-
-
-                response_text_part = (
-                    f"🔗 **Ссылка-подписка:**\n`{db_sub.subscription_url}`\n\n"
-                    f"👤 Имя пользователя (Marzban): `{db_sub.marzban_username}`\n"
-                    f"📊 Трафик: Использовано {used_traffic_gb} ГБ из {data_limit_gb_str}\n"
-                    f"🗓️ Действительна до: *{expires_str}*\n"
-                    f"🚦 Статус на сервере: *{marzban_status_str}*\n"
-                    f"{'🔑 (Пробная)' if db_sub.is_trial else '💳 (Платная)'}"
-                )
+                        f"Пожалуйста, свяжитесь с поддержкой, если считаете это ошибкой."
+                    ),
+                    "extend_sub_id": None
+                })
+                continue
 
-                # Кнопка продления только если подписка не "disabled" администратором
-                keyboard_buttons = []
-                if marzban_user_info.status != "disabled":
-                     keyboard_buttons.append([InlineKeyboardButton("Продлить на 1 месяц", callback_data=f"extend_sub_{db_sub.id}")])
+            sync_subscription_with_marzban(db_sub, marzban_user_info, now)
 
-                reply_markup = InlineKeyboardMarkup(keyboard_buttons) if keyboard_buttons else None
-                await update.message.reply_text(response_text_part, parse_mode='Markdown', reply_markup=reply_markup)
+            # Не показываем пользователю неактивные подписки, которые уже неактивны и в Marzban,
+            # или если они были помечены неактивными только что из-за статуса Marzban.
+            if not db_sub.is_active and marzban_user_info.status != "active":
+                logger.info(f"Пропуск отображения неактивной подписки ID {db_sub.id} (статус Marzban: {marzban_user_info.status})")
+                continue
 
-            except Exception as e:
-                logger.error(f"Ошибка при получении информации о подписке Marzban {db_sub.marzban_username} (ID {db_sub.id}): {e}", exc_info=True)
-                if "token" in str(e).lower(): # Очень грубая проверка
-                    marzban_api_token_val = await get_marzban_api_token(force_refresh=True) # Обновляем токен
-                await update.message.reply_text(f"Не удалось загрузить детали для подписки `{db_sub.marzban_username}`. Попробуйте позже.", parse_mode='Markdown')
-
-        if not subscriptions_found and not active_subscriptions_db: # Если изначально не было найдено активных в БД
-             pass # Сообщение "нет активных подписок" уже было отправлено выше
-        elif not subscriptions_found and active_subscriptions_db: # Если были в БД, но ни одна не прошла проверку Marzban или неактивна
+            pages.append(format_subscription_page(db_sub, marzban_user_info))
+
+        await session.commit() # Один commit на все изменения is_active/expires_at
+
+        if not pages: # Были в БД, но ни одна не прошла проверку Marzban или неактивна
             await update.message.reply_text("Не найдено актуальных активных подписок. Возможно, все ваши подписки истекли или были деактивированы на сервере.")
+            return
+
+        # Страницы храним в user_data, чтобы листание не требовало повторных запросов к Marzban
+        context.user_data["my_keys_pages"] = pages
+        text, reply_markup = render_my_keys_page(pages, 0)
+        await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+
+async def my_keys_page_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Листает сообщение "Моя подписка", редактируя его на месте.
+    """
+    query = update.callback_query
+    await query.answer()
 
+    pages = context.user_data.get("my_keys_pages")
+    if not pages:
+        await query.edit_message_text(f"Список подписок устарел. Нажмите '{BUTTON_MY_KEYS}' еще раз.")
+        return
+
+    index = int(context.matches[0].group(1))
+    text, reply_markup = render_my_keys_page(pages, index)
+    try:
+        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower(): # Нажата кнопка текущей страницы — редактировать нечего
+            raise
+
+@metrics.observe_handler
 async def extend_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обрабатывает нажатие на inline-кнопку "Продлить подписку" для конкретной подписки Marzban.
@@ -453,10 +480,17 @@ async def extend_callback_handler(update: Update, context: ContextTypes.DEFAULT_
         logger.error("extend_callback_handler: subscription_db_id not found in callback_data.")
         return
 
-    subscription_db_id = int(subscription_db_id_str)
+    await extend_subscription_flow(update, context, int(subscription_db_id_str))
+
+async def extend_subscription_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, subscription_db_id: int) -> None:
+    """Проверяет подписку и создает платеж на продление (под user_advisory_lock пользователя)."""
+    query = update.callback_query
     user_tg_id = query.from_user.id
 
     async for session in get_async_session():
+        user_db_id = await resolve_user_id(session, query.from_user)
+        await user_advisory_lock(session, user_tg_id) # До commit платежа: повторное нажатие получит ту же ссылку
+
         # Получаем объект подписки из нашей БД
         db_subscription = await session.get(VpnKey, subscription_db_id)
 
@@ -472,28 +506,26 @@ async def extend_callback_handler(update: Update, context: ContextTypes.DEFAULT_
         # Проще всего, если user_id в VpnKey соответствует DbUser.id, а не telegram_id.
         # Текущая модель: VpnKey.user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
         # User.telegram_id = Column(Integer, unique=True, index=True, nullable=False)
-        # Значит, нужно сначала получить DbUser.id по telegram_id
-
-        db_user_obj = (await session.execute(select(DbUser).where(DbUser.telegram_id == user_tg_id))).scalar_one()
-        if not db_user_obj or db_subscription.user_id != db_user_obj.id:
+        # Значит, нужно сначала получить DbUser.id по telegram_id (см. resolve_user_id выше)
+        if db_subscription.user_id != user_db_id:
             await query.message.reply_text("Ошибка: эта подписка не принадлежит вам.")
-            logger.warning(f"User {user_tg_id} tried to extend subscription {subscription_db_id} not belonging to them (owner user_id: {db_subscription.user_id}, this user_id: {db_user_obj.id if db_user_obj else 'None'}).")
+            logger.warning(f"User {user_tg_id} tried to extend subscription {subscription_db_id} not belonging to them (owner user_id: {db_subscription.user_id}, this user_id: {user_db_id}).")
             return
 
-        # Проверка статуса подписки в Marzban перед продлением
-        marzban_api_token_val = await get_marzban_api_token()
-        if not marzban_api_token_val:
-            await query.message.reply_text("Не удалось связаться с VPN сервисом. Попробуйте позже. (Ошибка токена Marzban)")
-            return
+        bind_log_context(marzban_username=db_subscription.marzban_username)
 
+        # Проверка статуса подписки в Marzban перед продлением
         try:
-            marzban_user_info = await marzban_client.get_user(username=db_subscription.marzban_username, token=marzban_api_token_val)
+            marzban_user_info = await get_marzban_user_cached(db_subscription.marzban_username)
             if not marzban_user_info:
                 await query.message.reply_text(f"Не удалось найти вашу подписку ({db_subscription.marzban_username}) на VPN сервере. Обратитесь в поддержку.")
                 return
             if marzban_user_info.status == "disabled":
                 await query.message.reply_text(f"Ваша подписка ({db_subscription.marzban_username}) отключена администратором и не может быть продлена. Обратитесь в поддержку.")
                 return
+        except MarzbanUnavailableError:
+            await query.message.reply_text("VPN сервис временно недоступен. Пожалуйста, попробуйте позже.")
+            return
         except Exception as e:
             logger.error(f"Ошибка при проверке статуса Marzban пользователя {db_subscription.marzban_username} перед продлением: {e}", exc_info=True)
             await query.message.reply_text("Произошла ошибка при проверке статуса вашей подписки. Пожалуйста, попробуйте позже.")
@@ -503,6 +535,8 @@ async def extend_callback_handler(update: Update, context: ContextTypes.DEFAULT_
         await initiate_yookassa_payment(
             update,
             context,
+            session,
+            user_db_id,
             months=1,
             duration_days=30, # Стандартная длительность для платной подписки
             marzban_username_to_extend=db_subscription.marzban_username,
@@ -513,6 +547,8 @@ async def extend_callback_handler(update: Update, context: ContextTypes.DEFAULT_
 async def initiate_yookassa_payment(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
+    session, # Сессия вызывающего потока: в ее транзакции держится user_advisory_lock
+    user_db_id: int,
     months: int,
     duration_days: int,
     marzban_username_to_extend: str | None = None, # Имя пользователя в Marzban для продления
@@ -541,247 +577,546 @@ async def initiate_yookassa_payment(
         return
 
     payment_amount = BASE_PRICE_PER_MONTH * months
+
+    # Метаданные для YooKassa
+    yookassa_metadata = {
+        "internal_user_db_id": str(user_db_id), # ID пользователя из нашей таблицы users
+        "telegram_user_id": str(user_tg.id),
+        "duration_days": str(duration_days),
+        # "chosen_protocol" больше не нужен
+    }
     
-    async for session in get_async_session():
-        db_user_obj = (await session.execute(select(DbUser).where(DbUser.telegram_id == user_tg.id))).scalar_one()
-        
-        # Метаданные для YooKassa
-        yookassa_metadata = {
-            "internal_user_db_id": str(db_user_obj.id), # ID пользователя из нашей таблицы users
-            "telegram_user_id": str(user_tg.id),
-            "duration_days": str(duration_days),
-            # "chosen_protocol" больше не нужен
-        }
-        
-        description_service_part = "VPN подписки (Marzban)"
-
-        if marzban_username_to_extend and subscription_db_id_to_extend:
-            yookassa_metadata["action"] = "extend"
-            yookassa_metadata["marzban_username"] = marzban_username_to_extend
-            yookassa_metadata["subscription_db_id"] = subscription_db_id_to_extend # ID VpnKey из нашей БД
-            description = f"Продление {description_service_part} ({marzban_username_to_extend}) на {months} мес."
-        else:
-            # Это сценарий создания новой платной подписки (например, после того как триал был использован)
-            yookassa_metadata["action"] = "create"
-            # marzban_username будет сгенерирован в вебхуке после успешной оплаты
-            description = f"Новая {description_service_part} на {months} мес."
-            # Проверим, нет ли у пользователя уже активной НЕ ТРИАЛЬНОЙ подписки, чтобы случайно не создать вторую платную
-            # Это больше для информации, т.к. вебхук должен быть идемпотентным или создавать нового юзера если нужно
-            active_paid_sub_stmt = select(VpnKey).where(
-                VpnKey.user_id == db_user_obj.id,
-                VpnKey.is_trial == False,
-                VpnKey.is_active == True,
-                VpnKey.expires_at > datetime.utcnow()
-            )
-            existing_active_paid_sub = (await session.execute(active_paid_sub_stmt)).scalars().first()
-            if existing_active_paid_sub:
-                logger.warning(f"Пользователь {user_tg.id} пытается создать новую платную подписку, уже имея активную платную {existing_active_paid_sub.marzban_username}.")
-                # Можно добавить доп. логику: предложить продлить существующую или подтвердить создание новой.
-                # Пока что, позволяем создать новый платеж на новую подписку. Вебхук разберется.
-                # Или можно перенаправить на продление существующей, если она одна.
-                # description = f"Новая/Продление {description_service_part} на {months} мес." # Более общий текст
-                # yookassa_metadata["action"] = "create_or_extend" # Если хотим универсальный обработчик в вебхуке
-                pass
-
-
-        receipt_items = [
-            ReceiptItem({
+    description_service_part = "VPN подписки (Marzban)"
+
+    if marzban_username_to_extend and subscription_db_id_to_extend:
+        yookassa_metadata["action"] = "extend"
+        yookassa_metadata["marzban_username"] = marzban_username_to_extend
+        yookassa_metadata["subscription_db_id"] = subscription_db_id_to_extend # ID VpnKey из нашей БД
+        description = f"Продление {description_service_part} ({marzban_username_to_extend}) на {months} мес."
+    else:
+        # Это сценарий создания новой платной подписки (например, после того как триал был использован)
+        yookassa_metadata["action"] = "create"
+        # marzban_username будет сгенерирован в вебхуке после успешной оплаты
+        description = f"Новая {description_service_part} на {months} мес."
+        # Проверим, нет ли у пользователя уже активной НЕ ТРИАЛЬНОЙ подписки, чтобы случайно не создать вторую платную
+        # Это больше для информации, т.к. вебхук должен быть идемпотентным или создавать нового юзера если нужно
+        active_paid_sub_stmt = select(VpnKey).where(
+            VpnKey.user_id == user_db_id,
+            VpnKey.is_trial == False,
+            VpnKey.is_active == True,
+            VpnKey.expires_at > datetime.utcnow()
+        )
+        existing_active_paid_sub = (await session.execute(active_paid_sub_stmt)).scalars().first()
+        if existing_active_paid_sub:
+            logger.warning(f"Пользователь {user_tg.id} пытается создать новую платную подписку, уже имея активную платную {existing_active_paid_sub.marzban_username}.")
+            # Можно добавить доп. логику: предложить продлить существующую или подтвердить создание новой.
+            # Пока что, позволяем создать новый платеж на новую подписку. Вебхук разберется.
+            # Или можно перенаправить на продление существующей, если она одна.
+            # description = f"Новая/Продление {description_service_part} на {months} мес." # Более общий текст
+            # yookassa_metadata["action"] = "create_or_extend" # Если хотим универсальный обработчик в вебхуке
+            pass
+
+    # Повторное нажатие: если по этой же покупке есть pending-платеж с живой ссылкой, отдаем ее
+    # без запроса к YooKassa и без новой строки в payments (индекс ix_payments_user_purchase_pending)
+    purchase_key = f"{yookassa_metadata['action']}_{marzban_username_to_extend or 'new'}_{months}_{duration_days}"
+    existing_confirmation_url = (await session.execute(
+        select(Payment.confirmation_url).where(
+            Payment.user_id == user_db_id,
+            Payment.purchase_key == purchase_key,
+            Payment.status == "pending",
+            Payment.confirmation_expires_at > datetime.utcnow(),
+        ).order_by(Payment.confirmation_expires_at.desc()).limit(1)
+    )).scalar_one_or_none()
+    if existing_confirmation_url:
+        logger.info(f"Пользователю {user_tg.id} повторно выдана ссылка на оплату ({purchase_key}).")
+        await context.bot.send_message(chat_id, f"Для оплаты перейдите по ссылке:\n{existing_confirmation_url}")
+        return
+
+    payment_payload = {
+        "amount": {"value": str(payment_amount), "currency": "RUB"},
+        "capture": True,
+        "confirmation": {"type": "redirect", "return_url": f"https://t.me/{context.bot.username}"},
+        "description": description,
+        "metadata": yookassa_metadata,
+        "receipt": {
+            "customer": {"email": f"user_{user_tg.id}@telegram.bot"}, # или другое валидное поле, если email нет
+            "items": [{
                 "description": description,
-                "quantity": 1.0,
+                "quantity": "1.00",
                 "amount": {"value": str(payment_amount), "currency": "RUB"},
                 "vat_code": 1
-            })
-        ]
-
-        receipt = Receipt()
-        receipt.customer = {"email": f"user_{user_tg.id}@telegram.bot"} # или другое валидное поле, если email нет
-        receipt.items = receipt_items
-
-        builder = PaymentRequestBuilder()
-        builder.set_amount({"value": str(payment_amount), "currency": "RUB"}) \
-            .set_capture(True) \
-            .set_confirmation({"type": "redirect", "return_url": f"https://t.me/{context.bot.username}"}) \
-            .set_description(description) \
-            .set_metadata(yookassa_metadata) \
-            .set_receipt(receipt)
-        
-        # Генерируем idempotency_key для предотвращения дублирования платежей при сбоях
-        idempotency_key_payload = f"{db_user_obj.id}_{yookassa_metadata['action']}_{marzban_username_to_extend or 'new'}_{months}_{duration_days}"
-        idempotency_key = str(uuid.uuid5(uuid.NAMESPACE_DNS, idempotency_key_payload)) # Пример генерации
+            }]
+        }
+    }
 
-        try:
-            payment_request = builder.build()
-            # YooKassaPaymentObject.create - блокирующий вызов, используем to_thread
-            yookassa_payment_obj = await asyncio.to_thread(
-                YooKassaPaymentObject.create, payment_request, idempotency_key
-            )
+    # Генерируем idempotency_key для предотвращения дублирования платежей при сбоях
+    idempotency_key_payload = f"{user_db_id}_{purchase_key}"
+    idempotency_key = str(uuid.uuid5(uuid.NAMESPACE_DNS, idempotency_key_payload)) # Пример генерации
 
-            if yookassa_payment_obj and yookassa_payment_obj.confirmation:
-                new_db_payment = Payment(
-                    yookassa_payment_id=yookassa_payment_obj.id,
-                    user_id=db_user_obj.id,
-                    amount=payment_amount,
-                    currency="RUB", # Можно брать из yookassa_payment_obj.amount.currency
-                    status=yookassa_payment_obj.status,
-                    description=description,
-                    additional_data=json.dumps(yookassa_metadata)
+    try:
+        # Асинхронный клиент с keep-alive сессией, без потоков из общего executor
+        yookassa_payment = await yookassa_client.create_payment(payment_payload, idempotency_key)
+        if yookassa_payment.get("status") != "pending":
+            # По этому Idempotence-Key YooKassa вернула прежний, уже завершенный платеж — нужен новый
+            yookassa_payment = await yookassa_client.create_payment(payment_payload, str(uuid.uuid4()))
+        bind_log_context(payment_id=yookassa_payment.get("id"))
+        confirmation_url = (yookassa_payment.get("confirmation") or {}).get("confirmation_url")
+
+        if confirmation_url:
+            insert_stmt = pg_insert(Payment).values(
+                yookassa_payment_id=yookassa_payment["id"],
+                user_id=user_db_id,
+                amount=payment_amount,
+                currency="RUB", # Можно брать из yookassa_payment["amount"]["currency"]
+                status=yookassa_payment["status"],
+                description=description,
+                additional_data=json.dumps(yookassa_metadata),
+                confirmation_url=confirmation_url,
+                confirmation_expires_at=datetime.utcnow() + timedelta(minutes=PAYMENT_LINK_TTL_MIN),
+                purchase_key=purchase_key,
+            )
+            # Повтор с тем же Idempotence-Key возвращает тот же платеж: вторую строку не создаем, но обновляем
+            # ссылку и срок — иначе после истечения сохраненного срока каждое нажатие снова шло бы в YooKassa
+            await session.execute(
+                insert_stmt.on_conflict_do_update(
+                    index_elements=[Payment.yookassa_payment_id],
+                    set_={
+                        "confirmation_url": insert_stmt.excluded.confirmation_url,
+                        "confirmation_expires_at": insert_stmt.excluded.confirmation_expires_at,
+                        "updated_at": datetime.utcnow(),
+                    },
+                    where=Payment.status == "pending", # Проведенный или отмененный платеж не трогаем
                 )
-                session.add(new_db_payment)
-                await session.commit()
-                await context.bot.send_message(chat_id, f"Для оплаты перейдите по ссылке:\n{yookassa_payment_obj.confirmation.confirmation_url}")
-            else:
-                logger.error(f"Не удалось создать платеж YooKassa для пользователя {user_tg.id}. Ответ: {yookassa_payment_obj}")
-                await context.bot.send_message(chat_id, "Не удалось создать ссылку на оплату. Пожалуйста, попробуйте позже.")
-        except Exception as e:
-            logger.error(f"Ошибка при создании платежа YooKassa для пользователя {user_tg.id}: {e}", exc_info=True)
-            await context.bot.send_message(chat_id, "Произошла ошибка при формировании запроса на оплату. Пожалуйста, попробуйте позже.")
-        except Exception as e:
-            logger.error(f"Ошибка при создании платежа YooKassa для пользователя {user_tg.id}: {e}", exc_info=True)
-            await context.bot.send_message(chat_id, "Произошла ошибка при формировании запроса на оплату. Пожалуйста, попробуйте позже.")
+            )
+            await session.commit()
+            await context.bot.send_message(chat_id, f"Для оплаты перейдите по ссылке:\n{confirmation_url}")
+        else:
+            logger.error(f"Не удалось создать платеж YooKassa для пользователя {user_tg.id}. Ответ: {yookassa_payment}")
+            await context.bot.send_message(chat_id, "Не удалось создать ссылку на оплату. Пожалуйста, попробуйте позже.")
+    except Exception as e:
+        logger.error(f"Ошибка при создании платежа YooKassa для пользователя {user_tg.id}: {e}", exc_info=True)
+        await context.bot.send_message(chat_id, "Произошла ошибка при формировании запроса на оплату. Пожалуйста, попробуйте позже.")
 
 # --- ПЛАНИРОВЩИК ЗАДАЧ ---
-async def check_and_deactivate_expired_keys():
-    logger.info("APScheduler: Checking expired Marzban subscriptions...")
+EXPIRY_SWEEP_CHECKPOINT_NAME = "expiry_sweep" # Строка в job_checkpoints
+# Не даем запускам проверки истекших подписок перекрываться (APScheduler тоже ограничен max_instances=1)
+expiry_sweep_lock = asyncio.Lock()
 
-    if not marzban_client:
-        logger.error("APScheduler: Marzban client not initialized. Skipping check.")
-        return
+async def fetch_marzban_users_snapshot() -> dict[str, tuple[str, int]]:
+    """
+    Загружает всех пользователей панели постранично (offset/limit у /api/users)
+    в компактный словарь {username: (status, expire)}.
+    """
+    from marzpy.api.send_requests import send_request as marzban_send_request # Для постраничного /api/users
+    snapshot: dict[str, tuple[str, int]] = {}
+    offset = 0
+    pages = 0
+    while True:
+        pages += 1
+        page = await marzban_api.call("list_users",
+            lambda token: marzban_send_request(f"users?offset={offset}&limit={MARZBAN_SNAPSHOT_PAGE_SIZE}", token, "get")
+        )
+        users = page.get("users") or []
+        for user in users:
+            snapshot[user["username"]] = (user.get("status") or "", user.get("expire") or 0)
+        offset += len(users)
+        if not users or offset >= page.get("total", offset):
+            break
+    logger.info(f"APScheduler: Loaded Marzban snapshot with {len(snapshot)} users in {pages} page(s).")
+    return snapshot
+
+async def report_marzban_drift(session, snapshot: dict[str, tuple[str, int]]) -> dict:
+    """
+    Сравнивает снимок панели с нашей БД и логирует расхождения.
+    Подписки читаются keyset-страницами по MARZBAN_SNAPSHOT_PAGE_SIZE, поэтому в памяти кроме снимка
+    только одна страница и множество еще не встреченных пользователей панели.
+    """
+    panel_unknown = set(snapshot) # Встреченные в БД пользователи удаляются отсюда
+    db_missing_count = 0
+    db_missing_examples = []
+    last_id = 0
+    while True:
+        page = (await session.execute(
+            select(VpnKey.id, VpnKey.marzban_username, VpnKey.is_active)
+            .where(VpnKey.id > last_id)
+            .order_by(VpnKey.id)
+            .limit(MARZBAN_SNAPSHOT_PAGE_SIZE)
+        )).all()
+        if not page:
+            break
+        for _, marzban_username, is_active in page:
+            panel_unknown.discard(marzban_username)
+            if is_active and marzban_username not in snapshot:
+                db_missing_count += 1
+                if len(db_missing_examples) < 10:
+                    db_missing_examples.append(marzban_username)
+        last_id = page[-1].id
+
+    if panel_unknown:
+        logger.warning(f"APScheduler: {len(panel_unknown)} Marzban users are unknown to our DB, e.g.: {sorted(panel_unknown)[:10]}")
+    if db_missing_count:
+        logger.warning(f"APScheduler: {db_missing_count} active DB subscriptions have no Marzban user, e.g.: {db_missing_examples}")
+    return {"panel_unknown": len(panel_unknown), "db_missing_in_panel": db_missing_count}
+
+async def resolve_expired_subscription(
+    db_sub, # Строка VpnKey (id, marzban_username, user_id)
+    semaphore: asyncio.Semaphore,
+    snapshot: dict[str, tuple[str, int]] | None = None
+) -> tuple[str, datetime | None]:
+    """
+    Выполняет вызовы Marzban для одной истекшей подписки и возвращает решение:
+    ("extended", новая дата) | ("deactivated", None) | ("failed", None).
+    Если передан снимок панели, статус берется из него без запроса get_user.
+    Сессию БД не трогает: изменения применяет вызывающий код, пакетами.
+    """
+    async with semaphore:
+        logger.info(f"APScheduler: Processing DB subscription ID {db_sub.id} (Marzban User: {db_sub.marzban_username}) for user_id {db_sub.user_id}.")
+        try:
+            # Сначала проверим статус в Marzban, чтобы не удалять, если она была продлена другим способом
+            if snapshot is not None:
+                snapshot_entry = snapshot.get(db_sub.marzban_username)
+                marzban_status, marzban_expire = snapshot_entry if snapshot_entry else (None, 0)
+            else:
+                marzban_user_info = await marzban_api.call("get_user",
+                    lambda token: marzban_client.get_user(user_username=db_sub.marzban_username, token=token)
+                )
+                marzban_status, marzban_expire = (marzban_user_info.status, marzban_user_info.expire) if marzban_user_info else (None, 0)
+
+            if marzban_status is None:
+                # Пользователя нет в Marzban, удалять там нечего, но локально деактивировать надо
+                logger.info(f"User {db_sub.marzban_username} (DB ID: {db_sub.id}) not found in Marzban. Deactivating locally.")
+                return "deactivated", None
+
+            if marzban_status == "active":
+                marzban_expires_dt = datetime.fromtimestamp(marzban_expire) if marzban_expire else None
+                if marzban_expires_dt and marzban_expires_dt > datetime.utcnow():
+                    # Подписка была продлена в Marzban, обновим нашу БД
+                    logger.info(f"Subscription {db_sub.marzban_username} (DB ID: {db_sub.id}) was extended in Marzban to {marzban_expires_dt}. Updating local DB.")
+                    return "extended", marzban_expires_dt
+                # Если же marzban_expires_dt все еще <= now, то удаляем
+
+            logger.info(f"Attempting to delete user {db_sub.marzban_username} from Marzban panel.")
+            await marzban_api.call("delete_user", lambda token: marzban_client.delete_user(user_username=db_sub.marzban_username, token=token))
+            logger.info(f"Successfully deleted user {db_sub.marzban_username} from Marzban (or user already deleted).")
+            return "deactivated", None
+
+        except MarzbanUnavailableError:
+            return "failed", None # Панель недоступна, повторим в следующий запуск
+        except Exception as e:
+            # Если ошибка "User not found" от marzpy, то это нормально, можно просто деактивировать локально.
+            # Нужно проверить, какой тип исключения кидает marzpy для "user not found"
+            err_msg = str(e).lower()
+            if "user not found" in err_msg or "not found" in err_msg: # Грубая проверка
+                logger.warning(f"User {db_sub.marzban_username} not found in Marzban during deactivation (Error: {e}). Deactivating locally.")
+                return "deactivated", None
+            logger.error(f"Error processing expired Marzban subscription for {db_sub.marzban_username} (DB ID: {db_sub.id}): {e}", exc_info=True)
+            # Не меняем статус в БД, чтобы попробовать в следующий раз, если это временная ошибка API Marzban
+            return "failed", None
+
+async def load_sweep_checkpoint(session) -> tuple[datetime, tuple[datetime, int] | None]:
+    """
+    Граница выборки и keyset-курсор для запуска проверки истекших подписок.
+    Если прошлый запуск прервался, продолжаем его с той же границей и курсором; иначе начинаем новый.
+    """
+    checkpoint = await session.get(JobCheckpoint, EXPIRY_SWEEP_CHECKPOINT_NAME)
+    if checkpoint and checkpoint.finished_at is None:
+        cursor = (checkpoint.cursor_expires_at, checkpoint.cursor_id) if checkpoint.cursor_id is not None else None
+        logger.info(f"APScheduler: Resuming interrupted expiry check started at {checkpoint.run_started_at} from cursor {cursor}.")
+        return checkpoint.run_started_at, cursor
+    run_started_at = datetime.utcnow()
+    await save_sweep_checkpoint(session, run_started_at, None)
+    await session.commit()
+    return run_started_at, None
+
+async def save_sweep_checkpoint(session, run_started_at: datetime, cursor: tuple[datetime, int] | None, finished: bool = False) -> None:
+    """Сохраняет курсор в той же транзакции, что и изменения страницы (commit делает вызывающий код)."""
+    values = {
+        "run_started_at": run_started_at,
+        "cursor_expires_at": cursor[0] if cursor else None,
+        "cursor_id": cursor[1] if cursor else None,
+        "updated_at": datetime.utcnow(),
+        "finished_at": datetime.utcnow() if finished else None,
+    }
+    stmt = pg_insert(JobCheckpoint).values(name=EXPIRY_SWEEP_CHECKPOINT_NAME, **values)
+    await session.execute(stmt.on_conflict_do_update(index_elements=[JobCheckpoint.name], set_=values))
+
+async def apply_expired_page_outcomes(session, page, outcomes) -> list[str]:
+    """
+    Применяет решения по странице двумя set-based UPDATE ... RETURNING вместо изменения ORM-объектов.
+    Возвращает marzban_username измененных подписок (для сброса кэша).
+    """
+    deactivated_ids = [row.id for row, (outcome, _) in zip(page, outcomes) if outcome == "deactivated"]
+    extended = [(row.id, new_expires_at) for row, (outcome, new_expires_at) in zip(page, outcomes) if outcome == "extended"]
+    changed_usernames = []
+
+    if deactivated_ids:
+        result = await session.execute(
+            update(VpnKey)
+            .where(VpnKey.id == any_(deactivated_ids), VpnKey.is_active == True)
+            .values(is_active=False)
+            .returning(VpnKey.id, VpnKey.marzban_username)
+            .execution_options(synchronize_session=False)
+        )
+        for sub_id, marzban_username in result.all():
+            changed_usernames.append(marzban_username)
+            logger.info(f"Deactivated subscription ID {sub_id} (Marzban User: {marzban_username}) in local DB.")
+
+    if extended:
+        # Новые даты у каждой подписки свои — передаем их одной таблицей VALUES
+        new_dates = sa_values(column("id", Integer), column("expires_at", DateTime), name="new_dates").data(extended)
+        result = await session.execute(
+            update(VpnKey)
+            .where(VpnKey.id == new_dates.c.id)
+            .values(expires_at=new_dates.c.expires_at, is_active=True)
+            .returning(VpnKey.marzban_username)
+            .execution_options(synchronize_session=False)
+        )
+        changed_usernames.extend(result.scalars().all())
 
-    marzban_api_token_val = await get_marzban_api_token()
-    if not marzban_api_token_val:
-        logger.error("APScheduler: Failed to get Marzban API token. Skipping check.")
-        return
+    return changed_usernames
 
-    async for session in get_async_session():
-        keys_modified_count = 0
-        try:
-            # Выбираем подписки, которые активны в нашей БД и у которых подошло время истечения
-            stmt = select(VpnKey).where(
-                VpnKey.is_active == True,
-                VpnKey.expires_at <= datetime.utcnow()
-            )
-            expired_db_subscriptions = (await session.execute(stmt)).scalars().all()
+async def check_and_deactivate_expired_keys() -> dict | None:
+    """
+    Проверяет истекшие подписки страницами по EXPIRY_SWEEP_BATCH_SIZE (keyset по expires_at, id),
+    поэтому память не зависит от размера очереди. Вызовы Marzban внутри страницы идут параллельно
+    (не более EXPIRY_SWEEP_CONCURRENCY), изменения страницы и курсор фиксируются одним commit:
+    прерванный запуск продолжится со следующей страницы. Возвращает сводку запуска.
+    """
+    if expiry_sweep_lock.locked():
+        logger.warning("APScheduler: Previous expiry check is still running. Skipping this run.")
+        return None
 
-            if not expired_db_subscriptions:
-                logger.info("APScheduler: No subscriptions found in DB that are marked active and past expiration time.")
-                return
+    async with expiry_sweep_lock:
+        logger.info("APScheduler: Checking expired Marzban subscriptions...")
+        started = time.monotonic()
+        summary = {"checked": 0, "extended": 0, "deactivated": 0, "failed": 0, "pages": 0, "mode": EXPIRY_SWEEP_MODE, "wall_time_sec": 0.0}
 
-            logger.info(f"APScheduler: Found {len(expired_db_subscriptions)} potentially expired subscriptions in DB to check/deactivate.")
+        if not marzban_client:
+            logger.error("APScheduler: Marzban client not initialized. Skipping check.")
+            return None
 
-            for db_sub in expired_db_subscriptions:
-                logger.info(f"APScheduler: Processing DB subscription ID {db_sub.id} (Marzban User: {db_sub.marzban_username}) for user_id {db_sub.user_id}.")
-                try:
-                    # Сначала проверим статус в Marzban, чтобы не удалять, если она была продлена другим способом
-                    marzban_user_info = await marzban_client.get_user(username=db_sub.marzban_username, token=marzban_api_token_val)
-
-                    needs_deactivation_in_marzban = True
-                    if marzban_user_info:
-                        if marzban_user_info.status == "active":
-                            marzban_expires_dt = datetime.fromtimestamp(marzban_user_info.expire) if marzban_user_info.expire else None
-                            if marzban_expires_dt and marzban_expires_dt > datetime.utcnow():
-                                # Подписка была продлена в Marzban, обновим нашу БД
-                                logger.info(f"Subscription {db_sub.marzban_username} (DB ID: {db_sub.id}) was extended in Marzban to {marzban_expires_dt}. Updating local DB.")
-                                db_sub.expires_at = marzban_expires_dt
-                                db_sub.is_active = True # Убедимся, что она активна
-                                # Возможно, нужно обновить и data_limit, если он изменился
-                                await session.commit()
-                                keys_modified_count +=1
-                                needs_deactivation_in_marzban = False # Не удаляем из Marzban и не деактивируем локально (уже обновили)
-                            # Если же marzban_expires_dt все еще <= now, то удаляем
-                    else:
-                        # Пользователя нет в Marzban, значит можно просто деактивировать у нас
-                        logger.info(f"User {db_sub.marzban_username} (DB ID: {db_sub.id}) not found in Marzban. Deactivating locally.")
-                        needs_deactivation_in_marzban = False
-                        # Удалять из Marzban нечего, но локально деактивировать надо
-
-                    if needs_deactivation_in_marzban:
-                        logger.info(f"Attempting to delete user {db_sub.marzban_username} from Marzban panel.")
-                        await marzban_client.delete_user(username=db_sub.marzban_username, token=marzban_api_token_val)
-                        logger.info(f"Successfully deleted user {db_sub.marzban_username} from Marzban (or user already deleted).")
-
-                    # В любом случае (удален из Marzban или не найден там), если needs_deactivation_in_marzban был true (или не найден)
-                    # и мы дошли сюда без обновления (т.е. он действительно истек), деактивируем локально.
-                    # Если needs_deactivation_in_marzban=false И он не был обновлен (т.е. не найден в Marzban), тоже деактивируем локально.
-                    if needs_deactivation_in_marzban or (not marzban_user_info and not needs_deactivation_in_marzban):
-                        db_sub.is_active = False
-                        logger.info(f"Deactivated subscription ID {db_sub.id} (Marzban User: {db_sub.marzban_username}) in local DB.")
-                        keys_modified_count +=1
-
-                except Exception as e:
-                    # Если ошибка "User not found" от marzpy, то это нормально, можно просто деактивировать локально.
-                    # Нужно проверить, какой тип исключения кидает marzpy для "user not found"
-                    # Например, if isinstance(e, MarzbanUserNotFoundError): ...
-                    err_msg = str(e).lower()
-                    if "user not found" in err_msg or "not found" in err_msg: # Грубая проверка
-                        logger.warning(f"User {db_sub.marzban_username} not found in Marzban during deactivation (Error: {e}). Deactivating locally.")
-                        db_sub.is_active = False
-                        keys_modified_count +=1
-                    elif "token" in err_msg:
-                         logger.error(f"Marzban API token error during deactivation of {db_sub.marzban_username}: {e}. Attempting to refresh token for next run.")
-                         await get_marzban_api_token(force_refresh=True) # Обновить токен для следующих попыток
-                    else:
-                        logger.error(f"Error processing expired Marzban subscription for {db_sub.marzban_username} (DB ID: {db_sub.id}): {e}", exc_info=True)
-                        # Не меняем статус в БД, чтобы попробовать в следующий раз, если это временная ошибка API Marzban
-                        # кроме ошибки токена, которую мы уже попробовали обновить
-
-            if keys_modified_count > 0:
+        if not marzban_api.is_available():
+            logger.error("APScheduler: Marzban circuit breaker is open. Skipping check.")
+            return None
+
+        semaphore = asyncio.Semaphore(EXPIRY_SWEEP_CONCURRENCY)
+        async for session in get_async_session():
+            try:
+                snapshot = None
+                if EXPIRY_SWEEP_MODE == "snapshot":
+                    # N/page_size запросов к панели вместо N вызовов get_user
+                    snapshot = await fetch_marzban_users_snapshot()
+                    summary.update(await report_marzban_drift(session, snapshot))
+
+                run_started_at, cursor = await load_sweep_checkpoint(session)
+
+                while True:
+                    # Только нужные колонки, без ORM-объектов: страница живет до commit
+                    stmt = (
+                        select(VpnKey.id, VpnKey.marzban_username, VpnKey.user_id, VpnKey.expires_at)
+                        .where(VpnKey.is_active == True, VpnKey.expires_at <= run_started_at)
+                        .order_by(VpnKey.expires_at, VpnKey.id) # Совпадает с индексом ix_vpn_keys_active_expires_at
+                        .limit(EXPIRY_SWEEP_BATCH_SIZE)
+                    )
+                    if cursor is not None:
+                        stmt = stmt.where(tuple_(VpnKey.expires_at, VpnKey.id) > tuple_(*cursor))
+                    page = (await session.execute(stmt)).all()
+                    if not page:
+                        break
+
+                    summary["pages"] += 1
+                    outcomes = await asyncio.gather(
+                        *(resolve_expired_subscription(db_sub, semaphore, snapshot) for db_sub in page)
+                    )
+                    for outcome, _ in outcomes:
+                        summary["checked"] += 1
+                        summary[outcome] += 1
+
+                    changed_usernames = await apply_expired_page_outcomes(session, page, outcomes)
+                    # Неудачные ("failed") остаются активными, курсор проходит мимо них — повтор в следующий запуск
+                    cursor = (page[-1].expires_at, page[-1].id)
+                    await save_sweep_checkpoint(session, run_started_at, cursor)
+                    await session.commit() # Фиксируем страницу вместе с курсором
+                    for marzban_username in changed_usernames:
+                        marzban_user_cache.invalidate(marzban_username)
+
+                    if len(page) < EXPIRY_SWEEP_BATCH_SIZE:
+                        break
+
+                if summary["checked"] == 0:
+                    logger.info("APScheduler: No subscriptions found in DB that are marked active and past expiration time.")
+                await save_sweep_checkpoint(session, run_started_at, cursor, finished=True)
                 await session.commit()
-                logger.info(f"APScheduler: Committed changes for {keys_modified_count} subscriptions.")
-            else:
-                logger.info("APScheduler: No subscriptions required database changes in this run.")
 
-        except Exception as e:
-            logger.error(f"APScheduler error in check_and_deactivate_expired_keys: {e}", exc_info=True)
-            await session.rollback()
+            except Exception as e:
+                logger.error(f"APScheduler error in check_and_deactivate_expired_keys: {e}", exc_info=True)
+                metrics.errors.inc(component="expiry_sweep", cause=type(e).__name__)
+                await session.rollback()
+
+        summary["wall_time_sec"] = round(time.monotonic() - started, 2)
+        metrics.observe_job("expiry_sweep", summary, summary["wall_time_sec"], outcomes=("checked", "extended", "deactivated", "failed"))
+        logger.info(
+            f"APScheduler: Expiry check finished. Checked: {summary['checked']} in {summary['pages']} page(s), extended: {summary['extended']}, "
+            f"deactivated: {summary['deactivated']}, failed: {summary['failed']}, wall time: {summary['wall_time_sec']} s."
+        )
+        return summary
 
-# --- ЗАПУСК БОТА ---
-def main() -> None:
-    if not BOT_TOKEN:
-        logger.critical("BOT_TOKEN not found!")
+async def log_marzban_cache_stats():
+    logger.info(f"Marzban user cache stats: {marzban_user_cache.stats()}")
+    logger.info(f"Marzban API stats: {marzban_api.snapshot()}")
+    logger.info(f"DB pool stats: {get_pool_stats()}")
+    logger.info(f"Telegram user id cache: {get_user_cache_stats()}")
+    logger.info(f"Telegram send queue: {telegram_dispatcher.snapshot()}")
+
+# --- Холодный старт ---
+# Этапы старта и их длительность в секундах (логируются и экспортируются в метрики)
+startup_timings: dict[str, float] = {}
+
+def record_startup_stage(stage: str, seconds: float) -> None:
+    startup_timings[stage] = round(seconds, 3)
+    metrics.startup_duration.set(round(seconds, 3), stage=stage)
+
+record_startup_stage("module_load", time.monotonic() - BOT_PROCESS_STARTED_AT) # Импорты и инициализация модуля
+
+async def timed_startup_stage(stage: str, coroutine):
+    started = time.monotonic()
+    try:
+        return await coroutine
+    finally:
+        record_startup_stage(stage, time.monotonic() - started)
+
+async def warm_up_marzban_token():
+    await initialize_marzban_client()
+    if marzban_client:
+        # Не дольше MARZBAN_TOKEN_WARMUP_TIMEOUT_SEC: зависшая панель не задерживает getMe и прием апдейтов
+        await marzban_tokens.warm_up()
+
+async def warm_up_db_pool():
+    try:
+        await warm_up_pool(BOT_WARMUP_DB_CONNECTIONS)
+    except Exception as e:
+        logger.warning(f"Не удалось прогреть пул соединений БД: {e}")
+
+async def ensure_db_schema():
+    await create_db_tables()
+    await apply_migrations() # Индексы и прочие изменения существующих таблиц
+
+class WarmStartApplication(Application):
+    """initialize() (getMe) выполняется одновременно с прогревом пула БД и получением токена Marzban."""
+
+    async def initialize(self) -> None:
+        await asyncio.gather(
+            timed_startup_stage("telegram_get_me", super().initialize()),
+            timed_startup_stage("db_pool", warm_up_db_pool()),
+            timed_startup_stage("marzban_token", warm_up_marzban_token()),
+        )
+
+async def mark_first_update_handled(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа 1 выполняется после обработчиков группы 0: фиксируем время до первого обработанного апдейта."""
+    if "first_update" in startup_timings:
         return
+    record_startup_stage("first_update", time.monotonic() - BOT_PROCESS_STARTED_AT)
+    logger.info(f"Первый апдейт обработан через {startup_timings['first_update']} с после запуска процесса.")
 
-    application = Application.builder().token(BOT_TOKEN).build()
+# --- ЗАПУСК БОТА ---
+def build_application() -> Application:
+    """Собирает Application со всеми обработчиками и хуками (используется main() и нагрузочным стендом load_test.py)."""
+    # Апдейты разных пользователей обрабатываются параллельно, одного пользователя — по порядку
+    application = (
+        Application.builder()
+        .application_class(WarmStartApplication)
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_BOT_API_URL)
+        .rate_limiter(telegram_dispatcher)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .build()
+    )
     
-    # Инициализация клиента Marzban при старте
+    # Клиент Marzban, пул БД и getMe прогреваются параллельно в WarmStartApplication.initialize()
     async def post_init(app: Application):
-        await initialize_marzban_client() # Инициализируем клиент Marzban
-        # Затем создаем таблицы БД (если их нет)
-        await create_db_tables()
+        if BOT_SCHEMA_CHECK == "startup":
+            await timed_startup_stage("schema", ensure_db_schema())
+        elif BOT_SCHEMA_CHECK == "background":
+            pending = (await check_schema())["pending_migrations"]
+            if pending:
+                # Без колонок из миграций запросы бота падают — апдейты принимаем только после миграций
+                logger.warning(f"BOT_SCHEMA_CHECK=background, но не применены миграции {pending}: применяем до старта (шаг деплоя: python migrations.py).")
+                await timed_startup_stage("schema", ensure_db_schema())
+            else:
+                app.bot_data["schema_task"] = asyncio.create_task(timed_startup_stage("schema", ensure_db_schema()))
+        else:
+            logger.info("Проверка схемы БД при старте отключена (BOT_SCHEMA_CHECK=skip).")
 
         # Запуск планировщика
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
         scheduler = AsyncIOScheduler(timezone="UTC") # Перенес инициализацию сюда, чтобы она была после async context
-        scheduler.add_job(check_and_deactivate_expired_keys, 'interval', hours=1) # Можно сделать чаще, например, каждые 10-15 минут
+        scheduler.add_job(maybe_profile(check_and_deactivate_expired_keys, sample_rate=PROFILE_JOB_SAMPLE_RATE), 'interval', hours=1, max_instances=1, coalesce=True) # Можно сделать чаще, например, каждые 10-15 минут
+        scheduler.add_job(send_expiry_reminders, 'interval', hours=1, args=[app.bot], max_instances=1, coalesce=True) # Напоминания "продлить" до окончания подписки
+        scheduler.add_job(log_marzban_cache_stats, 'interval', minutes=15)
         scheduler.start()
-        app.job_queue = scheduler # Сохраняем scheduler в application context если нужно будет им управлять
+        app.bot_data["scheduler"] = scheduler # Application.job_queue в PTB v20+ только для чтения
         logger.info("APScheduler started.")
 
+        if BOT_METRICS_PORT:
+            app.bot_data["metrics_runner"] = await metrics.start_metrics_server(BOT_METRICS_HOST, BOT_METRICS_PORT)
+
+        # Вебхук сообщает о продлениях/созданиях через Postgres NOTIFY
+        app.bot_data["marzban_cache_listener"] = asyncio.create_task(listen_for_marzban_invalidations(PSYCOPG_CONNINFO))
+
+        record_startup_stage("ready", time.monotonic() - BOT_PROCESS_STARTED_AT)
+        logger.info(f"Старт бота, с: {startup_timings}")
+
     application.post_init = post_init
     
-    # Обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(f"^{BUTTON_GET_KEY}$"), get_key_handler))
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(f"^{BUTTON_MY_KEYS}$"), my_keys_handler))
+    # Обработчики команд (maybe_profile без PROFILE_DIR возвращает обработчик как есть)
+    application.add_handler(CommandHandler("start", maybe_profile(start)))
+    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(f"^{BUTTON_GET_KEY}$"), maybe_profile(get_key_handler)))
+    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(f"^{BUTTON_MY_KEYS}$"), maybe_profile(my_keys_handler)))
     
     # Обновленный pattern для extend_callback_handler
-    application.add_handler(CallbackQueryHandler(extend_callback_handler, pattern=r"^extend_sub_(\d+)$"))
+    application.add_handler(CallbackQueryHandler(maybe_profile(extend_callback_handler), pattern=r"^extend_sub_(\d+)$"))
+    application.add_handler(CallbackQueryHandler(maybe_profile(my_keys_page_callback_handler), pattern=rf"^{MY_KEYS_PAGE_CALLBACK_PREFIX}(\d+)$"))
+
+    application.add_handler(TypeHandler(Update, mark_first_update_handled), group=1)
 
     # Удаляем старый обработчик выбора протокола
     # application.add_handler(CallbackQueryHandler(handle_protocol_selection, pattern=f"^({PROTOCOL_CALLBACK_OUTLINE}|{PROTOCOL_CALLBACK_AMNEZIA})$"))
 
     async def on_shutdown(app: Application):
         logger.info("Bot is shutting down...")
-        if app.job_queue and app.job_queue.running: # type: ignore
-            app.job_queue.shutdown() # type: ignore
+        scheduler = app.bot_data.get("scheduler")
+        if scheduler and scheduler.running:
+            scheduler.shutdown()
             logger.info("APScheduler stopped.")
+        await yookassa_client.close()
+        metrics_runner = app.bot_data.get("metrics_runner")
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        for task_name in ("marzban_cache_listener", "schema_task"):
+            task = app.bot_data.get(task_name)
+            if task and not task.done():
+                task.cancel()
         if marzban_client: # Хотя у marzpy нет явного close() или dispose() метода в README
             logger.info("Marzban client does not have an explicit close method in marzpy.")
         # Здесь можно было бы добавить await async_engine.dispose(), если бы это было легко сделать синхронно с PTB < v20
         # Для PTB v20+ это делается в application.shutdown()
 
     application.post_shutdown = on_shutdown
+    return application
 
-    logger.info("Bot starting...")
-    application.run_polling()
+def main() -> None:
+    if not BOT_TOKEN:
+        logger.critical("BOT_TOKEN not found!")
+        return
+
+    application = build_application()
+
+    if BOT_MODE == "webhook":
+        logger.info("Bot starting in webhook mode...")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("Bot starting...")
+        application.run_polling() # Сам удаляет webhook, если он был установлен
     # Код после run_polling() для PTB < v20 обычно не выполняется при штатном завершении через сигналы,
     # поэтому логику остановки лучше помещать в post_shutdown или управлять циклом asyncio самому (для v20+)
     # if scheduler.running: # Этот блок может не всегда срабатывать как ожидается
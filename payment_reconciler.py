@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from sqlalchemy import and_, or_, text, tuple_
+from sqlalchemy.future import select
+
+import metrics
+from database import Payment, AsyncSessionLocal, async_engine
+from yookassa_client import yookassa_client
+
+load_dotenv()
+
+PAYMENT_RECONCILE_INTERVAL_SEC = int(os.getenv("PAYMENT_RECONCILE_INTERVAL_SEC", "300")) # 0 — сверка выключена
+PAYMENT_RECONCILE_MIN_AGE_MIN = int(os.getenv("PAYMENT_RECONCILE_MIN_AGE_MIN", "10")) # Моложе — ждем обычный вебхук
+PAYMENT_RECONCILE_MAX_AGE_HOURS = int(os.getenv("PAYMENT_RECONCILE_MAX_AGE_HOURS", "168")) # Старше — не сверяем
+PAYMENT_RECONCILE_PAGE_SIZE = int(os.getenv("PAYMENT_RECONCILE_PAGE_SIZE", "500")) # Наших платежей на одно окно запроса к YooKassa
+PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv("PAYMENT_RECONCILE_CONCURRENCY", "4")) # Одновременных окон (= запросов к YooKassa)
+# Окно запроса списка не шире этого: список возвращает все платежи магазина за окно, а не только наши
+PAYMENT_RECONCILE_MAX_WINDOW_MIN = int(os.getenv("PAYMENT_RECONCILE_MAX_WINDOW_MIN", "60"))
+# Меньше наших платежей в окне — дешевле GET /payments/{id} на каждый, чем два списка за окно
+PAYMENT_RECONCILE_LIST_MIN_PAYMENTS = int(os.getenv("PAYMENT_RECONCILE_LIST_MIN_PAYMENTS", "10"))
+YOOKASSA_LIST_LIMIT = 100 # Максимум limit у GET /payments
+# created_at у YooKassa чуть раньше нашего (мы сохраняем платеж после ответа API)
+RECONCILE_WINDOW_SLACK = timedelta(minutes=5)
+# Статусы YooKassa, которые уже не изменятся, и соответствующие события уведомлений
+FINAL_STATUS_EVENTS = {"succeeded": "payment.succeeded", "canceled": "payment.canceled"}
+
+logger = logging.getLogger(__name__)
+
+payment_reconcile_lock = asyncio.Lock()
+
+
+def _yookassa_time(value: datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def _pending_page_query(created_from: datetime, created_to: datetime, after: tuple[datetime, int] | None, now: datetime):
+    # Порядок совпадает с индексом ix_payments_status_created_at (status, created_at)
+    stmt = (
+        select(Payment.id, Payment.yookassa_payment_id, Payment.created_at)
+        .where(
+            # processing с истекшей арендой — обработчик упал, не проведя платеж
+            or_(Payment.status == "pending", and_(Payment.status == "processing", Payment.claimed_until < now)),
+            Payment.created_at >= created_from, Payment.created_at <= created_to,
+        )
+        .order_by(Payment.created_at, Payment.id)
+        .limit(PAYMENT_RECONCILE_PAGE_SIZE)
+    )
+    if after is not None:
+        stmt = stmt.where(tuple_(Payment.created_at, Payment.id) > tuple_(*after))
+    return stmt
+
+
+def _split_windows(rows) -> list[list]:
+    """Делит страницу (по возрастанию created_at) на окна шириной не больше PAYMENT_RECONCILE_MAX_WINDOW_MIN."""
+    max_span = timedelta(minutes=PAYMENT_RECONCILE_MAX_WINDOW_MIN)
+    windows = []
+    for row in rows:
+        if windows and row.created_at - windows[-1][0].created_at <= max_span:
+            windows[-1].append(row)
+        else:
+            windows.append([row])
+    return windows
+
+
+async def _get_final_payments(rows, summary: dict) -> list[dict]:
+    """GET /payments/{id} на каждый платеж окна; возвращает те, что уже в финальном статусе."""
+    found = []
+    for row in rows:
+        payment_object = await yookassa_client.get_payment(row.yookassa_payment_id)
+        summary["yookassa_requests"] += 1
+        if payment_object.get("status") in FINAL_STATUS_EVENTS:
+            found.append(payment_object)
+    return found
+
+
+async def _list_final_payments(status: str, created_gte: datetime, created_lte: datetime, wanted_ids: set[str], summary: dict) -> list[dict]:
+    """Постранично читает платежи YooKassa со статусом status в окне и возвращает те, что есть в wanted_ids."""
+    found, cursor = [], None
+    while True:
+        params = {
+            "status": status,
+            "created_at.gte": _yookassa_time(created_gte),
+            "created_at.lte": _yookassa_time(created_lte),
+            "limit": YOOKASSA_LIST_LIMIT,
+        }
+        if cursor:
+            params["cursor"] = cursor
+        page = await yookassa_client.list_payments(**params)
+        summary["yookassa_requests"] += 1
+        found.extend(item for item in page.get("items") or [] if item.get("id") in wanted_ids)
+        cursor = page.get("next_cursor")
+        if not cursor:
+            return found
+
+
+async def _reconcile_window(rows, store_notification, summary: dict) -> None:
+    created_gte = rows[0].created_at - RECONCILE_WINDOW_SLACK
+    created_lte = rows[-1].created_at + RECONCILE_WINDOW_SLACK
+    # Запросы окна идут по очереди: одно окно — один запрос к YooKassa в полете
+    try:
+        if len(rows) < PAYMENT_RECONCILE_LIST_MIN_PAYMENTS:
+            payments = await _get_final_payments(rows, summary)
+        else:
+            wanted_ids = {row.yookassa_payment_id for row in rows}
+            payments = []
+            for status in FINAL_STATUS_EVENTS:
+                payments.extend(await _list_final_payments(status, created_gte, created_lte, wanted_ids, summary))
+    except Exception as e:
+        summary["failed_windows"] += 1
+        logger.warning(f"Сверка платежей: окно {created_gte} - {created_lte} не прочитано из YooKassa: {e}")
+        return
+
+    for payment_object in payments:
+        status = payment_object["status"]
+        summary[status] += 1
+        # Тот же путь, что у вебхука: запись в inbox, обработка — воркеры inbox
+        outcome = await store_notification({"type": "notification", "event": FINAL_STATUS_EVENTS[status], "object": payment_object})
+        summary[outcome or "already_queued"] += 1
+
+
+async def _run_window(rows, store_notification, semaphore: asyncio.Semaphore, summary: dict) -> None:
+    try:
+        await _reconcile_window(rows, store_notification, summary)
+    finally:
+        semaphore.release()
+
+
+async def _try_lock_run(conn) -> bool:
+    """Между процессами (воркеры gunicorn) сверку выполняет один: session-level advisory lock на время запуска."""
+    return bool((await conn.execute(text("SELECT pg_try_advisory_lock(hashtextextended('payment_reconciler', 0))"))).scalar())
+
+
+async def reconcile_pending_payments(store_notification) -> dict | None:
+    """
+    Сверяет с YooKassa наши pending-платежи (и processing с истекшей арендой) старше PAYMENT_RECONCILE_MIN_AGE_MIN,
+    если вебхук потерялся или его обработка не дошла до конца.
+    Платежи читаются страницами (keyset по created_at, id), страница делится на окна не шире
+    PAYMENT_RECONCILE_MAX_WINDOW_MIN. Для окна с PAYMENT_RECONCILE_LIST_MIN_PAYMENTS платежей и больше — списки
+    GET /payments со статусами succeeded и canceled, для более редких — GET на каждый платеж.
+    Найденные завершенные платежи уходят в store_notification (запись в inbox вебхука), который возвращает
+    "queued"/"requeued", "dead_letter" для записи в failed (не повторяется) или None, если уведомление уже ждет обработки.
+    Возвращает сводку: сколько завершенных платежей найдено (succeeded/canceled) и что стало с их уведомлениями.
+    """
+    if payment_reconcile_lock.locked():
+        logger.warning("Payment reconciliation: previous run is still in progress, skipping.")
+        return None
+
+    async with payment_reconcile_lock, async_engine.connect() as lock_conn:
+        lock_conn = await lock_conn.execution_options(isolation_level="AUTOCOMMIT") # Не держим транзакцию открытой весь запуск
+        if not await _try_lock_run(lock_conn):
+            logger.info("Payment reconciliation: выполняется в другом процессе, пропускаем.")
+            return None
+        try:
+            started = time.monotonic()
+            now = datetime.utcnow()
+            created_from = now - timedelta(hours=PAYMENT_RECONCILE_MAX_AGE_HOURS)
+            created_to = now - timedelta(minutes=PAYMENT_RECONCILE_MIN_AGE_MIN)
+            semaphore = asyncio.Semaphore(PAYMENT_RECONCILE_CONCURRENCY)
+            summary = {
+                "scanned": 0, "pages": 0, "windows": 0, "succeeded": 0, "canceled": 0,
+                "queued": 0, "requeued": 0, "already_queued": 0, "dead_letter": 0, "yookassa_requests": 0, "failed_windows": 0,
+            }
+            windows = []
+            after = None
+
+            while True:
+                async with AsyncSessionLocal() as session:
+                    rows = (await session.execute(_pending_page_query(created_from, created_to, after, now))).all()
+                if not rows:
+                    break
+                after = (rows[-1].created_at, rows[-1].id)
+                summary["pages"] += 1
+                summary["scanned"] += len(rows)
+                for window_rows in _split_windows(rows):
+                    # Не больше PAYMENT_RECONCILE_CONCURRENCY окон в работе: при большом бэклоге страницы не копятся в памяти
+                    await semaphore.acquire()
+                    summary["windows"] += 1
+                    windows.append(asyncio.create_task(_run_window(window_rows, store_notification, semaphore, summary)))
+                if len(rows) < PAYMENT_RECONCILE_PAGE_SIZE:
+                    break
+            await asyncio.gather(*windows)
+
+            wall_time = time.monotonic() - started
+            summary["wall_time_sec"] = round(wall_time, 2)
+            metrics.observe_job(
+                "payment_reconcile", summary, wall_time,
+                outcomes=("scanned", "succeeded", "canceled", "queued", "requeued", "already_queued", "dead_letter", "failed_windows"),
+            )
+            logger.info(
+                f"Payment reconciliation finished. Pending scanned: {summary['scanned']} in {summary['pages']} pages "
+                f"({summary['windows']} windows), final in YooKassa: succeeded {summary['succeeded']}, canceled {summary['canceled']}; "
+                f"inbox: queued {summary['queued']}, requeued {summary['requeued']}, already queued {summary['already_queued']}, dead letter {summary['dead_letter']}; "
+                f"YooKassa requests: {summary['yookassa_requests']}, "
+                f"failed windows: {summary['failed_windows']}, wall time: {summary['wall_time_sec']} s."
+            )
+            return summary
+        finally:
+            await lock_conn.execute(text("SELECT pg_advisory_unlock(hashtextextended('payment_reconciler', 0))"))
@@ -0,0 +1,144 @@
+# Профилирование обработчиков и фоновых задач по запросу (включается переменной PROFILE_DIR).
+# Когда PROFILE_DIR не задан, maybe_profile() возвращает функцию без обертки — накладных расходов нет.
+#
+# Сбор:   PROFILE_DIR=/tmp/vpnbot-profiles PROFILE_SAMPLE_RATE=0.05 python my_telegram_bot.py
+# Отчет:  python profiling.py /tmp/vpnbot-profiles --top 30 [--name my_keys_handler] [--sort tottime]
+#
+# cProfile детерминированный и видит весь поток: пока профилируемый вызов ждет I/O, в профиль попадает
+# и работа других корутин. Поэтому одновременно профилируется один вызов, а в сводке вызова отдельно
+# указаны время на CPU и время ожидания (I/O панели, БД, Telegram).
+import argparse
+import asyncio
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import time
+from collections import defaultdict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROFILE_DIR = os.getenv("PROFILE_DIR") # Пусто — профилирование выключено
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01")) # Доля профилируемых вызовов обработчиков
+PROFILE_JOB_SAMPLE_RATE = float(os.getenv("PROFILE_JOB_SAMPLE_RATE", "1.0")) # Доля профилируемых запусков фоновых задач
+
+logger = logging.getLogger(__name__)
+
+_active = False # cProfile нельзя включать вложенно, профилируем один вызов за раз
+_sequence = 0
+
+
+def _write_profile(name: str, profiler: cProfile.Profile, summary: dict) -> None:
+    global _sequence
+    _sequence += 1
+    base = os.path.join(PROFILE_DIR, f"{name}-{int(time.time())}-{os.getpid()}-{_sequence}")
+    profiler.dump_stats(f"{base}.prof")
+    with open(f"{base}.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False)
+
+
+def maybe_profile(func, name: str | None = None, sample_rate: float | None = None):
+    """Оборачивает async-функцию профилировщиком, если профилирование включено; иначе возвращает ее как есть."""
+    if not PROFILE_DIR:
+        return func
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = name or func.__name__
+    rate = PROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        global _active
+        if _active or random.random() >= rate:
+            return await func(*args, **kwargs)
+        _active = True
+        profiler = cProfile.Profile()
+        tasks_at_start = len(asyncio.all_tasks())
+        started_wall = time.perf_counter()
+        started_cpu = time.process_time()
+        profiler.enable()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            _active = False
+            wall = time.perf_counter() - started_wall
+            cpu = time.process_time() - started_cpu
+            summary = {
+                "name": name,
+                "started_at": time.time() - wall,
+                "wall_sec": round(wall, 6),
+                "cpu_sec": round(cpu, 6),
+                "wait_sec": round(max(0.0, wall - cpu), 6), # Ожидание I/O и других корутин
+                "tasks_at_start": tasks_at_start,
+                "tasks_at_end": len(asyncio.all_tasks()),
+            }
+            try:
+                _write_profile(name, profiler, summary)
+            except OSError as e:
+                logger.error(f"Не удалось сохранить профиль {name}: {e}")
+
+    return wrapper
+
+
+def aggregate(profile_dir: str, name: str | None = None) -> tuple[pstats.Stats | None, dict]:
+    """Объединяет профили из каталога (при необходимости — только для одного обработчика/задачи)."""
+    stats = None
+    timings = defaultdict(lambda: {"calls": 0, "wall_sec": 0.0, "cpu_sec": 0.0, "wait_sec": 0.0, "max_wall_sec": 0.0})
+    for file_name in sorted(os.listdir(profile_dir)):
+        if not file_name.endswith(".json"):
+            continue
+        with open(os.path.join(profile_dir, file_name), encoding="utf-8") as f:
+            summary = json.load(f)
+        if name and summary["name"] != name:
+            continue
+        entry = timings[summary["name"]]
+        entry["calls"] += 1
+        entry["wall_sec"] += summary["wall_sec"]
+        entry["cpu_sec"] += summary["cpu_sec"]
+        entry["wait_sec"] += summary["wait_sec"]
+        entry["max_wall_sec"] = max(entry["max_wall_sec"], summary["wall_sec"])
+        prof_path = os.path.join(profile_dir, file_name[:-len(".json")] + ".prof")
+        if os.path.exists(prof_path):
+            if stats is None:
+                stats = pstats.Stats(prof_path, stream=sys.stdout)
+            else:
+                stats.add(prof_path)
+    return stats, dict(timings)
+
+
+def _main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Сводка по собранным профилям: самые горячие функции")
+    parser.add_argument("profile_dir", nargs="?", default=PROFILE_DIR)
+    parser.add_argument("--top", type=int, default=30)
+    parser.add_argument("--name", help="Только один обработчик/задача, например my_keys_handler")
+    parser.add_argument("--sort", default="cumulative", choices=["cumulative", "tottime", "ncalls"])
+    args = parser.parse_args(argv)
+    if not args.profile_dir or not os.path.isdir(args.profile_dir):
+        print("Каталог с профилями не найден (укажите его аргументом или через PROFILE_DIR).")
+        return 1
+
+    stats, timings = aggregate(args.profile_dir, args.name)
+    if not timings:
+        print("Профилей не найдено.")
+        return 1
+    print(f"{'вызов':<36}{'n':>6}{'wall ср., мс':>14}{'cpu ср., мс':>13}{'ожидание ср., мс':>18}{'wall max, мс':>14}")
+    for call_name, entry in sorted(timings.items(), key=lambda item: -item[1]["wall_sec"]):
+        calls = entry["calls"]
+        print(
+            f"{call_name:<36}{calls:>6}{entry['wall_sec'] / calls * 1000:>14.1f}{entry['cpu_sec'] / calls * 1000:>13.1f}"
+            f"{entry['wait_sec'] / calls * 1000:>18.1f}{entry['max_wall_sec'] * 1000:>14.1f}"
+        )
+    if stats:
+        print()
+        stats.strip_dirs().sort_stats(args.sort).print_stats(args.top)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -0,0 +1,205 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from dotenv import load_dotenv
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+from metrics import LatencyHistogram
+
+load_dotenv()
+
+# Лимиты Telegram Bot API: ~30 сообщений/с на бота и ~1 сообщение/с в один чат.
+# Бот и вебхук отправляют от одного токена, а лимитеры у них свои: TELEGRAM_GLOBAL_RATE_PER_SEC — доля бота,
+# TELEGRAM_WEBHOOK_GLOBAL_RATE_PER_SEC — доля вебхука (на все воркеры gunicorn); в сумме не больше 30.
+TELEGRAM_GLOBAL_RATE_PER_SEC = float(os.getenv("TELEGRAM_GLOBAL_RATE_PER_SEC", "25"))
+TELEGRAM_GLOBAL_BURST = int(os.getenv("TELEGRAM_GLOBAL_BURST", "25"))
+TELEGRAM_WEBHOOK_GLOBAL_RATE_PER_SEC = float(os.getenv("TELEGRAM_WEBHOOK_GLOBAL_RATE_PER_SEC", "4"))
+TELEGRAM_CHAT_RATE_PER_SEC = float(os.getenv("TELEGRAM_CHAT_RATE_PER_SEC", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3")) # Повторов после 429 (retry_after)
+# Больше — вытесняются давно не использованные чаты, чьи bucket уже полностью восстановились
+TELEGRAM_CHAT_BUCKETS_MAX_SIZE = int(os.getenv("TELEGRAM_CHAT_BUCKETS_MAX_SIZE", "10000"))
+
+# Приоритеты: меньше — раньше. Передаются через rate_limit_args={"priority": ...}
+PRIORITY_TRANSACTIONAL = 0 # Подтверждения оплаты и т.п.
+PRIORITY_INTERACTIVE = 1 # Ответы на действия пользователя (по умолчанию)
+PRIORITY_BULK = 2 # Рассылки и напоминания
+PRIORITY_NAMES = {PRIORITY_TRANSACTIONAL: "transactional", PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, burst: int):
+        self.rate = rate_per_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0 # Выставляется по retry_after
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 — доступен сейчас)."""
+        self._refill(now)
+        wait_blocked = max(0.0, self.blocked_until - now)
+        wait_tokens = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait_blocked, wait_tokens)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        """Bucket полон и не заблокирован — ничем не отличается от нового, его можно удалить."""
+        self._refill(now)
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Диспетчер исходящих запросов Bot API (подключается к Application/ExtBot как rate_limiter).
+    Глобальный и по-чатовый token bucket; ожидающие запросы получают разрешение в порядке приоритета,
+    при 429 соблюдается retry_after. Запросы идут через HTTP-сессию самого бота.
+    """
+
+    def __init__(self, global_rate_per_sec: float = TELEGRAM_GLOBAL_RATE_PER_SEC, global_burst: int = TELEGRAM_GLOBAL_BURST):
+        self.global_bucket = TokenBucket(global_rate_per_sec, global_burst)
+        # chat_id -> bucket в порядке последнего использования (LRU)
+        self.chat_buckets: OrderedDict[object, TokenBucket] = OrderedDict()
+        self._waiters: list[tuple[int, int, object, asyncio.Future]] = [] # (priority, seq, chat_id, future), отсортирован
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._scheduler_task: asyncio.Task | None = None
+        self.send_latency: dict[str, LatencyHistogram] = {}
+        self.retry_after_count = 0
+        self.sent_count = 0
+
+    async def initialize(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._scheduler_task = asyncio.create_task(self._scheduler())
+
+    async def shutdown(self) -> None:
+        if self._scheduler_task:
+            self._scheduler_task.cancel()
+            await asyncio.gather(self._scheduler_task, return_exceptions=True)
+            self._scheduler_task = None
+        for _, _, _, future in self._waiters:
+            if not future.done():
+                future.cancel()
+        self._waiters.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE_PER_SEC, TELEGRAM_CHAT_BURST)
+            self._evict_idle_chat_buckets()
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _evict_idle_chat_buckets(self) -> None:
+        # Удаляем только восстановившиеся bucket: новый для того же чата будет таким же, лимит не теряется
+        now = time.monotonic()
+        while len(self.chat_buckets) > TELEGRAM_CHAT_BUCKETS_MAX_SIZE:
+            chat_id, bucket = next(iter(self.chat_buckets.items()))
+            if not bucket.is_idle(now):
+                break # Самый давний еще не восстановился; остальные использовались позже — проверим при следующем новом чате
+            del self.chat_buckets[chat_id]
+
+    async def _scheduler(self) -> None:
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            # Первый по приоритету ожидающий, чей чат не упирается в лимит
+            next_ready_in = None
+            for index, (_, _, chat_id, future) in enumerate(self._waiters):
+                if future.done(): # Вызывающий отменил ожидание
+                    continue
+                chat_delay = self._chat_bucket(chat_id).delay(now) if chat_id is not None else 0.0
+                if chat_delay == 0:
+                    if chat_id is not None:
+                        self._chat_bucket(chat_id).take(now)
+                    self.global_bucket.take(now)
+                    future.set_result(None)
+                    del self._waiters[index]
+                    break
+                next_ready_in = chat_delay if next_ready_in is None else min(next_ready_in, chat_delay)
+            else:
+                self._waiters = [waiter for waiter in self._waiters if not waiter[3].done()]
+                if next_ready_in is None:
+                    continue
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=next_ready_in)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _acquire(self, chat_id, priority: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        waiter = (priority, next(self._seq), chat_id, future)
+        # Вставка с сохранением порядка (priority, seq)
+        index = len(self._waiters)
+        while index > 0 and self._waiters[index - 1][:2] > waiter[:2]:
+            index -= 1
+        self._waiters.insert(index, waiter)
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_INTERACTIVE)
+        chat_id = data.get("chat_id")
+        priority_name = PRIORITY_NAMES.get(priority, str(priority))
+        histogram = self.send_latency.setdefault(priority_name, metrics.telegram_send_duration.child(priority=priority_name))
+        started = time.monotonic()
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after_count += 1
+                metrics.errors.inc(component="telegram", cause="RetryAfter")
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                blocked_until = time.monotonic() + retry_after + 0.1
+                # retry_after без чата (или для всего бота) — притормаживаем все отправки
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.blocked_until = max(bucket.blocked_until, blocked_until)
+                logger.warning(f"Telegram 429 для {endpoint} (chat {chat_id}), retry_after={retry_after} с, попытка {attempt + 1}.")
+                if attempt >= TELEGRAM_MAX_RETRIES:
+                    raise
+                continue
+            self.sent_count += 1
+            histogram.observe(time.monotonic() - started)
+            return result
+
+    def snapshot(self) -> dict:
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _, future in self._waiters:
+            if not future.done():
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                depth[name] = depth.get(name, 0) + 1
+        return {
+            "queue_depth": depth,
+            "sent": self.sent_count,
+            "retry_after": self.retry_after_count,
+            "chat_buckets": len(self.chat_buckets),
+            "send_latency": {name: histogram.snapshot() for name, histogram in self.send_latency.items()},
+        }
@@ -0,0 +1,46 @@
+# Общие настройки тестов.
+#
+# Модули бота и вебхука читают настройки из окружения при импорте (и подхватывают .env), поэтому
+# окружение задается здесь, до первого импорта: тесты не должны ходить в рабочую БД, панель или Telegram.
+# Тесты с БД запускаются только при заданном TEST_DB_HOST (отдельная база, тесты создают в ней записи):
+#     TEST_DB_HOST=127.0.0.1 TEST_DB_PORT=5432 TEST_DB_USER=postgres TEST_DB_PASSWORD=... TEST_DB_NAME=vpnbot_test python -m pytest -q
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.update({
+    "DB_HOST": os.getenv("TEST_DB_HOST", "127.0.0.1"),
+    "DB_PORT": os.getenv("TEST_DB_PORT", "5432"),
+    "DB_USER": os.getenv("TEST_DB_USER", "postgres"),
+    "DB_PASSWORD": os.getenv("TEST_DB_PASSWORD", "postgres"),
+    "DB_NAME": os.getenv("TEST_DB_NAME", "vpnbot_test"),
+    "BOT_TOKEN": "",
+    "MARZBAN_PANEL_URL": "",
+    "MARZBAN_USERNAME": "",
+    "MARZBAN_PASSWORD": "",
+    "YOOKASSA_SHOP_ID": "",
+    "YOOKASSA_SECRET_KEY": "",
+    "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    "LOG_FORMAT": "text",
+})
+
+
+@pytest.fixture
+def run_db():
+    """Запускает корутину в своем event loop; пул соединений БД привязан к loop, поэтому закрывается в конце."""
+    import database
+
+    def run(coro_factory):
+        async def runner():
+            try:
+                return await coro_factory()
+            finally:
+                await database.async_engine.dispose()
+
+        return asyncio.run(runner())
+
+    return run
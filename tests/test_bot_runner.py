@@ -0,0 +1,84 @@
+import asyncio
+
+from telegram import CallbackQuery, Update, User
+
+from bot_runner import PerUserUpdateProcessor
+
+
+def make_update(update_id: int, telegram_id: int) -> Update:
+    user = User(id=telegram_id, first_name="test", is_bot=False)
+    return Update(update_id, callback_query=CallbackQuery(id=str(update_id), from_user=user, chat_instance="test"))
+
+
+def test_updates_of_one_user_run_in_order():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=8)
+        done = []
+
+        async def handle(update_id: int, delay: float):
+            await asyncio.sleep(delay)
+            done.append(update_id)
+
+        await asyncio.gather(*(
+            processor.process_update(make_update(update_id, 1), handle(update_id, delay))
+            for update_id, delay in ((1, 0.05), (2, 0.0), (3, 0.02))
+        ))
+        assert done == [1, 2, 3]
+        assert processor._user_locks == {} and processor._user_waiters == {}
+
+    asyncio.run(scenario())
+
+
+def test_queued_updates_of_one_user_do_not_hold_concurrency_slots():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2)
+        release_first = asyncio.Event()
+        done = []
+
+        async def slow(update_id: int):
+            await release_first.wait()
+            done.append(update_id)
+
+        async def fast(update_id: int):
+            done.append(update_id)
+
+        busy_user = [asyncio.create_task(processor.process_update(make_update(update_id, 1), slow(update_id))) for update_id in (1, 2, 3)]
+        await asyncio.sleep(0)
+        # Пользователь 1 занимает один слот из двух, его остальные апдейты ждут очереди без слота
+        assert processor.processing_updates == 1
+        await asyncio.wait_for(processor.process_update(make_update(4, 2), fast(4)), timeout=1)
+        assert done == [4]
+
+        release_first.set()
+        await asyncio.gather(*busy_user)
+        assert done == [4, 1, 2, 3]
+
+    asyncio.run(scenario())
+
+
+def test_updates_without_user_are_not_serialized():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=4)
+        running = 0
+        peak = 0
+
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(object(), handle()) for _ in range(3)))
+        assert peak == 3
+
+    asyncio.run(scenario())
+
+
+def test_base_process_update_is_kept():
+    from telegram.ext import BaseUpdateProcessor
+
+    # process_update в PTB помечен @final и владеет своим семафором; очередь пользователя — в do_process_update
+    assert PerUserUpdateProcessor.process_update is BaseUpdateProcessor.process_update
+    processor = PerUserUpdateProcessor(max_concurrent_updates=4, max_pending_updates=100)
+    assert (processor.max_concurrent_updates, processor.max_processing_updates) == (100, 4)
@@ -0,0 +1,106 @@
+# MarzbanTokenManager: один логин на всех, повтор после 401 и ограниченный прогрев.
+import asyncio
+import base64
+import json
+import time
+
+import pytest
+
+from marzban_auth import MarzbanTokenError, MarzbanTokenManager, decode_jwt_expiry
+
+
+def make_token(expires_in: float) -> dict:
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": int(time.time() + expires_in)}).encode()).decode().rstrip("=")
+    return {"access_token": f"header.{payload}.signature", "token_type": "bearer"}
+
+
+class Unauthorized(Exception):
+    status = 401
+
+
+def test_concurrent_callers_share_one_login():
+    logins = []
+
+    async def login():
+        logins.append(1)
+        await asyncio.sleep(0.05)
+        return make_token(3600)
+
+    async def scenario():
+        tokens = MarzbanTokenManager(login)
+        results = await asyncio.gather(*(tokens.get_token() for _ in range(10)))
+        assert all(result is results[0] for result in results)
+        assert await tokens.get_token() is results[0] # Свежий токен берется без логина
+
+    asyncio.run(scenario())
+    assert len(logins) == 1
+
+
+def test_token_is_refreshed_before_expiry():
+    logins = []
+
+    async def login():
+        logins.append(1)
+        return make_token(30) # Меньше MARZBAN_TOKEN_REFRESH_MARGIN_SEC — считается истекающим
+
+    async def scenario():
+        tokens = MarzbanTokenManager(login)
+        await tokens.get_token()
+        await tokens.get_token()
+
+    asyncio.run(scenario())
+    assert len(logins) == 2
+    assert decode_jwt_expiry(make_token(60)) == pytest.approx(time.time() + 60, abs=2)
+
+
+def test_call_refreshes_token_once_after_401():
+    issued = []
+
+    async def login():
+        issued.append(make_token(3600))
+        return issued[-1]
+
+    async def scenario():
+        tokens = MarzbanTokenManager(login)
+        seen = []
+
+        async def operation(token):
+            seen.append(token)
+            if len(seen) == 1:
+                raise Unauthorized("401 Unauthorized")
+            return "ok"
+
+        assert await tokens.call(operation) == "ok"
+        assert seen == issued # Повтор ушел с новым токеном
+
+        async def always_401(token):
+            raise Unauthorized("401 Unauthorized")
+
+        with pytest.raises(Unauthorized):
+            await tokens.call(always_401) # Повторяется один раз, дальше ошибка уходит вызывающему
+
+    asyncio.run(scenario())
+    assert len(issued) == 3
+
+
+def test_failed_login_raises_token_error():
+    async def login():
+        raise OSError("connection refused")
+
+    async def operation(token):
+        return "unreachable"
+
+    with pytest.raises(MarzbanTokenError):
+        asyncio.run(MarzbanTokenManager(login).call(operation))
+
+
+def test_warm_up_gives_up_after_timeout():
+    async def hanging_login():
+        await asyncio.sleep(10)
+
+    async def scenario():
+        started = time.monotonic()
+        assert await MarzbanTokenManager(hanging_login).warm_up(timeout_sec=0.1) is False
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 1
@@ -0,0 +1,97 @@
+# MarzbanUserCache: single-flight, TTL, LRU и инвалидация во время запроса.
+import asyncio
+
+from marzban_cache import MarzbanUserCache
+
+
+def test_concurrent_misses_share_one_fetch():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"username": "alice"}
+
+    async def scenario():
+        cache = MarzbanUserCache(ttl_sec=60, max_size=10)
+        results = await asyncio.gather(*(cache.get("alice", fetch) for _ in range(5)))
+        assert all(result == {"username": "alice"} for result in results)
+        assert await cache.get("alice", fetch) == {"username": "alice"}
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert (stats["misses"], stats["coalesced"], stats["hits"]) == (1, 4, 1)
+
+
+def test_fetch_error_is_shared_and_not_cached():
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise OSError("panel down")
+
+    async def scenario():
+        cache = MarzbanUserCache(ttl_sec=60, max_size=10)
+        results = await asyncio.gather(*(cache.get("bob", failing) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, OSError) for result in results)
+        assert len(calls) == 1
+        # Ошибка не кэшируется: следующий запрос снова идет в панель
+        await asyncio.gather(cache.get("bob", failing), return_exceptions=True)
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_expired_entries_are_refetched_and_lru_is_bounded():
+    fetched = []
+
+    def fetch_for(username):
+        async def fetch():
+            fetched.append(username)
+            return {"username": username}
+        return fetch
+
+    async def scenario():
+        cache = MarzbanUserCache(ttl_sec=0, max_size=10)
+        await cache.get("carol", fetch_for("carol"))
+        await cache.get("carol", fetch_for("carol")) # TTL 0 — запись сразу устарела
+        assert fetched == ["carol", "carol"]
+
+        cache = MarzbanUserCache(ttl_sec=60, max_size=2)
+        for username in ("a", "b"):
+            await cache.get(username, fetch_for(username))
+        await cache.get("a", fetch_for("a")) # "a" становится самой свежей
+        await cache.get("c", fetch_for("c")) # вытесняет "b"
+        assert cache.stats()["evictions"] == 1
+        fetched.clear()
+        await cache.get("a", fetch_for("a"))
+        await cache.get("b", fetch_for("b"))
+        assert fetched == ["b"]
+
+    asyncio.run(scenario())
+
+
+def test_invalidation_during_fetch_drops_the_stale_answer():
+    async def scenario():
+        cache = MarzbanUserCache(ttl_sec=60, max_size=10)
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_fetch():
+            started.set()
+            await release.wait()
+            return {"username": "dave", "expire": 1}
+
+        pending = asyncio.create_task(cache.get("dave", slow_fetch))
+        await started.wait()
+        cache.invalidate("dave") # Вебхук продлил подписку, пока шел запрос
+        release.set()
+        assert (await pending)["expire"] == 1
+
+        async def fresh_fetch():
+            return {"username": "dave", "expire": 2}
+
+        assert (await cache.get("dave", fresh_fetch))["expire"] == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,50 @@
+# report_marzban_drift: сравнение снимка панели с подписками в БД по страницам (TEST_DB_*, см. conftest.py).
+import os
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import delete
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_DB_HOST"), reason="нужна тестовая Postgres (TEST_DB_HOST)")
+
+
+def test_drift_is_found_across_keyset_pages(monkeypatch, run_db):
+    import database
+    import migrations
+    import my_telegram_bot
+    from database import AsyncSessionLocal, User, VpnKey
+
+    monkeypatch.setattr(my_telegram_bot, "MARZBAN_SNAPSHOT_PAGE_SIZE", 2) # Несколько страниц даже на пяти подписках
+    prefix = f"drift_test_{random.getrandbits(32)}_"
+
+    async def scenario():
+        await database.create_db_tables()
+        await migrations.apply_migrations()
+        async with AsyncSessionLocal() as session:
+            user = User(telegram_id=random.randint(1, 2**31 - 1), username="drift_test")
+            session.add(user)
+            await session.flush()
+            user_id = user.id
+            for index in range(5):
+                session.add(VpnKey(
+                    marzban_username=f"{prefix}{index}", subscription_url="/sub", user_id=user_id,
+                    is_active=index != 4, expires_at=datetime.utcnow() + timedelta(days=1),
+                ))
+            await session.commit()
+        try:
+            # В панели нет подписок 3 (активна) и 4 (неактивна), зато есть неизвестный нам пользователь
+            snapshot = {f"{prefix}{index}": ("active", 0) for index in range(3)}
+            snapshot[f"{prefix}ghost"] = ("active", 0)
+            async with AsyncSessionLocal() as session:
+                summary = await my_telegram_bot.report_marzban_drift(session, snapshot)
+            assert summary["panel_unknown"] == 1
+            # В тестовой базе могут быть чужие активные подписки, которых нет в снимке
+            assert summary["db_missing_in_panel"] >= 1
+        finally:
+            async with AsyncSessionLocal() as session:
+                await session.execute(delete(VpnKey).where(VpnKey.user_id == user_id))
+                await session.execute(delete(User).where(User.id == user_id))
+                await session.commit()
+
+    run_db(scenario)
@@ -0,0 +1,136 @@
+import asyncio
+
+import aiohttp
+import pytest
+from multidict import CIMultiDictProxy, CIMultiDict
+from yarl import URL
+
+import marzban_resilience
+from marzban_auth import MarzbanTokenManager
+from marzban_resilience import CircuitBreaker, MarzbanUnavailableError, ResilientMarzbanCaller
+
+
+def make_caller(login, monkeypatch, threshold: int = 2) -> ResilientMarzbanCaller:
+    monkeypatch.setattr(marzban_resilience, "MARZBAN_RETRY_BASE_DELAY_SEC", 0.0)
+    caller = ResilientMarzbanCaller(MarzbanTokenManager(login), name="test")
+    caller.breaker = CircuitBreaker(failure_threshold=threshold, reset_sec=0.05, name="test")
+    return caller
+
+
+def http_error(status: int) -> aiohttp.ClientResponseError:
+    url = URL("http://panel/api/user/test")
+    request_info = aiohttp.RequestInfo(url, "GET", CIMultiDictProxy(CIMultiDict()), url)
+    return aiohttp.ClientResponseError(request_info, (), status=status)
+
+
+async def good_login():
+    return {"access_token": "token", "token_type": "bearer"}
+
+
+def test_breaker_opens_after_consecutive_outage_errors_and_recovers(monkeypatch):
+    async def scenario():
+        caller = make_caller(good_login, monkeypatch, threshold=3)
+
+        async def unavailable(token):
+            raise aiohttp.ServerDisconnectedError()
+
+        with pytest.raises(aiohttp.ServerDisconnectedError):
+            await caller.call("get_user", unavailable) # 3 попытки — 3 сбоя подряд
+        assert caller.breaker.state == "open"
+        with pytest.raises(MarzbanUnavailableError):
+            await caller.call("get_user", unavailable)
+
+        await asyncio.sleep(0.06)
+
+        async def ok(token):
+            return "user"
+
+        assert await caller.call("get_user", ok) == "user" # Проба half-open прошла
+        assert caller.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_not_found_does_not_count_as_outage(monkeypatch):
+    async def scenario():
+        caller = make_caller(good_login, monkeypatch, threshold=1)
+
+        async def not_found(token):
+            raise http_error(404)
+
+        with pytest.raises(aiohttp.ClientResponseError):
+            await caller.call("get_user", not_found)
+        assert caller.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_probe_is_released(monkeypatch):
+    async def scenario():
+        caller = make_caller(good_login, monkeypatch)
+        caller.breaker.state, caller.breaker.opened_at = "open", 0.0
+        started = asyncio.Event()
+
+        async def hangs(token):
+            started.set()
+            await asyncio.sleep(10)
+
+        probe = asyncio.create_task(caller.call("get_user", hangs))
+        await started.wait()
+        assert caller.breaker.state == "half_open"
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        async def ok(token):
+            return "user"
+
+        # Без сброса флага пробы этот вызов получил бы MarzbanUnavailableError навсегда
+        assert await caller.call("get_user", ok) == "user"
+        assert caller.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_token_failure_counts_as_outage_and_is_reported_as_unavailable(monkeypatch):
+    async def scenario():
+        logins = 0
+
+        async def failing_login():
+            nonlocal logins
+            logins += 1
+            raise OSError("connection refused")
+
+        caller = make_caller(failing_login, monkeypatch)
+
+        async def never_called(token):
+            raise AssertionError("операция без токена не выполняется")
+
+        for _ in range(2):
+            with pytest.raises(MarzbanUnavailableError):
+                await caller.call("get_user", never_called)
+        assert caller.breaker.state == "open"
+        with pytest.raises(MarzbanUnavailableError):
+            await caller.call("get_user", never_called)
+        assert logins == 2 # Разомкнутый breaker не пускает к логину
+
+    asyncio.run(scenario())
+
+
+def test_hanging_login_is_bounded_by_operation_timeout(monkeypatch):
+    async def scenario():
+        async def hanging_login():
+            await asyncio.sleep(10)
+
+        monkeypatch.setenv("MARZBAN_TIMEOUT_GET_USER_SEC", "0.05")
+        monkeypatch.setattr(marzban_resilience, "MARZBAN_RETRY_ATTEMPTS", 1)
+        caller = make_caller(hanging_login, monkeypatch, threshold=1)
+
+        async def ok(token):
+            return "user"
+
+        with pytest.raises(asyncio.TimeoutError):
+            await caller.call("get_user", ok)
+        assert caller.breaker.state == "open"
+
+    asyncio.run(scenario())
@@ -0,0 +1,107 @@
+# metrics: текстовый формат Prometheus, observe_handler и observe_job.
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Свой реестр на тест: тестовые метрики не попадают в /metrics процесса и в другие тесты."""
+    monkeypatch.setattr(metrics, "_registry", [])
+    monkeypatch.setattr(metrics, "_collect_hooks", [])
+    return metrics._registry
+
+
+def test_counter_and_gauge_exposition(registry):
+    sends = metrics.Counter("test_sends", "Test sends", ("chat", "note"))
+    sends.inc(chat=1, note='say "hi"\n')
+    sends.inc(2, chat=1, note='say "hi"\n')
+    queue = metrics.Gauge("test_queue", "Test queue depth")
+    queue.set(7)
+
+    lines = metrics.render_metrics().splitlines()
+    assert lines == [
+        "# HELP vpnbot_test_sends_total Test sends",
+        "# TYPE vpnbot_test_sends_total counter",
+        'vpnbot_test_sends_total{chat="1",note="say \\"hi\\"\\n"} 3',
+        "# HELP vpnbot_test_queue Test queue depth",
+        "# TYPE vpnbot_test_queue gauge",
+        "vpnbot_test_queue 7",
+    ]
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    latency = metrics.Histogram("test_latency_seconds", "Test latency", ("op",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value, op="get")
+
+    lines = metrics.render_metrics().splitlines()
+    assert lines[1] == "# TYPE vpnbot_test_latency_seconds histogram"
+    assert lines[2:] == [
+        'vpnbot_test_latency_seconds_bucket{op="get",le="0.1"} 2', # Граница входит в корзину (le)
+        'vpnbot_test_latency_seconds_bucket{op="get",le="1.0"} 3',
+        'vpnbot_test_latency_seconds_bucket{op="get",le="+Inf"} 4',
+        'vpnbot_test_latency_seconds_sum{op="get"} 3.65',
+        'vpnbot_test_latency_seconds_count{op="get"} 4',
+    ]
+
+
+def test_failing_collect_hook_does_not_break_exposition(registry):
+    gauge = metrics.Gauge("test_pool", "Test pool", ("state",))
+    metrics.on_collect(lambda: 1 / 0)
+    metrics.on_collect(lambda: gauge.set(3, state="idle"))
+    assert 'vpnbot_test_pool{state="idle"} 3' in metrics.render_metrics()
+
+
+def test_observe_handler_records_latency_and_errors(monkeypatch):
+    monkeypatch.setattr(metrics.handler_duration, "children", {})
+    monkeypatch.setattr(metrics.errors, "children", {})
+
+    @metrics.observe_handler
+    async def ok_handler():
+        return "done"
+
+    @metrics.observe_handler
+    async def broken_handler():
+        raise KeyError("x")
+
+    assert asyncio.run(ok_handler()) == "done"
+    with pytest.raises(KeyError):
+        asyncio.run(broken_handler())
+
+    assert broken_handler.__name__ == "broken_handler"
+    assert metrics.handler_duration.child(handler="ok_handler").count == 1
+    assert metrics.handler_duration.child(handler="broken_handler").count == 1
+    assert metrics.errors.children == {("broken_handler", "KeyError"): 1}
+
+
+def test_observe_job_counts_only_nonzero_outcomes(monkeypatch):
+    monkeypatch.setattr(metrics.scheduler_job_duration, "children", {})
+    monkeypatch.setattr(metrics.scheduler_rows, "children", {})
+
+    metrics.observe_job("sweep", {"scanned": 10, "deactivated": 0, "other": 5}, 2.0, outcomes=("scanned", "deactivated", "missing"))
+    metrics.observe_job("sweep", None, 1.0, outcomes=("scanned",)) # Запуск пропущен — только длительность
+
+    assert metrics.scheduler_rows.children == {("sweep", "scanned"): 10}
+    histogram = metrics.scheduler_job_duration.child(job="sweep")
+    assert (histogram.count, histogram.total) == (2, 3.0)
+
+
+def test_metrics_route_serves_text_format(registry):
+    metrics.Counter("test_requests", "Test requests").inc()
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/metrics", metrics.metrics_route)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get("/metrics")
+            return response.status, response.headers["Content-Type"], await response.text()
+
+    status, content_type, body = asyncio.run(scenario())
+    assert status == 200
+    assert content_type.startswith("text/plain")
+    assert "vpnbot_test_requests_total 1" in body
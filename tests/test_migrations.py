@@ -0,0 +1,67 @@
+# apply_migrations и планы горячих запросов на настоящей Postgres (TEST_DB_*, см. conftest.py).
+import asyncio
+import os
+import random
+
+import pytest
+from sqlalchemy import text
+
+import migrations
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_DB_HOST"), reason="нужна тестовая Postgres (TEST_DB_HOST)")
+
+
+def test_concurrent_starts_apply_each_migration_once(monkeypatch, run_db):
+    import database
+    import migrations
+
+    version = random.randint(100_000, 2**31 - 1)
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS + [(version, "test", ["SELECT pg_sleep(0.3)"])])
+
+    async def scenario():
+        await database.create_db_tables()
+        try:
+            results = await asyncio.gather(*(migrations.apply_migrations() for _ in range(3)))
+            # Миграцию применил ровно один запуск, остальные дождались его и увидели ее примененной
+            assert sorted(results) == [[], [], [version]]
+        finally:
+            async with database.async_engine.begin() as conn:
+                await conn.execute(text("DELETE FROM schema_migrations WHERE version = :version"), {"version": version})
+
+    run_db(scenario)
+
+
+# Данные, похожие на рабочие: на почти пустых таблицах планировщик берет самый узкий индекс, и проверка ничего не говорит
+SEED_SQL = [
+    "INSERT INTO users (telegram_id, username) SELECT -g, 'plan_test' FROM generate_series(1, 5000) g",
+    "INSERT INTO vpn_keys (marzban_username, subscription_url, name, is_trial, user_id, created_at, expires_at, is_active) "
+    "SELECT 'plan_test_' || g, '/sub', 'plan_test', g <= 5000 AND g % 5 = 0, u.id, now(), now() + ((g % 60) - 30) * interval '1 day', g % 3 = 0 "
+    "FROM generate_series(1, 50000) g JOIN users u ON u.telegram_id = -((g % 5000) + 1)",
+    "INSERT INTO payments (user_id, yookassa_payment_id, amount, currency, status, purchase_key, confirmation_expires_at, created_at) "
+    "SELECT u.id, 'plan_test_' || g, 100, 'RUB', (ARRAY['succeeded', 'succeeded', 'succeeded', 'canceled', 'pending'])[g % 5 + 1], "
+    "'extend_plan_test_' || (g % 3), now() + ((g % 120) - 60) * interval '1 minute', now() - (g % 10000) * interval '1 minute' "
+    "FROM generate_series(1, 50000) g JOIN users u ON u.telegram_id = -((g % 5000) + 1)",
+    "ANALYZE users",
+    "ANALYZE vpn_keys",
+    "ANALYZE payments",
+]
+
+
+def test_hot_queries_use_expected_indexes(run_db):
+    import database
+
+    async def scenario():
+        await database.create_db_tables()
+        await migrations.apply_migrations()
+        async with database.async_engine.connect() as conn:
+            try:
+                for statement in SEED_SQL:
+                    await conn.execute(text(statement))
+                return await migrations.explain_hot_queries(conn)
+            finally:
+                await conn.rollback() # Данные и статистика ANALYZE откатываются вместе с транзакцией
+
+    results = run_db(scenario)
+    assert [result["query"] for result in results] == [description for description, _, _ in migrations.HOT_QUERIES]
+    for result in results:
+        assert result["uses_expected_index"], f"{result['query']}: ожидается {result['expected_index']}\n{result['plan']}"
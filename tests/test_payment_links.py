@@ -0,0 +1,83 @@
+# Повторная выдача ссылки на оплату (initiate_yookassa_payment) на настоящей Postgres (TEST_DB_*, см. conftest.py).
+import os
+import random
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete, update
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_DB_HOST"), reason="нужна тестовая Postgres (TEST_DB_HOST)")
+
+
+class FakeYooKassa:
+    """По одному Idempotence-Key возвращает один и тот же pending-платеж, как YooKassa."""
+
+    def __init__(self):
+        self.by_key = {}
+        self.create_calls = 0
+
+    async def create_payment(self, payload: dict, idempotency_key: str) -> dict:
+        self.create_calls += 1
+        payment_id = self.by_key.setdefault(idempotency_key, f"link_test_{random.getrandbits(48)}")
+        return {"id": payment_id, "status": "pending", "confirmation": {"confirmation_url": f"https://pay.test/{payment_id}"}}
+
+
+class FakeBot:
+    username = "test_bot"
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append(text)
+
+
+def test_expired_link_of_the_same_pending_payment_is_refreshed(monkeypatch, run_db):
+    import database
+    import migrations
+    import my_telegram_bot
+    from database import AsyncSessionLocal, Payment, User
+
+    fake = FakeYooKassa()
+    monkeypatch.setattr(my_telegram_bot, "yookassa_client", fake)
+    monkeypatch.setattr(my_telegram_bot, "YOOKASSA_SHOP_ID", "shop")
+    monkeypatch.setattr(my_telegram_bot, "YOOKASSA_SECRET_KEY", "secret")
+    telegram_id = random.randint(1, 2**31 - 1)
+    update_tg = SimpleNamespace(effective_user=SimpleNamespace(id=telegram_id), callback_query=None, message=SimpleNamespace(chat_id=telegram_id))
+    context = SimpleNamespace(bot=FakeBot())
+
+    async def pay(user_id):
+        async with AsyncSessionLocal() as session:
+            await my_telegram_bot.initiate_yookassa_payment(update_tg, context, session, user_id, 1, 30)
+
+    async def scenario():
+        await database.create_db_tables()
+        await migrations.apply_migrations()
+        async with AsyncSessionLocal() as session:
+            user = User(telegram_id=telegram_id, username="link_test")
+            session.add(user)
+            await session.commit()
+            user_id = user.id
+        try:
+            await pay(user_id)
+            # Сохраненный срок ссылки истек, а платеж в YooKassa все еще pending
+            async with AsyncSessionLocal() as session:
+                await session.execute(update(Payment).where(Payment.user_id == user_id).values(confirmation_expires_at=datetime.utcnow() - timedelta(minutes=1)))
+                await session.commit()
+            await pay(user_id) # YooKassa вернула тот же платеж — срок обновлен
+            await pay(user_id) # Ссылка снова живая, YooKassa не вызывается
+            assert fake.create_calls == 2
+
+            async with AsyncSessionLocal() as session:
+                payments = (await session.execute(Payment.__table__.select().where(Payment.user_id == user_id))).all()
+            assert len(payments) == 1
+            assert payments[0].confirmation_expires_at > datetime.utcnow()
+            assert len(set(context.bot.messages)) == 1
+        finally:
+            async with AsyncSessionLocal() as session:
+                await session.execute(delete(Payment).where(Payment.user_id == user_id))
+                await session.execute(delete(User).where(User.id == user_id))
+                await session.commit()
+
+    run_db(scenario)
@@ -0,0 +1,194 @@
+# Сверка платежей: окна и выбор запросов — на заглушке клиента YooKassa; запуск целиком — на тестовой Postgres.
+import asyncio
+import json
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete
+
+import payment_reconciler
+
+needs_db = pytest.mark.skipif(not os.getenv("TEST_DB_HOST"), reason="нужна тестовая Postgres (TEST_DB_HOST)")
+
+
+class FakeYooKassa:
+    """Отвечает на get_payment/list_payments по словарю платежей и считает запросы в полете."""
+
+    def __init__(self, payments: dict[str, dict]):
+        self.payments = payments
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def _call(self, name: str):
+        self.calls.append(name)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+
+    async def get_payment(self, payment_id: str) -> dict:
+        await self._call("get_payment")
+        return self.payments[payment_id]
+
+    async def list_payments(self, **params) -> dict:
+        await self._call("list_payments")
+        return {"type": "list", "items": [payment for payment in self.payments.values() if payment["status"] == params["status"]]}
+
+
+def make_rows(start: datetime, minutes: list[int]):
+    return [
+        SimpleNamespace(id=index, yookassa_payment_id=f"yk-{index}", created_at=start + timedelta(minutes=offset))
+        for index, offset in enumerate(minutes)
+    ]
+
+
+def test_page_is_split_into_bounded_windows(monkeypatch):
+    monkeypatch.setattr(payment_reconciler, "PAYMENT_RECONCILE_MAX_WINDOW_MIN", 60)
+    rows = make_rows(datetime(2026, 1, 1), [0, 30, 60, 61, 200, 5000])
+    windows = payment_reconciler._split_windows(rows)
+    assert [[row.id for row in window] for window in windows] == [[0, 1, 2], [3], [4], [5]]
+    for window in windows:
+        assert window[-1].created_at - window[0].created_at <= timedelta(minutes=60)
+
+
+def test_sparse_window_uses_get_per_payment(monkeypatch):
+    rows = make_rows(datetime(2026, 1, 1), [0, 1, 2])
+    fake = FakeYooKassa({
+        "yk-0": {"id": "yk-0", "status": "succeeded"},
+        "yk-1": {"id": "yk-1", "status": "pending"},
+        "yk-2": {"id": "yk-2", "status": "canceled"},
+    })
+    monkeypatch.setattr(payment_reconciler, "yookassa_client", fake)
+    monkeypatch.setattr(payment_reconciler, "PAYMENT_RECONCILE_LIST_MIN_PAYMENTS", 10)
+    outcomes = iter(["queued", "requeued"])
+    stored = []
+
+    async def store(notification):
+        stored.append(notification)
+        return next(outcomes)
+
+    summary = {key: 0 for key in ("succeeded", "canceled", "queued", "requeued", "already_queued", "yookassa_requests", "failed_windows")}
+    asyncio.run(payment_reconciler._reconcile_window(rows, store, summary))
+
+    assert fake.calls == ["get_payment"] * 3
+    assert [notification["event"] for notification in stored] == ["payment.succeeded", "payment.canceled"]
+    assert summary["yookassa_requests"] == 3
+    assert (summary["succeeded"], summary["canceled"], summary["queued"], summary["requeued"]) == (1, 1, 1, 1)
+
+
+def test_dense_window_lists_statuses_one_at_a_time(monkeypatch):
+    rows = make_rows(datetime(2026, 1, 1), [0, 1, 2])
+    payments = {f"yk-{index}": {"id": f"yk-{index}", "status": "succeeded"} for index in range(3)}
+    payments["foreign"] = {"id": "foreign", "status": "succeeded"} # Платеж магазина, которого нет среди наших pending
+    fake = FakeYooKassa(payments)
+    monkeypatch.setattr(payment_reconciler, "yookassa_client", fake)
+    monkeypatch.setattr(payment_reconciler, "PAYMENT_RECONCILE_LIST_MIN_PAYMENTS", 3)
+
+    async def store(notification):
+        return None
+
+    summary = {key: 0 for key in ("succeeded", "canceled", "queued", "requeued", "already_queued", "yookassa_requests", "failed_windows")}
+    asyncio.run(payment_reconciler._reconcile_window(rows, store, summary))
+
+    assert fake.calls == ["list_payments", "list_payments"]
+    assert fake.max_in_flight == 1
+    assert summary["succeeded"] == 3
+    assert summary["already_queued"] == 3
+
+
+class Payments:
+    """Наши платежи в тестовой БД: pending, processing с истекшей арендой и processing с живой арендой."""
+
+    async def create(self):
+        from database import AsyncSessionLocal, Payment, User
+
+        created_at = datetime.utcnow() - timedelta(hours=1)
+        async with AsyncSessionLocal() as session:
+            user = User(telegram_id=random.randint(1, 2**31 - 1), username="test")
+            session.add(user)
+            await session.flush()
+            self.user_id = user.id
+            self.payments = {}
+            for name, status, claimed_until in (
+                ("pending", "pending", None),
+                ("stale", "processing", datetime.utcnow() - timedelta(minutes=1)),
+                ("leased", "processing", datetime.utcnow() + timedelta(minutes=5)),
+            ):
+                payment = Payment(
+                    user_id=user.id, yookassa_payment_id=str(uuid.uuid4()), amount=100, currency="RUB", status=status,
+                    claimed_until=claimed_until, additional_data=json.dumps({}), created_at=created_at,
+                )
+                session.add(payment)
+                self.payments[name] = payment
+            await session.commit()
+
+    async def cleanup(self):
+        from database import AsyncSessionLocal, Payment, User, WebhookInbox
+
+        ids = [payment.yookassa_payment_id for payment in self.payments.values()]
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(WebhookInbox).where(WebhookInbox.yookassa_payment_id.in_(ids)))
+            await session.execute(delete(Payment).where(Payment.user_id == self.user_id))
+            await session.execute(delete(User).where(User.id == self.user_id))
+            await session.commit()
+
+
+@needs_db
+def test_reconcile_requeues_done_rows_and_keeps_failed_rows_terminal(monkeypatch, run_db):
+    import database
+    import migrations
+    import webhook_listener
+    from database import AsyncSessionLocal, WebhookInbox
+
+    async def scenario():
+        await database.create_db_tables()
+        await migrations.apply_migrations()
+        our = Payments()
+        await our.create()
+        try:
+            fake = FakeYooKassa({
+                payment.yookassa_payment_id: {"id": payment.yookassa_payment_id, "status": "succeeded"}
+                for payment in our.payments.values()
+            })
+            monkeypatch.setattr(payment_reconciler, "yookassa_client", fake)
+            # Уведомление по pending-платежу уже было обработано, но платеж так и не проведен;
+            # по платежу с истекшей арендой уведомление исчерпало попытки и ушло в failed
+            pending_id = our.payments["pending"].yookassa_payment_id
+            stale_id = our.payments["stale"].yookassa_payment_id
+            async with AsyncSessionLocal() as session:
+                session.add(WebhookInbox(
+                    yookassa_payment_id=pending_id, event="payment.succeeded", payload="{}", status="done",
+                    attempts=1, next_attempt_at=datetime.utcnow(), processed_at=datetime.utcnow(),
+                ))
+                session.add(WebhookInbox(
+                    yookassa_payment_id=stale_id, event="payment.succeeded", payload="{}", status="failed",
+                    attempts=10, next_attempt_at=datetime.utcnow(), last_error="marzban down",
+                ))
+                await session.commit()
+
+            summary = await payment_reconciler.reconcile_pending_payments(webhook_listener.requeue_notification_in_inbox)
+            # В тестовой базе могут быть чужие платежи, поэтому проверяем по своим записям inbox
+            assert summary["requeued"] >= 1 and summary["dead_letter"] >= 1
+
+            ids = [payment.yookassa_payment_id for payment in our.payments.values()]
+            async with AsyncSessionLocal() as session:
+                rows = {
+                    item.yookassa_payment_id: item
+                    for item in (await session.execute(WebhookInbox.__table__.select().where(WebhookInbox.yookassa_payment_id.in_(ids)))).all()
+                }
+            assert rows[pending_id].status == "pending" and rows[pending_id].attempts == 0
+            assert rows[stale_id].status == "failed" and rows[stale_id].attempts == 10 # Не повторяется по кругу
+            assert our.payments["leased"].yookassa_payment_id not in rows # Аренда жива — платеж еще проводится
+
+            # Повторный запуск не трогает записи, которые и так ждут обработки
+            again = await payment_reconciler.reconcile_pending_payments(webhook_listener.requeue_notification_in_inbox)
+            assert again["queued"] == again["requeued"] == 0
+        finally:
+            await our.cleanup()
+
+    run_db(scenario)
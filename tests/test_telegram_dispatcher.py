@@ -0,0 +1,56 @@
+# PriorityRateLimiter: вытеснение bucket чатов и порядок выдачи разрешений.
+import asyncio
+import time
+
+import telegram_dispatcher
+from telegram_dispatcher import PRIORITY_BULK, PRIORITY_TRANSACTIONAL, PriorityRateLimiter
+
+
+def test_idle_chat_buckets_are_evicted(monkeypatch):
+    monkeypatch.setattr(telegram_dispatcher, "TELEGRAM_CHAT_BUCKETS_MAX_SIZE", 2)
+    limiter = PriorityRateLimiter()
+    now = time.monotonic()
+    for chat_id in (1, 2):
+        limiter._chat_bucket(chat_id)
+    limiter._chat_bucket(1) # Чат 1 использовался позже чата 2
+
+    limiter._chat_bucket(3)
+    assert list(limiter.chat_buckets) == [1, 3]
+
+    # Bucket, который еще восстанавливается, не вытесняется: его лимит потерялся бы
+    limiter._chat_bucket(1).take(now)
+    limiter._chat_bucket(3) # 1 снова самый давний
+    limiter._chat_bucket(4)
+    assert 1 in limiter.chat_buckets
+    assert list(limiter.chat_buckets)[-1] == 4
+
+
+def test_higher_priority_waiters_are_served_first():
+    sent = []
+
+    async def record(name):
+        sent.append(name)
+
+    async def scenario():
+        # Токен раз в 50 мс: все запросы успевают встать в очередь до первого разрешения
+        limiter = PriorityRateLimiter(global_rate_per_sec=20, global_burst=1)
+        limiter.global_bucket.tokens = 0
+        await limiter.initialize()
+        try:
+            async def send(name, priority):
+                await limiter.process_request(record, (name,), {}, "sendMessage", {"chat_id": None}, {"priority": priority})
+
+            tasks = [asyncio.create_task(send(f"bulk{index}", PRIORITY_BULK)) for index in range(3)]
+            tasks.append(asyncio.create_task(send("payment", PRIORITY_TRANSACTIONAL)))
+            await asyncio.gather(*tasks)
+        finally:
+            await limiter.shutdown()
+
+    asyncio.run(scenario())
+    assert sent == ["payment", "bulk0", "bulk1", "bulk2"]
+
+
+def test_webhook_gets_its_own_share_of_the_global_limit():
+    limiter = PriorityRateLimiter(global_rate_per_sec=2, global_burst=2)
+    assert (limiter.global_bucket.rate, limiter.global_bucket.burst) == (2, 2)
+    assert telegram_dispatcher.TELEGRAM_GLOBAL_RATE_PER_SEC + telegram_dispatcher.TELEGRAM_WEBHOOK_GLOBAL_RATE_PER_SEC <= 30
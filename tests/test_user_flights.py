@@ -0,0 +1,102 @@
+# user_advisory_lock на настоящей Postgres (TEST_DB_*, см. conftest.py).
+import asyncio
+import os
+
+import pytest
+from sqlalchemy import text
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_DB_HOST"), reason="нужна тестовая Postgres (TEST_DB_HOST)")
+
+
+def test_lock_is_held_by_the_flow_session_until_commit(run_db):
+    from database import AsyncSessionLocal, get_pool_stats
+    from user_flights import user_advisory_lock
+
+    async def scenario():
+        async with AsyncSessionLocal() as first, AsyncSessionLocal() as second:
+            await user_advisory_lock(first, 42)
+            # Поток держит ровно одно соединение — свое
+            assert get_pool_stats()["checked_out"] == 1
+
+            waiting = asyncio.create_task(user_advisory_lock(second, 42))
+            await asyncio.sleep(0.3)
+            assert not waiting.done()
+
+            await first.commit() # Конец транзакции потока снимает блокировку
+            await asyncio.wait_for(waiting, timeout=5)
+            await second.rollback()
+
+    run_db(scenario)
+
+
+def test_other_users_are_not_blocked(run_db):
+    from database import AsyncSessionLocal
+    from user_flights import user_advisory_lock
+
+    async def scenario():
+        async with AsyncSessionLocal() as first, AsyncSessionLocal() as second:
+            await user_advisory_lock(first, 1)
+            await asyncio.wait_for(user_advisory_lock(second, 2), timeout=5)
+            await first.rollback()
+            await second.rollback()
+
+    run_db(scenario)
+
+
+def test_lock_wait_is_bounded_by_lock_timeout(monkeypatch, run_db):
+    import user_flights
+    from database import AsyncSessionLocal
+
+    monkeypatch.setattr(user_flights, "USER_FLOW_LOCK_TIMEOUT_SEC", 1)
+
+    async def scenario():
+        async with AsyncSessionLocal() as first, AsyncSessionLocal() as second:
+            await user_flights.user_advisory_lock(first, 7)
+            with pytest.raises(Exception, match="lock timeout"):
+                await user_flights.user_advisory_lock(second, 7)
+            await second.rollback()
+            assert (await second.execute(text("SELECT 1"))).scalar() == 1
+            await first.rollback()
+
+    run_db(scenario)
+
+
+def test_second_trial_is_rejected_by_the_database(run_db):
+    import random
+
+    from sqlalchemy import delete
+    from sqlalchemy.exc import IntegrityError
+
+    import database
+    import migrations
+    from database import AsyncSessionLocal, User, VpnKey
+
+    async def scenario():
+        await database.create_db_tables()
+        await migrations.apply_migrations()
+        async with AsyncSessionLocal() as session:
+            user = User(telegram_id=random.randint(1, 2**31 - 1), username="trial_test")
+            session.add(user)
+            await session.commit()
+            user_id = user.id
+        try:
+            # Advisory lock не дождался (lock_timeout) — два потока пишут триал одновременно
+            async with AsyncSessionLocal() as first, AsyncSessionLocal() as second:
+                for session, suffix in ((first, "a"), (second, "b")):
+                    session.add(VpnKey(marzban_username=f"trial_test_{user_id}_{suffix}", subscription_url="/sub", user_id=user_id, is_trial=True))
+                await first.commit()
+                with pytest.raises(IntegrityError):
+                    await second.commit()
+                await second.rollback()
+            # Платные подписки индекс не ограничивает
+            async with AsyncSessionLocal() as session:
+                for suffix in ("c", "d"):
+                    session.add(VpnKey(marzban_username=f"trial_test_{user_id}_{suffix}", subscription_url="/sub", user_id=user_id, is_trial=False))
+                await session.commit()
+        finally:
+            async with AsyncSessionLocal() as session:
+                await session.execute(delete(VpnKey).where(VpnKey.user_id == user_id))
+                await session.execute(delete(User).where(User.id == user_id))
+                await session.commit()
+
+    run_db(scenario)
@@ -0,0 +1,38 @@
+# upsert_user на настоящей Postgres (TEST_DB_*, см. conftest.py).
+import asyncio
+import os
+import random
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_DB_HOST"), reason="нужна тестовая Postgres (TEST_DB_HOST)")
+
+
+def test_first_insert_race_returns_the_winner_row(run_db):
+    import database
+    from database import AsyncSessionLocal, User
+    from user_resolver import upsert_user
+
+    user_tg = SimpleNamespace(id=random.randint(1, 2**31 - 1), username="racer", first_name="Race")
+
+    async def scenario():
+        await database.create_db_tables()
+        try:
+            async with AsyncSessionLocal() as first, AsyncSessionLocal() as second:
+                # Первая вставка еще не закоммичена, вторая ждет ее на уникальном telegram_id
+                winner = User(telegram_id=user_tg.id, username=user_tg.username, first_name=user_tg.first_name)
+                first.add(winner)
+                await first.flush()
+                waiting = asyncio.create_task(upsert_user(second, user_tg))
+                await asyncio.sleep(0.3)
+                assert not waiting.done()
+                await first.commit()
+                assert await asyncio.wait_for(waiting, timeout=5) == winner.id
+        finally:
+            async with AsyncSessionLocal() as session:
+                await session.execute(delete(User).where(User.telegram_id == user_tg.id))
+                await session.commit()
+
+    run_db(scenario)
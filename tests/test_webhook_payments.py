@@ -0,0 +1,195 @@
+# Проведение платежа вебхуком на настоящей Postgres (TEST_DB_*, см. conftest.py) и заглушке Marzban.
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from aiohttp.test_utils import TestServer
+from marzpy import Marzban
+from sqlalchemy import delete, update
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_DB_HOST"), reason="нужна тестовая Postgres (TEST_DB_HOST)")
+
+DURATION_DAYS = 30
+
+
+class Stand:
+    """Пользователь с подпиской, pending-платеж на ее продление и заглушка Marzban."""
+
+    def __init__(self, webhook_listener, fake_users: dict):
+        self.wh = webhook_listener
+        self.fake_users = fake_users
+        self.marzban_username = f"paid_tg_test_{uuid.uuid4().hex[:8]}"
+        self.yookassa_payment_id = str(uuid.uuid4())
+        self.original_expire = int(time.time()) + 10 * 86400
+
+    async def create(self, metadata_overrides: dict | None = None):
+        from database import AsyncSessionLocal, Payment, User, VpnKey
+
+        self.fake_users[self.marzban_username] = {
+            "username": self.marzban_username, "proxies": {}, "inbounds": {}, "expire": self.original_expire,
+            "data_limit": 0, "data_limit_reset_strategy": "no_reset", "status": "active", "used_traffic": 0,
+            "lifetime_used_traffic": 0, "created_at": datetime.utcnow().isoformat(), "sub_token": uuid.uuid4().hex,
+        }
+        async with AsyncSessionLocal() as session:
+            user = User(telegram_id=random.randint(1, 2**31 - 1), username="test")
+            session.add(user)
+            await session.flush()
+            key = VpnKey(
+                marzban_username=self.marzban_username, subscription_url="/sub/test", name="test", user_id=user.id,
+                created_at=datetime.utcnow(), expires_at=datetime.utcfromtimestamp(self.original_expire), is_active=True, is_trial=False,
+            )
+            session.add(key)
+            await session.flush()
+            metadata = {
+                "action": "extend", "duration_days": DURATION_DAYS, "telegram_user_id": user.telegram_id,
+                "internal_user_db_id": user.id, "marzban_username": self.marzban_username, "subscription_db_id": key.id,
+                **(metadata_overrides or {}),
+            }
+            payment = Payment(
+                user_id=user.id, yookassa_payment_id=self.yookassa_payment_id, amount=100, currency="RUB",
+                status="pending", additional_data=json.dumps(metadata),
+            )
+            session.add(payment)
+            await session.commit()
+            self.user_id, self.key_id, self.payment_id = user.id, key.id, payment.id
+
+    def notification(self) -> dict:
+        return {"type": "notification", "event": "payment.succeeded", "object": {"id": self.yookassa_payment_id, "status": "succeeded"}}
+
+    async def payment(self):
+        from database import AsyncSessionLocal, Payment
+
+        async with AsyncSessionLocal() as session:
+            return await session.get(Payment, self.payment_id)
+
+    async def cleanup(self):
+        from database import AsyncSessionLocal, Payment, User, VpnKey
+
+        async with AsyncSessionLocal() as session:
+            await session.execute(update(VpnKey).where(VpnKey.id == self.key_id).values(payment_id=None))
+            await session.execute(delete(Payment).where(Payment.id == self.payment_id))
+            await session.execute(delete(VpnKey).where(VpnKey.id == self.key_id))
+            await session.execute(delete(User).where(User.id == self.user_id))
+            await session.commit()
+
+
+def with_stand(monkeypatch, run_db, test_body, metadata_overrides: dict | None = None):
+    import database
+    import migrations
+    import webhook_listener
+    from fakes import fake_marzban
+    from marzban_auth import MarzbanTokenManager
+    from marzban_resilience import ResilientMarzbanCaller
+
+    async def scenario():
+        await database.create_db_tables()
+        await migrations.apply_migrations()
+        fake_app = fake_marzban.create_app()
+        server = TestServer(fake_app)
+        await server.start_server()
+        # Клиент, токен и breaker — свои на каждый тест: их asyncio-примитивы привязываются к event loop
+        monkeypatch.setattr(webhook_listener, "marzban_client_wh", Marzban("admin", "admin", str(server.make_url("")).rstrip("/")))
+        tokens = MarzbanTokenManager(lambda: webhook_listener.marzban_client_wh.get_token())
+        monkeypatch.setattr(webhook_listener, "marzban_tokens_wh", tokens)
+        monkeypatch.setattr(webhook_listener, "marzban_api_wh", ResilientMarzbanCaller(tokens, name="marzban_test"))
+        stand = Stand(webhook_listener, fake_app["users"])
+        await stand.create(metadata_overrides)
+        try:
+            await test_body(stand)
+        finally:
+            await stand.cleanup()
+            await server.close()
+
+    run_db(scenario)
+
+
+def test_parallel_deliveries_extend_subscription_once(monkeypatch, run_db):
+    async def body(stand: Stand):
+        results = await asyncio.gather(*(stand.wh.process_yookassa_notification_standalone(stand.notification()) for _ in range(3)))
+        # Повторы, которые застали аренду, просят inbox повторить; после проведения повтор только подтверждает
+        assert results.count(True) >= 1
+        assert all(await asyncio.gather(*(stand.wh.process_yookassa_notification_standalone(stand.notification()) for _ in range(2))))
+
+        payment = await stand.payment()
+        assert payment.status == "succeeded"
+        assert payment.claim_token is None
+        expire = stand.fake_users[stand.marzban_username]["expire"]
+        assert expire - stand.original_expire == pytest.approx(DURATION_DAYS * 86400, abs=5)
+
+    with_stand(monkeypatch, run_db, body)
+
+
+def test_delivery_while_claim_is_held_is_retried(monkeypatch, run_db):
+    async def body(stand: Stand):
+        from database import AsyncSessionLocal, Payment
+
+        async with AsyncSessionLocal() as session:
+            assert await stand.wh.claim_payment(session, stand.yookassa_payment_id, "other-worker")
+        assert await stand.wh.process_yookassa_notification_standalone(stand.notification()) is False
+        assert stand.fake_users[stand.marzban_username]["expire"] == stand.original_expire
+
+        # Аренда истекла (воркер упал): следующая доставка забирает платеж и проводит его
+        async with AsyncSessionLocal() as session:
+            await session.execute(update(Payment).where(Payment.id == stand.payment_id).values(claimed_until=datetime.utcnow() - timedelta(seconds=1)))
+            await session.commit()
+        assert await stand.wh.process_yookassa_notification_standalone(stand.notification()) is True
+        assert (await stand.payment()).status == "succeeded"
+
+    with_stand(monkeypatch, run_db, body)
+
+
+def test_subscription_of_another_user_marks_payment_failed(monkeypatch, run_db):
+    async def body(stand: Stand):
+        assert await stand.wh.process_yookassa_notification_standalone(stand.notification()) is True
+        payment = await stand.payment()
+        assert payment.status == "failed"
+        assert payment.claim_token is None
+        assert stand.fake_users[stand.marzban_username]["expire"] == stand.original_expire
+
+    with_stand(monkeypatch, run_db, body, metadata_overrides={"internal_user_db_id": -1})
+
+
+class RecordingBot:
+    """Вместо Telegram: запоминает статус платежа в БД в момент отправки сообщения."""
+
+    def __init__(self, stand: Stand, error: Exception | None = None):
+        self.stand = stand
+        self.error = error
+        self.statuses_at_send = []
+
+    async def send_message(self, **kwargs):
+        self.statuses_at_send.append((await self.stand.payment()).status)
+        if self.error:
+            raise self.error
+
+
+def test_user_is_notified_only_after_payment_is_finalised(monkeypatch, run_db):
+    async def body(stand: Stand):
+        bot = RecordingBot(stand)
+        monkeypatch.setattr(stand.wh, "telegram_bot_wh", bot)
+        assert await stand.wh.process_yookassa_notification_standalone(stand.notification()) is True
+        assert bot.statuses_at_send == ["succeeded"]
+
+    with_stand(monkeypatch, run_db, body)
+
+
+def test_failed_notification_does_not_reprocess_payment(monkeypatch, run_db):
+    from telegram.error import Forbidden
+
+    async def body(stand: Stand):
+        bot = RecordingBot(stand, error=Forbidden("bot was blocked by the user"))
+        monkeypatch.setattr(stand.wh, "telegram_bot_wh", bot)
+        assert await stand.wh.process_yookassa_notification_standalone(stand.notification()) is True
+        # Повторная доставка не продлевает подписку второй раз
+        assert await stand.wh.process_yookassa_notification_standalone(stand.notification()) is True
+        assert (await stand.payment()).status == "succeeded"
+        expire = stand.fake_users[stand.marzban_username]["expire"]
+        assert expire - stand.original_expire == pytest.approx(DURATION_DAYS * 86400, abs=5)
+        assert bot.statuses_at_send == ["succeeded"]
+
+    with_stand(monkeypatch, run_db, body)
@@ -0,0 +1,24 @@
+import logging
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+load_dotenv()
+
+USER_FLOW_LOCK_TIMEOUT_SEC = int(os.getenv("USER_FLOW_LOCK_TIMEOUT_SEC", "30")) # Сколько ждать advisory lock другой реплики
+
+logger = logging.getLogger(__name__)
+
+
+async def user_advisory_lock(session, telegram_id: int) -> None:
+    """
+    Транзакционный advisory lock Postgres на пользователя: сериализует выдачу триала и создание платежей
+    между репликами бота. Берется в текущей транзакции session — той же, в которой поток читает и пишет,
+    поэтому второе соединение из пула не занимается. Снимается на commit/rollback этой транзакции
+    (и при обрыве соединения), поэтому вызывать после resolve_user_id/upsert_user, которые делают commit.
+    Внутри процесса апдейты одного пользователя и так идут по очереди (PerUserUpdateProcessor).
+    """
+    await session.execute(text(f"SET LOCAL lock_timeout = '{USER_FLOW_LOCK_TIMEOUT_SEC}s'"))
+    # telegram_id не помещается в int4, поэтому ключ — bigint-хэш строки
+    await session.execute(text("SELECT pg_advisory_xact_lock(hashtextextended(:key, 0))"), {"key": f"vpn_flow:{telegram_id}"})
@@ -0,0 +1,72 @@
+import logging
+import os
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.future import select
+
+from database import User as DbUser
+
+load_dotenv()
+
+TELEGRAM_USER_CACHE_MAX_SIZE = int(os.getenv("TELEGRAM_USER_CACHE_MAX_SIZE", "50000"))
+
+logger = logging.getLogger(__name__)
+
+# telegram_id -> users.id. Связка не меняется (пользователи не удаляются), поэтому TTL не нужен, только LRU по размеру.
+_user_id_cache: OrderedDict[int, int] = OrderedDict()
+
+
+def _remember(telegram_id: int, user_id: int) -> None:
+    _user_id_cache[telegram_id] = user_id
+    _user_id_cache.move_to_end(telegram_id)
+    while len(_user_id_cache) > TELEGRAM_USER_CACHE_MAX_SIZE:
+        _user_id_cache.popitem(last=False)
+
+
+async def upsert_user(session, user_tg) -> int:
+    """
+    Создает пользователя или обновляет username/first_name, если они изменились, за один запрос.
+    Возвращает users.id. Выполняет commit.
+    """
+    insert_stmt = pg_insert(DbUser).values(
+        telegram_id=user_tg.id,
+        username=user_tg.username,
+        first_name=user_tg.first_name,
+    )
+    upserted = insert_stmt.on_conflict_do_update(
+        index_elements=[DbUser.telegram_id],
+        set_={"username": insert_stmt.excluded.username, "first_name": insert_stmt.excluded.first_name},
+        # Не переписываем строку, если ничего не изменилось
+        where=or_(
+            DbUser.username.is_distinct_from(insert_stmt.excluded.username),
+            DbUser.first_name.is_distinct_from(insert_stmt.excluded.first_name),
+        ),
+    ).returning(DbUser.id).cte("upserted")
+    # Если строка не изменилась, RETURNING пуст — берем id существующей строки в том же запросе
+    stmt = select(upserted.c.id).union_all(
+        select(DbUser.id).where(DbUser.telegram_id == user_tg.id)
+    ).limit(1)
+    user_id = (await session.execute(stmt)).scalar_one_or_none()
+    if user_id is None:
+        # Первая вставка в гонке: ON CONFLICT дождался чужой строки с теми же данными, но SELECT этого запроса
+        # видит снимок до ее коммита. Новый запрос (READ COMMITTED) получает новый снимок и видит строку.
+        user_id = (await session.execute(select(DbUser.id).where(DbUser.telegram_id == user_tg.id))).scalar_one()
+    await session.commit()
+    _remember(user_tg.id, user_id)
+    return user_id
+
+
+async def resolve_user_id(session, user_tg) -> int:
+    """users.id по Telegram-пользователю: из кэша, иначе через upsert (заодно создаст пропущенного пользователя)."""
+    user_id = _user_id_cache.get(user_tg.id)
+    if user_id is not None:
+        _user_id_cache.move_to_end(user_tg.id)
+        return user_id
+    return await upsert_user(session, user_tg)
+
+
+def get_user_cache_stats() -> dict:
+    return {"size": len(_user_id_cache), "max_size": TELEGRAM_USER_CACHE_MAX_SIZE}
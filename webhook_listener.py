@@ -2,15 +2,27 @@ import logging
 import os
 import json
 import asyncio
+import time
 import uuid # Для генерации marzban_username при необходимости
 
-from flask import Flask, request # Оставляем Flask для текущей структуры, но помним о рекомендации перейти на ASGI
+from aiohttp import web # Долгоживущее async-приложение: один event loop на воркер вместо asyncio.run() на каждый запрос
 from dotenv import load_dotenv
 from sqlalchemy.future import select
 # REMOVE: from sqlalchemy import and_ # Если не используется, можно удалить. Пока оставлю.
+from sqlalchemy import and_, func, literal_column, or_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from datetime import datetime, timedelta
+import random
 # REMOVE: from outline_vpn.outline_vpn import OutlineVPN
-from telegram import Bot as TelegramBotInstance
+from telegram.ext import ExtBot as TelegramBotInstance
+from telegram_dispatcher import PriorityRateLimiter, PRIORITY_TRANSACTIONAL, TELEGRAM_WEBHOOK_GLOBAL_RATE_PER_SEC
+from marzban_cache import publish_marzban_user_invalidation
+from marzban_auth import MarzbanTokenManager
+from marzban_resilience import ResilientMarzbanCaller
+import metrics
+from log_config import configure_logging, log_context, bind_log_context
+from payment_reconciler import reconcile_pending_payments, PAYMENT_RECONCILE_INTERVAL_SEC
+from yookassa_client import yookassa_client
 
 # +++ Marzban Imports +++
 from marzpy import Marzban
@@ -20,6 +32,7 @@ from marzpy.api.user import User as MarzbanUser
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+TELEGRAM_BOT_API_URL = os.getenv("TELEGRAM_BOT_API_URL", "https://api.telegram.org/bot")
 # REMOVE: API_URL = os.getenv("API_URL")
 # REMOVE: CERT_SHA256 = os.getenv("CERT_SHA256")
 # REMOVE: AMNEZIA_API_URL_WH = os.getenv("AMNEZIA_API_URL")
@@ -31,22 +44,33 @@ MARZBAN_PASSWORD = os.getenv("MARZBAN_PASSWORD")
 # Лимиты трафика для платной подписки (в ГБ), если нужны при создании пользователя
 MARZBAN_DEFAULT_DATA_LIMIT_GB_PAID_WH = int(os.getenv("MARZBAN_DEFAULT_DATA_LIMIT_GB_PAID", "50"))
 
+# +++ Inbox Settings +++
+INBOX_WORKERS = int(os.getenv("INBOX_WORKERS", "4")) # Сколько уведомлений обрабатывается одновременно
+INBOX_POLL_INTERVAL_SEC = float(os.getenv("INBOX_POLL_INTERVAL_SEC", "5"))
+INBOX_MAX_ATTEMPTS = int(os.getenv("INBOX_MAX_ATTEMPTS", "10"))
+INBOX_RETRY_BASE_SEC = float(os.getenv("INBOX_RETRY_BASE_SEC", "10"))
+INBOX_RETRY_MAX_SEC = float(os.getenv("INBOX_RETRY_MAX_SEC", "1800"))
+# Аренда платежа на время выдачи подписки; должна быть заметно больше времени обработки (с учетом повторов к Marzban)
+PAYMENT_CLAIM_LEASE_SEC = int(os.getenv("PAYMENT_CLAIM_LEASE_SEC", "300"))
+# Через сколько запись зависшего воркера снова доступна. Не короче аренды платежа: к повтору аренда
+# упавшего воркера уже истекла, и claim_payment заберет платеж, а не отложит уведомление еще раз
+INBOX_LEASE_SEC = max(int(os.getenv("INBOX_LEASE_SEC", "360")), PAYMENT_CLAIM_LEASE_SEC)
+# Число воркеров gunicorn (gunicorn читает ту же переменную): доля вебхука в лимите Telegram делится между ними
+WEBHOOK_WORKERS = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-log = logging.getLogger(__name__) # log используется для Flask, logger_webhook_process для логики обработки
+
+configure_logging("webhook") # JSON-логи через очередь и фоновый поток (см. log_config.py)
+log = logging.getLogger(__name__) # log — веб-приложение и воркеры inbox, logger_webhook_process — обработка платежей
 
 
 # --- 2. ИМПОРТ МОДЕЛЕЙ БАЗЫ ДАННЫХ ---
 try:
     # Используем DbUser для нашей модели User, чтобы не конфликтовать с MarzbanUser
-    from database import User as DbUser, VpnKey, Payment, AsyncSessionLocal
+    from database import User as DbUser, VpnKey, Payment, WebhookInbox, AsyncSessionLocal, async_engine, get_pool_stats
     log.info("Модели БД успешно импортированы в webhook_listener.")
 except ImportError as e:
     log.error(f"Не удалось импортировать модели БД: {e}")
-    DbUser, VpnKey, Payment, AsyncSessionLocal = None, None, None, None
+    DbUser, VpnKey, Payment, WebhookInbox, AsyncSessionLocal, async_engine, get_pool_stats = None, None, None, None, None, None, None
 
 # REMOVE: Импорты Amnezia и констант протоколов
 # try:
@@ -66,13 +90,23 @@ except ImportError as e:
 # Используем отдельные переменные для клиента и токена в вебхуке,
 # чтобы избежать конфликта состояния с основным ботом, если они работают в разных процессах.
 marzban_client_wh: Marzban | None = None
-marzban_api_token_wh: str | None = None
+# Токен Marzban: тот же менеджер, что и в боте (marzban_auth), но свой экземпляр на процесс
+marzban_tokens_wh = MarzbanTokenManager(lambda: marzban_client_wh.get_token(), log_prefix="Webhook: ")
+marzban_api_wh = ResilientMarzbanCaller(marzban_tokens_wh, name="marzban_wh")
+# Один экземпляр Telegram Bot на весь процесс (создается в startup-хуке, закрывается в cleanup).
+# Все отправки идут через общий диспетчер с глобальным и по-чатовым лимитом.
+telegram_bot_wh: TelegramBotInstance | None = None
+# Лимит — доля вебхука в общих ~30 сообщениях/с на бота (см. telegram_dispatcher.py), поровну на воркер
+telegram_dispatcher_wh = PriorityRateLimiter(
+    global_rate_per_sec=TELEGRAM_WEBHOOK_GLOBAL_RATE_PER_SEC / WEBHOOK_WORKERS,
+    global_burst=max(int(TELEGRAM_WEBHOOK_GLOBAL_RATE_PER_SEC / WEBHOOK_WORKERS), 1),
+)
 
 async def initialize_marzban_client_wh():
     global marzban_client_wh
     if MARZBAN_PANEL_URL and MARZBAN_USERNAME and MARZBAN_PASSWORD:
         try:
-            marzban_client_wh = Marzban(username=MARZBAN_USERNAME, password=MARZBAN_PASSWORD, base_url=MARZBAN_PANEL_URL)
+            marzban_client_wh = Marzban(MARZBAN_USERNAME, MARZBAN_PASSWORD, MARZBAN_PANEL_URL) # username, password, panel_address
             log.info("Webhook: Клиент Marzban инициализирован. URL: %s", MARZBAN_PANEL_URL)
         except Exception as e:
             log.error(f"Webhook: Ошибка инициализации клиента Marzban: {e}")
@@ -80,43 +114,81 @@ async def initialize_marzban_client_wh():
     else:
         log.error("Webhook: Не заданы MARZBAN_PANEL_URL, MARZBAN_USERNAME или MARZBAN_PASSWORD в .env. Клиент Marzban не будет работать.")
 
-async def get_marzban_api_token_wh(force_refresh: bool = False) -> str | None:
-    global marzban_api_token_wh
-    if not marzban_client_wh:
-        log.error("Webhook: Клиент Marzban не инициализирован.")
-        return None
-
-    if marzban_api_token_wh and not force_refresh:
-        return marzban_api_token_wh
-
+async def initialize_telegram_bot_wh():
+    global telegram_bot_wh
+    if not BOT_TOKEN:
+        log.error("Webhook: BOT_TOKEN не задан. Уведомления пользователям отправляться не будут.")
+        return
+    telegram_bot_wh = TelegramBotInstance(token=BOT_TOKEN, base_url=TELEGRAM_BOT_API_URL, rate_limiter=telegram_dispatcher_wh)
     try:
-        token = await marzban_client_wh.get_token()
-        if token:
-            marzban_api_token_wh = token
-            log.info("Webhook: Токен Marzban успешно получен/обновлен.")
-            return marzban_api_token_wh
-        else:
-            log.error("Webhook: Не удалось получить токен Marzban (ответ None).")
-            marzban_api_token_wh = None
-            return None
+        await telegram_bot_wh.initialize()
+        log.info("Webhook: Telegram Bot инициализирован.")
     except Exception as e:
-        log.error(f"Webhook: Ошибка при получении токена Marzban: {e}", exc_info=True)
-        marzban_api_token_wh = None
-        return None
-
-# Вызов инициализации клиента при старте вебхук-приложения (если это модуль)
-# Для Flask это лучше делать в before_first_request или при создании app, но в async контексте.
-# Пока оставим так, предполагая, что модуль импортируется один раз.
-# Для ASGI-приложения это было бы в startup-хуке.
-# asyncio.run(initialize_marzban_client_wh()) # Это не сработает здесь на уровне модуля.
-# Инициализацию нужно будет вызвать в подходящий момент, например, перед первым использованием.
+        # Бот все равно может отправлять сообщения, initialize() лишь прогревает сессию и getMe
+        log.error(f"Webhook: Ошибка инициализации Telegram Bot: {e}")
 
 # --- 4. ОСНОВНАЯ ЛОГИКА ОБРАБОТКИ ПЛАТЕЖА ---
-async def process_yookassa_notification_standalone(notification_data: dict): # Убрали outline_client из аргументов
+async def claim_payment(session, yookassa_payment_id: str, claim_token: str) -> Payment | None:
+    """
+    Атомарно переводит платеж pending -> processing (или забирает processing с истекшей арендой).
+    Возвращает платеж, если его взяли мы; None — не найден, уже проведен или его обрабатывает другой воркер.
+    """
+    now = datetime.utcnow()
+    stmt = (
+        update(Payment)
+        .where(
+            Payment.yookassa_payment_id == yookassa_payment_id,
+            or_(Payment.status == "pending", and_(Payment.status == "processing", Payment.claimed_until < now)),
+        )
+        .values(status="processing", claimed_until=now + timedelta(seconds=PAYMENT_CLAIM_LEASE_SEC), claim_token=claim_token, updated_at=now)
+        .returning(Payment)
+        .execution_options(synchronize_session=False)
+    )
+    db_payment = (await session.execute(stmt)).scalar_one_or_none()
+    await session.commit()
+    return db_payment
+
+async def is_payment_claim_busy(session, yookassa_payment_id: str) -> bool:
+    """После неудачного claim_payment: True, если платеж еще ждет проведения (его держит другой воркер)."""
+    status = (await session.execute(
+        select(Payment.status).where(Payment.yookassa_payment_id == yookassa_payment_id)
+    )).scalar_one_or_none()
+    return status in ("pending", "processing")
+
+async def release_payment_claim(payment_db_id: int, claim_token: str, status: str = "pending") -> None:
+    """
+    Снимает аренду, если обработка не завершилась. По умолчанию возвращает платеж в pending: повтор inbox
+    или сверка заберут его снова. status="failed" — повтор бесполезен (ошибка в данных платежа), нужен разбор вручную.
+    """
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(Payment)
+            .where(Payment.id == payment_db_id, Payment.status == "processing", Payment.claim_token == claim_token)
+            .values(status=status, claimed_until=None, claim_token=None, updated_at=datetime.utcnow())
+        )
+        await session.commit()
+
+async def notify_payment_user(bot_instance, telegram_user_id: int, message: dict) -> None:
+    """
+    Сообщение об уже проведенном платеже. Ошибки Telegram (бот заблокирован, исчерпаны повторы после 429 и т.п.)
+    только логируются: неудачная отправка не должна возвращать уведомление в inbox и проводить платеж повторно.
+    """
+    try:
+        await bot_instance.send_message(chat_id=telegram_user_id, rate_limit_args={"priority": PRIORITY_TRANSACTIONAL}, **message)
+    except Exception as e:
+        logging.getLogger('yookassa_process_marzban').warning(f"Не удалось отправить пользователю {telegram_user_id} сообщение о проведенном платеже: {e}")
+        metrics.errors.inc(component="webhook.notify_user", cause=type(e).__name__)
+
+async def process_yookassa_notification_standalone(notification_data: dict) -> bool: # Убрали outline_client из аргументов
+    """
+    Обрабатывает уведомление YooKassa.
+    Возвращает True, если уведомление обработано (или повтор бесполезен), и False, если стоит повторить позже.
+    """
     logger_webhook_process = logging.getLogger('yookassa_process_marzban') # Новое имя логгера для ясности
-    bot_instance = None
-    if BOT_TOKEN:
-        bot_instance = TelegramBotInstance(token=BOT_TOKEN)
+    # Используем общий экземпляр бота из startup-хука; при вызове вне приложения создаем его один раз
+    if not telegram_bot_wh and BOT_TOKEN:
+        await initialize_telegram_bot_wh()
+    bot_instance = telegram_bot_wh
 
     # Инициализация клиента Marzban, если еще не сделана (важно для worker-based серверов)
     if not marzban_client_wh:
@@ -125,13 +197,10 @@ async def process_yookassa_notification_standalone(notification_data: dict): # 
     if not marzban_client_wh: # Проверка после попытки инициализации
         logger_webhook_process.error("Критическая ошибка: Клиент Marzban не инициализирован в вебхуке.")
         # В этом случае мы не можем обработать платеж для VPN.
-        # YooKassa ожидает 200 OK, иначе будет повторять.
-        # Если мы не можем ничего сделать, возможно, стоит вернуть ошибку, чтобы YooKassa повторила позже,
-        # но это может привести к зацикливанию, если проблема с конфигом Marzban постоянная.
-        # Пока что просто логируем и выходим (YooKassa получит 200 OK от Flask и не повторит).
-        # Это означает, что платеж прошел, но VPN не выдан. Требуется ручное вмешательство.
+        # YooKassa уже получила 200 OK при записи в inbox, повторять будет воркер inbox с backoff.
+        # Если проблема с конфигом Marzban постоянная, запись уйдет в failed после INBOX_MAX_ATTEMPTS.
         # TODO: Рассмотреть отправку уведомления администратору в этом случае.
-        return
+        return False
 
 
     event = notification_data.get("event")
@@ -139,39 +208,45 @@ async def process_yookassa_notification_standalone(notification_data: dict): # 
 
     if not (event and payment_object and payment_object.get("id")):
         logger_webhook_process.error("Некорректные данные уведомления YooKassa.")
-        return
+        return True
 
     yookassa_payment_id = payment_object.get("id")
 
     if event == "payment.succeeded" and payment_object.get("status") == "succeeded":
         logger_webhook_process.info(f"Платеж {yookassa_payment_id} УСПЕШНО ПРОШЕЛ.")
         
+        claim_token = uuid.uuid4().hex
+        db_payment = None
+        payment_finished = False
+        release_status = "pending" # Куда вернуть платеж, если обработка не завершилась
+        success_message = None # Сообщение пользователю: отправляется только после того, как платеж проведен в БД
         async with AsyncSessionLocal() as session: # Используем async with для сессии
             try:
-                stmt = select(Payment).where(Payment.yookassa_payment_id == yookassa_payment_id)
-                db_payment = (await session.execute(stmt)).scalar_one_or_none()
-
+                # Захват платежа одним UPDATE ... RETURNING: параллельная или повторная доставка сюда не пройдет
+                db_payment = await claim_payment(session, yookassa_payment_id, claim_token)
                 if not db_payment:
-                    logger_webhook_process.warning(f"Платеж {yookassa_payment_id} не найден в нашей БД. Возможно, уже обработан или ошибка.")
-                    return
-
-                if db_payment.status == "succeeded":
-                    logger_webhook_process.warning(f"Платеж {yookassa_payment_id} уже помечен как 'succeeded' в нашей БД.")
-                    return # Предотвращение двойной обработки
-
-                additional_data = json.loads(db_payment.additional_data or '{}')
-                action = additional_data.get("action", "create") # "create" или "extend"
-                duration_days = int(additional_data.get("duration_days", 30))
-                telegram_user_id = int(additional_data.get("telegram_user_id"))
-                user_db_id = int(additional_data.get("internal_user_db_id")) # ID из нашей таблицы users
-                
-                # Получаем токен Marzban API
-                marzban_api_token_val = await get_marzban_api_token_wh()
-                if not marzban_api_token_val:
-                    logger_webhook_process.error(f"Не удалось получить токен Marzban для обработки платежа {yookassa_payment_id}.")
-                    # Оставляем платеж в pending, чтобы попробовать обработать позже или вручную.
+                    if await is_payment_claim_busy(session, yookassa_payment_id):
+                        # Аренда другого воркера еще действует: повторим после backoff, когда он закончит или аренда истечет
+                        logger_webhook_process.info(f"Платеж {yookassa_payment_id} обрабатывается другим воркером, повторим позже.")
+                        return False
+                    logger_webhook_process.info(f"Платеж {yookassa_payment_id} не взят в обработку: не найден или уже завершен.")
+                    return True
+
+                try:
+                    additional_data = json.loads(db_payment.additional_data or '{}')
+                    action = additional_data.get("action", "create") # "create" или "extend"
+                    duration_days = int(additional_data.get("duration_days", 30))
+                    telegram_user_id = int(additional_data.get("telegram_user_id"))
+                    user_db_id = int(additional_data.get("internal_user_db_id")) # ID из нашей таблицы users
+                except (ValueError, TypeError) as e_data:
+                    logger_webhook_process.error(f"Некорректные metadata платежа {yookassa_payment_id}: {e_data}. Платеж помечен failed.")
                     # TODO: Уведомить администратора.
-                    return
+                    release_status = "failed"
+                    return True
+                bind_log_context(telegram_id=telegram_user_id, marzban_username=additional_data.get("marzban_username"))
+                
+                # Токен Marzban получает marzban_api_wh.call (под таймаутом и circuit breaker); если его нет,
+                # вызов завершится ошибкой, платеж вернется в pending, а inbox повторит обработку
 
                 new_marzban_user_obj_from_api = None # Для хранения объекта пользователя от Marzban API
 
@@ -183,21 +258,26 @@ async def process_yookassa_notification_standalone(notification_data: dict): # 
                         logger_webhook_process.error(f"Для action='extend' платежа {yookassa_payment_id} отсутствуют marzban_username или subscription_db_id в metadata.")
                         # Попытаться создать как новую подписку? Или ошибка? Пока ошибка.
                         # TODO: Уведомить администратора.
-                        return
+                        release_status = "failed" # Повтор не поможет: в pending платеж снова и снова уходил бы в обработку
+                        return True
 
                     db_subscription_to_extend = await session.get(VpnKey, int(subscription_db_id))
                     if not db_subscription_to_extend or db_subscription_to_extend.user_id != user_db_id:
                         logger_webhook_process.error(f"Подписка ID {subscription_db_id} для продления не найдена или не принадлежит пользователю {user_db_id} (платеж {yookassa_payment_id}).")
                         # TODO: Уведомить администратора.
-                        return
+                        release_status = "failed"
+                        return True
 
                     if db_subscription_to_extend.marzban_username != marzban_username_to_extend:
                          logger_webhook_process.error(f"Несоответствие marzban_username для подписки ID {subscription_db_id}: в БД {db_subscription_to_extend.marzban_username}, в метаданных {marzban_username_to_extend}.")
                          # TODO: Уведомить администратора.
-                         return
+                         release_status = "failed"
+                         return True
 
                     try:
-                        current_marzban_user = await marzban_client_wh.get_user(username=marzban_username_to_extend, token=marzban_api_token_val)
+                        current_marzban_user = await marzban_api_wh.call("get_user",
+                            lambda token: marzban_client_wh.get_user(user_username=marzban_username_to_extend, token=token)
+                        )
                         if not current_marzban_user:
                             logger_webhook_process.warning(f"Пользователь Marzban {marzban_username_to_extend} не найден для продления (платеж {yookassa_payment_id}). Попытка создать нового.")
                             action = "create" # Переходим к созданию нового, если старый не найден
@@ -223,10 +303,12 @@ async def process_yookassa_notification_standalone(notification_data: dict): # 
                                 data_limit_reset_strategy=current_marzban_user.data_limit_reset_strategy # или "no_reset"
                             )
 
-                            new_marzban_user_obj_from_api = await marzban_client_wh.modify_user(
-                                username=marzban_username_to_extend,
-                                token=marzban_api_token_val,
-                                user=modified_user_config
+                            new_marzban_user_obj_from_api = await marzban_api_wh.call("modify_user",
+                                lambda token: marzban_client_wh.modify_user(
+                                    user_username=marzban_username_to_extend,
+                                    token=token,
+                                    user=modified_user_config
+                                )
                             )
 
                             db_subscription_to_extend.expires_at = new_expire_dt
@@ -235,22 +317,21 @@ async def process_yookassa_notification_standalone(notification_data: dict): # 
                             # db_subscription_to_extend.subscription_url можно обновить, если он мог измениться
                             if new_marzban_user_obj_from_api and new_marzban_user_obj_from_api.subscription_url:
                                 db_subscription_to_extend.subscription_url = new_marzban_user_obj_from_api.subscription_url
+                            # Бот сбросит закэшированные данные пользователя после commit
+                            await publish_marzban_user_invalidation(session, marzban_username_to_extend)
 
                             # session.add(db_subscription_to_extend) # Уже в сессии
                             logger_webhook_process.info(f"Подписка Marzban {marzban_username_to_extend} продлена до {new_expire_dt}.")
-                            if bot_instance:
-                                await bot_instance.send_message(
-                                    chat_id=telegram_user_id,
-                                    text=f"✅ Ваша VPN подписка ({marzban_username_to_extend}) успешно продлена!\n\n"
-                                         f"Новая дата окончания: {new_expire_dt.strftime('%d.%m.%Y %H:%M')} UTC\n"
-                                         f"Лимит трафика: {MARZBAN_DEFAULT_DATA_LIMIT_GB_PAID_WH} ГБ"
-                                )
+                            success_message = {
+                                "text": f"✅ Ваша VPN подписка ({marzban_username_to_extend}) успешно продлена!\n\n"
+                                        f"Новая дата окончания: {new_expire_dt.strftime('%d.%m.%Y %H:%M')} UTC\n"
+                                        f"Лимит трафика: {MARZBAN_DEFAULT_DATA_LIMIT_GB_PAID_WH} ГБ",
+                            }
                     except Exception as e_extend:
                         logger_webhook_process.error(f"Ошибка при продлении пользователя Marzban {marzban_username_to_extend} (платеж {yookassa_payment_id}): {e_extend}", exc_info=True)
                         # TODO: Уведомить администратора. Платеж прошел, но продление не удалось.
                         # Не меняем статус платежа, чтобы можно было повторить вручную.
-                        if "token" in str(e_extend).lower(): await get_marzban_api_token_wh(force_refresh=True)
-                        return # Выходим, чтобы не пометить платеж как успешный в БД
+                        return False # Выходим, чтобы не пометить платеж как успешный в БД
 
 
                 if action == "create": # Если это создание нового или fallback с продления
@@ -269,11 +350,13 @@ async def process_yookassa_notification_standalone(notification_data: dict): # 
                         status="active"
                     )
                     try:
-                        new_marzban_user_obj_from_api = await marzban_client_wh.add_user(user=new_paid_marzban_user_config, token=marzban_api_token_val)
+                        new_marzban_user_obj_from_api = await marzban_api_wh.call("add_user",
+                            lambda token: marzban_client_wh.add_user(user=new_paid_marzban_user_config, token=token)
+                        )
                         if not new_marzban_user_obj_from_api or not new_marzban_user_obj_from_api.subscription_url:
                             logger_webhook_process.error(f"Не удалось создать платного пользователя Marzban или отсутствует subscription_url для {paid_marzban_username} (платеж {yookassa_payment_id}).")
                             # TODO: Уведомить администратора.
-                            return # Выходим, платеж не обработан до конца
+                            return False # Выходим, платеж не обработан до конца
 
                         new_db_vpn_key = VpnKey(
                             marzban_username=paid_marzban_username,
@@ -287,37 +370,51 @@ async def process_yookassa_notification_standalone(notification_data: dict): # 
                             is_trial=False
                         )
                         session.add(new_db_vpn_key)
+                        await publish_marzban_user_invalidation(session, paid_marzban_username)
                         # db_payment.marzban_subscription_association = new_db_vpn_key # Устанавливаем связь
 
                         logger_webhook_process.info(f"Создана новая платная подписка Marzban {paid_marzban_username} до {paid_expire_dt}.")
-                        if bot_instance:
-                            await bot_instance.send_message(
-                                chat_id=telegram_user_id,
-                                text=f"✅ Оплата прошла успешно! Ваша новая VPN подписка готова.\n\n"
-                                     f"🔗 Ссылка-подписка:\n`{new_marzban_user_obj_from_api.subscription_url}`\n\n"
-                                     f"🗓️ Действительна до: {paid_expire_dt.strftime('%d.%m.%Y %H:%M')} UTC\n"
-                                     f"📊 Лимит трафика: {MARZBAN_DEFAULT_DATA_LIMIT_GB_PAID_WH} ГБ",
-                                parse_mode='Markdown'
-                            )
+                        success_message = {
+                            "text": f"✅ Оплата прошла успешно! Ваша новая VPN подписка готова.\n\n"
+                                    f"🔗 Ссылка-подписка:\n`{new_marzban_user_obj_from_api.subscription_url}`\n\n"
+                                    f"🗓️ Действительна до: {paid_expire_dt.strftime('%d.%m.%Y %H:%M')} UTC\n"
+                                    f"📊 Лимит трафика: {MARZBAN_DEFAULT_DATA_LIMIT_GB_PAID_WH} ГБ",
+                            "parse_mode": "Markdown",
+                        }
                     except Exception as e_create:
                         logger_webhook_process.error(f"Ошибка при создании платного пользователя Marzban {paid_marzban_username} (платеж {yookassa_payment_id}): {e_create}", exc_info=True)
                         # TODO: Уведомить администратора.
-                        if "token" in str(e_create).lower(): await get_marzban_api_token_wh(force_refresh=True)
-                        return # Выходим, платеж не обработан до конца
-
-                # Если все операции с Marzban прошли успешно
-                db_payment.status = "succeeded"
-                db_payment.updated_at = datetime.utcnow()
-                # session.add(db_payment) # Уже в сессии
+                        return False # Выходим, платеж не обработан до конца
+
+                # Если все операции с Marzban прошли успешно: processing -> succeeded, только пока аренда наша
+                finished = await session.execute(
+                    update(Payment)
+                    .where(Payment.id == db_payment.id, Payment.status == "processing", Payment.claim_token == claim_token)
+                    .values(status="succeeded", claimed_until=None, claim_token=None, updated_at=datetime.utcnow())
+                    .execution_options(synchronize_session=False)
+                )
+                if finished.rowcount != 1:
+                    logger_webhook_process.error(f"Аренда платежа {yookassa_payment_id} истекла до завершения обработки (PAYMENT_CLAIM_LEASE_SEC={PAYMENT_CLAIM_LEASE_SEC}), изменения отменены.")
+                    await session.rollback()
+                    return True # Платеж уже у другого воркера
                 await session.commit()
+                payment_finished = True
                 logger_webhook_process.info(f"Платеж {yookassa_payment_id} успешно обработан и все операции выполнены.")
+                # Пользователь узнает об успехе только после commit под нашей арендой: если аренда потеряна,
+                # платеж доведет другой воркер, а сообщение отправит он
+                if bot_instance and success_message:
+                    await notify_payment_user(bot_instance, telegram_user_id, success_message)
+                return True
 
             except Exception as e_outer:
                 logger_webhook_process.error(f"Общая ошибка при обработке платежа {yookassa_payment_id}: {e_outer}", exc_info=True)
                 await session.rollback()
                 # TODO: Уведомить администратора.
-                # Не возвращаем ошибку Flask, чтобы YooKassa не повторяла, если проблема в нашей логике.
-                # Если ошибка была связана с временной недоступностью Marzban, платеж останется pending.
+                # Платеж вернется в pending, воркер inbox повторит обработку с backoff.
+                return False
+            finally:
+                if db_payment is not None and not payment_finished:
+                    await release_payment_claim(db_payment.id, claim_token, release_status)
             # finally:
             #     await session.close() # async with AsyncSessionLocal() закроет автоматически
 
@@ -326,35 +423,282 @@ async def process_yookassa_notification_standalone(notification_data: dict): # 
         # Можно обновить статус в нашей БД, если нужно
         async with AsyncSessionLocal() as session:
             try:
-                stmt_cancel = select(Payment).where(Payment.yookassa_payment_id == yookassa_payment_id)
-                db_payment_cancel = (await session.execute(stmt_cancel)).scalar_one_or_none()
-                if db_payment_cancel and db_payment_cancel.status != "succeeded": # Не меняем, если уже успешно обработан
-                    db_payment_cancel.status = "canceled"
-                    db_payment_cancel.updated_at = datetime.utcnow()
-                    await session.commit()
+                # Не меняем, если платеж уже проведен или сейчас обрабатывается
+                await session.execute(
+                    update(Payment)
+                    .where(Payment.yookassa_payment_id == yookassa_payment_id, Payment.status.notin_(("succeeded", "processing")))
+                    .values(status="canceled", updated_at=datetime.utcnow())
+                )
+                await session.commit()
+                return True
             except Exception as e_cancel:
                 logger_webhook_process.error(f"Ошибка при обновлении статуса отмененного платежа {yookassa_payment_id}: {e_cancel}", exc_info=True)
                 await session.rollback()
+                return False
     else:
         logger_webhook_process.info(f"Получено уведомление YooKassa с событием {event} для платежа {yookassa_payment_id}. Статус: {payment_object.get('status')}. Не обрабатывается.")
+        return True
+
+
+# --- 5. INBOX И ФОНОВЫЕ ВОРКЕРЫ ---
+# Вебхук только сохраняет уведомление и сразу отвечает 200, поэтому медленный Marzban
+# не приводит к таймаутам и повторам со стороны YooKassa. Обработку делают воркеры.
+inbox_wakeup = asyncio.Event() # Будит воркеров сразу после записи нового уведомления
+inbox_worker_tasks: list[asyncio.Task] = []
+
+async def store_notification_in_inbox(notification_data: dict) -> bool:
+    """Сохраняет уведомление в inbox. Возвращает False, если такое событие по платежу уже было записано."""
+    payment_object = notification_data.get("object") or {}
+    stmt = pg_insert(WebhookInbox).values(
+        yookassa_payment_id=str(payment_object.get("id") or ""),
+        event=str(notification_data.get("event") or ""),
+        payload=json.dumps(notification_data, ensure_ascii=False),
+        status="pending",
+        attempts=0,
+        next_attempt_at=datetime.utcnow(),
+        created_at=datetime.utcnow(),
+    ).on_conflict_do_nothing(constraint="uq_webhook_inbox_payment_event").returning(WebhookInbox.id)
+    async with AsyncSessionLocal() as session:
+        inserted_id = (await session.execute(stmt)).scalar_one_or_none()
+        await session.commit()
+    if inserted_id is not None:
+        inbox_wakeup.set()
+    return inserted_id is not None
+
+async def requeue_notification_in_inbox(notification_data: dict) -> str | None:
+    """
+    Запись уведомления для сверки платежей: как store_notification_in_inbox, но запись done по тому же
+    событию снова ставится в очередь — сверка передает только платежи, которые у нас так и не проведены.
+    Запись failed остается в failed: она уже исчерпала INBOX_MAX_ATTEMPTS, повторять ее по кругу нельзя (разбор вручную).
+    Возвращает "queued" (новая запись), "requeued" (запись открыта заново), "dead_letter" (запись в failed)
+    или None (запись и так ждет обработки).
+    """
+    payment_object = notification_data.get("object") or {}
+    yookassa_payment_id = str(payment_object.get("id") or "")
+    event = str(notification_data.get("event") or "")
+    now = datetime.utcnow()
+    insert_stmt = pg_insert(WebhookInbox).values(
+        yookassa_payment_id=yookassa_payment_id,
+        event=event,
+        payload=json.dumps(notification_data, ensure_ascii=False),
+        status="pending",
+        attempts=0,
+        next_attempt_at=now,
+        created_at=now,
+    )
+    stmt = insert_stmt.on_conflict_do_update(
+        constraint="uq_webhook_inbox_payment_event",
+        set_={
+            "payload": insert_stmt.excluded.payload, "status": "pending", "attempts": 0, "next_attempt_at": now,
+            "locked_until": None, "last_error": None, "processed_at": None,
+        },
+        where=WebhookInbox.status == "done",
+    ).returning(literal_column("xmax = 0").label("inserted")) # xmax = 0 — строка вставлена, а не обновлена
+    async with AsyncSessionLocal() as session:
+        inserted = (await session.execute(stmt)).scalar_one_or_none()
+        await session.commit()
+        if inserted is None:
+            status = (await session.execute(
+                select(WebhookInbox.status).where(WebhookInbox.yookassa_payment_id == yookassa_payment_id, WebhookInbox.event == event)
+            )).scalar_one_or_none()
+            return "dead_letter" if status == "failed" else None
+    inbox_wakeup.set()
+    return "queued" if inserted else "requeued"
+
+async def claim_inbox_item() -> WebhookInbox | None:
+    """Забирает одну готовую к обработке запись (FOR UPDATE SKIP LOCKED) и выставляет ей аренду."""
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as session:
+        stmt = (
+            select(WebhookInbox)
+            .where(or_(
+                (WebhookInbox.status == "pending") & (WebhookInbox.next_attempt_at <= now),
+                # Запись воркера, который упал, не закончив обработку
+                (WebhookInbox.status == "processing") & (WebhookInbox.locked_until < now),
+            ))
+            .order_by(WebhookInbox.next_attempt_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        item = (await session.execute(stmt)).scalar_one_or_none()
+        if not item:
+            return None
+        item.status = "processing"
+        item.attempts += 1
+        item.locked_until = now + timedelta(seconds=INBOX_LEASE_SEC)
+        await session.commit()
+        return item
+
+def inbox_retry_delay(attempts: int) -> float:
+    """Экспоненциальный backoff с jitter."""
+    delay = min(INBOX_RETRY_MAX_SEC, INBOX_RETRY_BASE_SEC * (2 ** max(0, attempts - 1)))
+    return random.uniform(delay / 2, delay)
+
+async def finish_inbox_item(item: WebhookInbox, processed: bool, error: str | None = None):
+    values = {"locked_until": None, "last_error": error}
+    if processed:
+        values.update(status="done", processed_at=datetime.utcnow())
+    elif item.attempts >= INBOX_MAX_ATTEMPTS:
+        values.update(status="failed")
+        log.error(f"Inbox: уведомление {item.id} (платеж {item.yookassa_payment_id}, {item.event}) не обработано за {item.attempts} попыток. Требуется ручное вмешательство.")
+    else:
+        delay = inbox_retry_delay(item.attempts)
+        values.update(status="pending", next_attempt_at=datetime.utcnow() + timedelta(seconds=delay))
+        log.warning(f"Inbox: уведомление {item.id} (платеж {item.yookassa_payment_id}) будет повторено через {delay:.0f} с (попытка {item.attempts}).")
+    async with AsyncSessionLocal() as session:
+        await session.execute(update(WebhookInbox).where(WebhookInbox.id == item.id).values(**values))
+        await session.commit()
+
+async def inbox_worker(worker_no: int):
+    log.info(f"Inbox: воркер {worker_no} запущен.")
+    while True:
+        try:
+            item = await claim_inbox_item()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"Inbox: воркер {worker_no} не смог получить запись: {e}", exc_info=True)
+            item = None
 
+        if not item:
+            inbox_wakeup.clear()
+            try:
+                await asyncio.wait_for(inbox_wakeup.wait(), timeout=INBOX_POLL_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+            continue
 
-# --- 5. FLASK ПРИЛОЖЕНИЕ ---
-flask_app = Flask(__name__)
-
-@flask_app.route('/yookassa_webhook', methods=['POST'])
-def yookassa_webhook_route():
-    json_data = request.get_json()
-    log.info(f"Webhook received data: {json_data}")
+        error = None
+        started = time.monotonic()
+        try:
+            with log_context(payment_id=item.yookassa_payment_id, inbox_id=item.id):
+                processed = await process_yookassa_notification_standalone(json.loads(item.payload))
+        except asyncio.CancelledError:
+            raise # Аренда истечет, и запись заберет другой воркер
+        except Exception as e:
+            log.error(f"Inbox: ошибка обработки уведомления {item.id}: {e}", exc_info=True)
+            processed, error = False, str(e)[:500]
+            metrics.errors.inc(component="webhook_processing", cause=type(e).__name__)
+        metrics.webhook_processing_duration.observe(
+            time.monotonic() - started, event=item.event, result="processed" if processed else "retry"
+        )
+        try:
+            await finish_inbox_item(item, processed, error)
+        except Exception as e:
+            log.error(f"Inbox: не удалось сохранить результат обработки уведомления {item.id}: {e}", exc_info=True)
+
+async def get_inbox_backlog_depth() -> dict:
+    """Количество записей inbox по статусам (кроме done) — глубина очереди для мониторинга."""
+    async with AsyncSessionLocal() as session:
+        stmt = (
+            select(WebhookInbox.status, func.count())
+            .where(WebhookInbox.status != "done")
+            .group_by(WebhookInbox.status)
+        )
+        counts = {status: count for status, count in (await session.execute(stmt)).all()}
+    return {status: counts.get(status, 0) for status in ("pending", "processing", "failed")}
+
+async def payment_reconciler_loop():
+    """Периодическая сверка pending-платежей с YooKassa на случай потерянных вебхуков (см. payment_reconciler.py)."""
+    await asyncio.sleep(random.uniform(0, PAYMENT_RECONCILE_INTERVAL_SEC)) # Разносим воркеры gunicorn по времени
+    while True:
+        try:
+            await reconcile_pending_payments(requeue_notification_in_inbox)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"Сверка платежей: ошибка запуска: {e}", exc_info=True)
+            metrics.errors.inc(component="payment_reconcile", cause=type(e).__name__)
+        await asyncio.sleep(PAYMENT_RECONCILE_INTERVAL_SEC)
+
+def start_inbox_workers():
+    for worker_no in range(INBOX_WORKERS):
+        inbox_worker_tasks.append(asyncio.create_task(inbox_worker(worker_no)))
+    if PAYMENT_RECONCILE_INTERVAL_SEC > 0 and yookassa_client.is_configured:
+        inbox_worker_tasks.append(asyncio.create_task(payment_reconciler_loop())) # Останавливается вместе с воркерами
+
+async def stop_inbox_workers():
+    for task in inbox_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*inbox_worker_tasks, return_exceptions=True)
+    inbox_worker_tasks.clear()
+
+
+# --- 6. ВЕБ-ПРИЛОЖЕНИЕ (aiohttp) ---
+# Приложение живет на одном event loop, поэтому пул соединений async_engine, клиент Marzban
+# и Telegram Bot создаются один раз в on_startup и переиспользуются всеми запросами.
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "5001"))
+
+async def on_startup(app: web.Application):
+    await initialize_marzban_client_wh()
+    if marzban_client_wh:
+        await marzban_tokens_wh.warm_up() # Первый платеж не ждет логина в панель; зависшая панель не держит старт
+    await initialize_telegram_bot_wh()
+    start_inbox_workers()
+    log.info(f"Webhook: приложение запущено, воркеров inbox: {INBOX_WORKERS}.")
+
+async def on_cleanup(app: web.Application):
+    global telegram_bot_wh
+    await stop_inbox_workers()
+    await yookassa_client.close()
+    if telegram_bot_wh:
+        try:
+            await telegram_bot_wh.shutdown()
+        except Exception as e:
+            log.error(f"Webhook: Ошибка при остановке Telegram Bot: {e}")
+        telegram_bot_wh = None
+    if async_engine is not None:
+        await async_engine.dispose()
+    log.info("Webhook: приложение остановлено, пул соединений БД закрыт.")
 
+async def yookassa_webhook_route(request: web.Request) -> web.Response:
     try:
-        # Запускаем нашу асинхронную логику
-        asyncio.run(process_yookassa_notification_standalone(json_data)) # Убрали outline_client_webhook
+        json_data = await request.json()
     except Exception as e:
-        log.error(f"Critical error in webhook processing: {e}", exc_info=True)
-        return "Internal Server Error", 500
+        log.error(f"Webhook: некорректное тело запроса: {e}")
+        return web.Response(text="Bad Request", status=400)
+    payment_object = (json_data.get("object") if isinstance(json_data, dict) else None) or {}
+    with log_context(payment_id=payment_object.get("id")):
+        log.info(f"Webhook: получено уведомление {json_data.get('event') if isinstance(json_data, dict) else None}")
+        log.debug("Webhook: тело уведомления: %s", json_data) # Полное тело — только на DEBUG, форматируется лениво
+
+        try:
+            # Только сохраняем уведомление; обработка идет в фоне (см. inbox_worker)
+            is_new = await store_notification_in_inbox(json_data)
+            if not is_new:
+                log.info("Webhook: повторная доставка уже сохраненного уведомления, пропускаем.")
+        except Exception as e:
+            # Не смогли сохранить — отвечаем 500, чтобы YooKassa повторила доставку
+            log.error(f"Critical error in webhook processing: {e}", exc_info=True)
+            return web.Response(text="Internal Server Error", status=500)
+
+    return web.Response(text="OK", status=200)
+
+async def inbox_stats_route(request: web.Request) -> web.Response:
+    return web.json_response(await get_inbox_backlog_depth())
+
+async def marzban_stats_route(request: web.Request) -> web.Response:
+    return web.json_response(marzban_api_wh.snapshot())
+
+async def db_stats_route(request: web.Request) -> web.Response:
+    return web.json_response(get_pool_stats())
+
+async def telegram_stats_route(request: web.Request) -> web.Response:
+    return web.json_response(telegram_dispatcher_wh.snapshot())
 
-    return "OK", 200
+async def create_app() -> web.Application:
+    """Async-фабрика: aiohttp.GunicornWebWorker принимает только Application или корутину, возвращающую его."""
+    app = web.Application()
+    app.router.add_post('/yookassa_webhook', yookassa_webhook_route)
+    app.router.add_get('/inbox/stats', inbox_stats_route)
+    app.router.add_get('/marzban/stats', marzban_stats_route)
+    app.router.add_get('/db/stats', db_stats_route)
+    app.router.add_get('/telegram/stats', telegram_stats_route)
+    app.router.add_get('/metrics', metrics.metrics_route)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
 
 if __name__ == '__main__':
-    flask_app.run(host='0.0.0.0', port=5001)
+    web.run_app(create_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)
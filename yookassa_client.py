@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
+YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
+# Можно направить на локальную заглушку (fakes/fake_yookassa.py) для тестов и нагрузочных прогонов
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+YOOKASSA_TIMEOUT_SEC = float(os.getenv("YOOKASSA_TIMEOUT_SEC", "15"))
+YOOKASSA_MAX_CONCURRENCY = int(os.getenv("YOOKASSA_MAX_CONCURRENCY", "20")) # Одновременных запросов к API
+YOOKASSA_MAX_CONNECTIONS = int(os.getenv("YOOKASSA_MAX_CONNECTIONS", "20")) # Keep-alive соединений в пуле
+
+logger = logging.getLogger(__name__)
+
+
+class YooKassaApiError(Exception):
+    def __init__(self, status: int, body):
+        super().__init__(f"YooKassa API error {status}: {body}")
+        self.status = status
+        self.body = body
+
+
+class AsyncYooKassaClient:
+    """
+    Асинхронный клиент YooKassa API v3: одна keep-alive сессия aiohttp на процесс,
+    ограничение одновременных запросов и таймауты. Семантика Idempotence-Key как у SDK.
+    """
+
+    def __init__(self, shop_id: str = YOOKASSA_SHOP_ID, secret_key: str = YOOKASSA_SECRET_KEY, api_url: str = YOOKASSA_API_URL):
+        self.shop_id = shop_id
+        self.secret_key = secret_key
+        self.api_url = api_url.rstrip("/")
+        self._session: aiohttp.ClientSession | None = None
+        self._semaphore = asyncio.Semaphore(YOOKASSA_MAX_CONCURRENCY)
+
+    @property
+    def is_configured(self) -> bool:
+        return bool(self.shop_id and self.secret_key)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(str(self.shop_id), str(self.secret_key)),
+                timeout=aiohttp.ClientTimeout(total=YOOKASSA_TIMEOUT_SEC),
+                connector=aiohttp.TCPConnector(limit=YOOKASSA_MAX_CONNECTIONS, keepalive_timeout=60),
+            )
+        return self._session
+
+    async def _request(self, operation: str, method: str, path: str, json_body: dict | None = None, params: dict | None = None, idempotency_key: str | None = None) -> dict:
+        headers = {}
+        if idempotency_key:
+            headers["Idempotence-Key"] = idempotency_key
+        async with self._semaphore:
+            started = time.monotonic()
+            try:
+                async with self._get_session().request(method, f"{self.api_url}{path}", json=json_body, params=params, headers=headers) as response:
+                    try:
+                        body = await response.json(content_type=None)
+                    except ValueError:
+                        body = await response.text()
+                    if response.status >= 400:
+                        raise YooKassaApiError(response.status, body)
+                    return body
+            except YooKassaApiError as e:
+                metrics.errors.inc(component=f"yookassa.{operation}", cause=f"http_{e.status}")
+                raise
+            except Exception as e:
+                metrics.errors.inc(component=f"yookassa.{operation}", cause=type(e).__name__)
+                raise
+            finally:
+                metrics.yookassa_request_duration.observe(time.monotonic() - started, operation=operation)
+
+    async def create_payment(self, payload: dict, idempotency_key: str) -> dict:
+        return await self._request("create_payment", "POST", "/payments", json_body=payload, idempotency_key=idempotency_key)
+
+    async def get_payment(self, payment_id: str) -> dict:
+        return await self._request("get_payment", "GET", f"/payments/{payment_id}")
+
+    async def list_payments(self, **params) -> dict:
+        """Список платежей (фильтры created_at.gte, status, limit, cursor и т.д. — как в API)."""
+        return await self._request("list_payments", "GET", "/payments", params={key: str(value) for key, value in params.items()})
+
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+# Общий экземпляр на процесс
+yookassa_client = AsyncYooKassaClient()